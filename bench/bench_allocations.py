@@ -0,0 +1,122 @@
+# memory kept per Request / Response / Message / RequestTimer and allocated per request, measured with tracemalloc
+# run from the repo root:  python -m bench.bench_allocations
+# (only uses the public API, so the same script runs on older commits to compare)
+import time
+import tracemalloc
+
+from util.request_parser import RequestParser
+from util.response import Response
+from util.for_chat import Message
+from util.metrics import RequestTimer
+
+# objects kept alive at once to measure the size of one
+OBJECTS : int = 10000
+# request cycles timed per case
+CYCLES : int = 50000
+
+browser_get : bytes = (b"GET /api/chats HTTP/1.1\r\n"
+                       b"Host: localhost:8080\r\n"
+                       b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n"
+                       b"Accept: */*\r\n"
+                       b"Accept-Language: en-US,en;q=0.5\r\n"
+                       b"Accept-Encoding: gzip, deflate, br\r\n"
+                       b"Connection: keep-alive\r\n"
+                       b"Referer: http://localhost:8080/chat\r\n"
+                       b"Cookie: session=f0c82cbf-737c-4d9d-879a-3a4e3762765d; theme=dark\r\n"
+                       b"\r\n")
+
+chat_post : bytes = (b"POST /api/chats HTTP/1.1\r\n"
+                     b"Host: localhost:8080\r\n"
+                     b"Content-Type: application/json\r\n"
+                     b"Content-Length: 19\r\n"
+                     b"Cookie: session=f0c82cbf-737c-4d9d-879a-3a4e3762765d; theme=dark\r\n"
+                     b"\r\n"
+                     b'{"content":"hello"}')
+
+
+def parse(data : bytes):
+    parser : RequestParser = RequestParser()
+    parser.feed(data)
+    return parser.next_request()
+
+
+def static_request():
+    # a static file request never looks at the cookies
+    return parse(browser_get)
+
+
+def chat_request():
+    # the chat handlers read the session cookie
+    request = parse(chat_post)
+    request.cookies.get("session", "")
+    return request
+
+
+def text_response() -> Response:
+    return Response().text("message sent")
+
+
+def json_response() -> Response:
+    return Response().json({"messages": [], "version": 1})
+
+
+def message() -> Message:
+    return Message("f0c82cbf-737c-4d9d-879a-3a4e3762765d", "6f1c0f0e-6f3a-4d8e-9f43-0f4b6a1e9c2d", "hello", seq=1)
+
+
+def serve_text() -> None:
+    # one whole request: parse, read the cookie, build and serialize the answer
+    request = parse(chat_post)
+    request.cookies.get("session", "")
+    timer : RequestTimer = RequestTimer()
+    Response().text("message sent").cookies({"session": "f0c82cbf", "HttpOnly": ""}).to_buffers()
+    del timer
+
+
+KEPT : dict = {
+    "Request (static GET)": static_request,
+    "Request (chat POST, cookie read)": chat_request,
+    "Response (text)": text_response,
+    "Response (json)": json_response,
+    "Message": message,
+    "RequestTimer": RequestTimer,
+}
+
+
+def kept_bytes(make) -> float:
+    # traced memory that OBJECTS of them hold on to, per object
+    make()          # anything cached on first use isn't counted
+    tracemalloc.start()
+    before : int = tracemalloc.get_traced_memory()[0]
+    objects : list = [make() for _ in range(OBJECTS)]
+    after : int = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # (the list itself is 8 bytes per object)
+    size : float = (after - before) / len(objects) - 8
+    del objects
+    return size
+
+
+def peak_bytes(call) -> int:
+    # most memory in use at once during one call
+    call()
+    tracemalloc.start()
+    before : int = tracemalloc.get_traced_memory()[0]
+    call()
+    peak : int = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - before
+
+
+def cycles_per_second(call) -> float:
+    start : float = time.perf_counter()
+    for _ in range(CYCLES):
+        call()
+    return CYCLES / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    for name, make in KEPT.items():
+        print(f"{name:<34} {kept_bytes(make):>7,.0f} bytes each")
+    print(f"{'one request (parse + text answer)':<34} {peak_bytes(serve_text):>7,} bytes peak   "
+          f"{cycles_per_second(serve_text):>9,.0f} requests/s")
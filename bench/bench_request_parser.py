@@ -0,0 +1,87 @@
+# compares parse throughput of the incremental RequestParser against the original Request class
+# run from the repo root:  python -m bench.bench_request_parser
+import json
+import time
+
+from util.request import Request
+from util.request_parser import RequestParser
+
+# how long to run each case for
+SECONDS_PER_CASE : float = 1.0
+
+small_get : bytes = (b"GET /api/chats HTTP/1.1\r\n"
+                     b"Host: localhost:8080\r\n"
+                     b"Connection: keep-alive\r\n"
+                     b"Accept: */*\r\n"
+                     b"Cookie: session=f0c82cbf-737c-4d9d-879a-3a4e3762765d\r\n"
+                     b"\r\n")
+
+chat_body : bytes = json.dumps({"content": "hello " * 200}).encode()
+chat_post : bytes = (b"POST /api/chats HTTP/1.1\r\n"
+                     b"Host: localhost:8080\r\n"
+                     b"Content-Type: application/json\r\n"
+                     b"Content-Length: " + str(len(chat_body)).encode() + b"\r\n"
+                     b"Cookie: session=f0c82cbf-737c-4d9d-879a-3a4e3762765d; theme=dark\r\n"
+                     b"\r\n" + chat_body)
+
+large_body : bytes = b"x" * (256 * 1024)
+large_post : bytes = (b"POST /api/chats HTTP/1.1\r\n"
+                      b"Host: localhost:8080\r\n"
+                      b"Content-Length: " + str(len(large_body)).encode() + b"\r\n"
+                      b"\r\n" + large_body)
+
+CASES : dict[str, bytes] = {
+    "small GET": small_get,
+    "1 KB chat POST": chat_post,
+    "256 KB POST": large_post,
+}
+
+
+def split_into_reads(data : bytes, read_size : int) -> list[bytes]:
+    return [data[i:i + read_size] for i in range(0, len(data), read_size)]
+
+
+def requests_per_second(parse_one) -> float:
+    count : int = 0
+    start : float = time.perf_counter()
+    deadline : float = start + SECONDS_PER_CASE
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            parse_one()
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+def bench_case(name : str, data : bytes) -> None:
+    # the original class needs the whole request in one buffer
+    def parse_with_request() -> None:
+        Request(data)
+
+    # the parser gets the same bytes in one feed, and split into 8 KB socket reads
+    # (one parser per connection, like MyTCPHandler)
+    parser = RequestParser(max_body_size=len(data))
+
+    def parse_with_parser() -> None:
+        parser.feed(data)
+        parser.next_request()
+
+    reads : list[bytes] = split_into_reads(data, 8192)
+
+    def parse_with_parser_reads() -> None:
+        request = None
+        for read in reads:
+            parser.feed(read)
+            request = parser.next_request()
+        assert request is not None
+
+    old : float = requests_per_second(parse_with_request)
+    new : float = requests_per_second(parse_with_parser)
+    new_reads : float = requests_per_second(parse_with_parser_reads)
+    print(f"{name:<16} Request: {old:>11,.0f} req/s   "
+          f"RequestParser: {new:>11,.0f} req/s ({new / old:.2f}x)   "
+          f"RequestParser, {len(reads)} reads: {new_reads:>11,.0f} req/s")
+
+
+if __name__ == '__main__':
+    for case_name, case_data in CASES.items():
+        bench_case(case_name, case_data)
@@ -0,0 +1,92 @@
+# compares Response serialization before and after the status line cache / one-pass head / sendmsg change
+# run from the repo root:  python -m bench.bench_to_data
+import json
+import socket
+import threading
+import time
+
+from util.response import Response
+
+# how long to run each case for
+SECONDS_PER_CASE : float = 1.0
+
+
+def old_to_data(self : Response) -> bytes:
+    # Response.to_data as it was: status line built every time, bytes added together one header at a time
+    status_line : bytes = ((self.http_version + " " + str(self.status_code) + " " + self.status_message + "\r\n")
+                           .encode("utf-8"))
+    self.set_header("Content-Length", str(len(self.body)))
+    headers : bytes = b""
+    for key, value in self.final_headers.items():
+        headers += (key + ": " + value + "\r\n").encode("utf-8")
+    for key, value in self.final_cookies.items():
+        if key == "HttpOnly" or key == "Secure":
+            headers += b"Set-Cookie: " + (key + "\r\n").encode("utf-8")
+        else:
+            headers += b"Set-Cookie: " + (key + "=" + value + "\r\n").encode("utf-8")
+    return status_line + headers + b"\r\n" + self.body
+
+
+def small_text() -> Response:
+    return Response().text("hello").cookies({"session": "f0c82cbf-737c-4d9d-879a-3a4e3762765d"})
+
+
+def json_10kb() -> Response:
+    messages : list[dict] = [{"id": str(number), "author": "f0c82cbf", "content": "hello " * 10,
+                              "updated": False, "reactions": {}} for number in range(100)]
+    return Response().json({"messages": messages})
+
+
+def binary_1mb() -> Response:
+    response : Response = Response().bytes(b"\x89" * (1024 * 1024))
+    response.headers({"Content-Type": "image/png"})
+    return response
+
+
+CASES : dict = {
+    "small text": small_text(),
+    "10 KB JSON": json_10kb(),
+    "1 MB binary": binary_1mb(),
+}
+
+
+def calls_per_second(call) -> float:
+    count : int = 0
+    start : float = time.perf_counter()
+    deadline : float = start + SECONDS_PER_CASE
+    while time.perf_counter() < deadline:
+        for _ in range(20):
+            call()
+        count += 20
+    return count / (time.perf_counter() - start)
+
+
+def drain(sock : socket.socket) -> None:
+    # reads everything the other end sends until it closes
+    while len(sock.recv(1 << 20)) > 0:
+        pass
+
+
+def bench_case(name : str, response : Response) -> None:
+    assert old_to_data(response) == response.to_data()
+
+    old : float = calls_per_second(lambda: old_to_data(response))
+    new : float = calls_per_second(response.to_buffers)
+
+    # the same through a socket: sendall(old to_data()) vs send() (head and body handed over as two buffers once the body is big)
+    writer, reader = socket.socketpair()
+    thread : threading.Thread = threading.Thread(target=drain, args=(reader,), daemon=True)
+    thread.start()
+    old_send : float = calls_per_second(lambda: writer.sendall(old_to_data(response)))
+    new_send : float = calls_per_second(lambda: response.send(writer))
+    writer.close()
+    thread.join()
+    reader.close()
+
+    print(f"{name:<12} old to_data: {old:>10,.0f}/s   to_buffers(): {new:>10,.0f}/s ({new / old:.2f}x)   "
+          f"old sendall: {old_send:>9,.0f}/s   send(): {new_send:>9,.0f}/s ({new_send / old_send:.2f}x)")
+
+
+if __name__ == '__main__':
+    for case_name, case_response in CASES.items():
+        bench_case(case_name, case_response)
@@ -0,0 +1,327 @@
+# load test for server.py: starts the server against the in-memory database (DB_BACKEND=memory),
+# replays a few traffic mixes against it and saves the results as JSON
+# run from the repo root:  python -m bench.load_test [--scenario mixed] [--duration 10] [--server-mode threads]
+# compare two runs:       python -m bench.load_test --compare bench/results/<old>.json bench/results/<new>.json
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+# how many of each kind of client every scenario runs (all at once)
+#   pollers  : browsers polling GET /api/chats?since= once a second, like public/js/chat.js
+#   posters  : POST /api/chats in bursts of BURST_SIZE back to back, then BURST_PAUSE seconds of nothing
+#   reactors : add/remove reactions on the same few messages as fast as they can
+#   fetchers : static files and the rendered pages, as fast as they can
+SCENARIOS : dict[str, dict[str, int]] = {
+    "polling": {"pollers": 200},
+    "post_burst": {"pollers": 20, "posters": 20},
+    "reaction_storm": {"pollers": 20, "reactors": 20},
+    "static": {"fetchers": 10},
+    "mixed": {"pollers": 100, "posters": 5, "reactors": 5, "fetchers": 5},
+}
+
+POLL_INTERVAL : float = 1.0
+BURST_SIZE : int = 20
+BURST_PAUSE : float = 0.5
+# messages posted before the clock starts, for reactors to react to
+SEED_MESSAGES : int = 10
+EMOJIS : list[str] = ["👍", "🔥", "😂", "🎉"]
+STATIC_PATHS : list[str] = ["/", "/chat", "/public/js/chat.js", "/public/js/utils.js",
+                            "/public/css/googleButton.css", "/public/imgs/cat.jpg"]
+
+RESULTS_DIR : str = os.path.join("bench", "results")
+
+
+class ClientStats:
+    # what one client saw, merged per kind after the run
+    def __init__(self) -> None:
+        self.latencies : list[float] = []
+        self.statuses : dict[str, int] = {}
+        self.errors : int = 0
+        self.reconnects : int = 0
+
+    def record(self, started : float, status : int) -> None:
+        self.latencies.append(time.perf_counter() - started)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        if status >= 500:
+            self.errors += 1
+
+
+def request(connection : http.client.HTTPConnection, stats : ClientStats, method : str, path : str,
+            body : dict | None = None, headers : dict[str, str] | None = None) -> http.client.HTTPResponse | None:
+    # one request on a keep-alive connection (the body is read), None if it failed
+    # the server closes a connection after MAX_REQUESTS_PER_CONNECTION, so like a browser, a request that
+    # fails on a reused connection is sent again once on a new one
+    started : float = time.perf_counter()
+    for attempt in range(2):
+        try:
+            connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers or {})
+            response : http.client.HTTPResponse = connection.getresponse()
+            response.data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            if attempt == 0:
+                stats.reconnects += 1
+                continue
+            stats.latencies.append(time.perf_counter() - started)
+            stats.errors += 1
+            return None
+        stats.record(started, response.status)
+        return response
+
+
+def poller(port : int, stats : ClientStats, stop : threading.Event, context : dict) -> None:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    headers : dict[str, str] = {"Accept-Encoding": "gzip"}
+    path : str = "/api/chats"
+    # spread the polls over the second, like browsers opened at different times
+    next_poll : float = time.monotonic() + random.random() * POLL_INTERVAL
+    while not stop.wait(max(0.0, next_poll - time.monotonic())):
+        next_poll += POLL_INTERVAL
+        response = request(connection, stats, "GET", path, headers=headers)
+        if response is not None and response.status == 200:
+            # ETag "chat-<cursor>" says how far the response goes, the next poll asks for what's after it
+            etag : str = response.getheader("ETag")
+            path = "/api/chats?since=" + etag.strip('"')[len("chat-"):]
+            headers["If-None-Match"] = etag
+
+
+def poster(port : int, stats : ClientStats, stop : threading.Event, context : dict) -> None:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    headers : dict[str, str] = {"Cookie": "session=" + str(uuid.uuid4())}
+    number : int = 0
+    while not stop.is_set():
+        for _ in range(BURST_SIZE):
+            number += 1
+            request(connection, stats, "POST", "/api/chats", {"content": "load test message " + str(number)}, headers)
+        stop.wait(BURST_PAUSE)
+
+
+def reactor(port : int, stats : ClientStats, stop : threading.Event, context : dict) -> None:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    headers : dict[str, str] = {"Cookie": "session=" + str(uuid.uuid4())}
+    message_ids : list[str] = context["message_ids"]
+    while not stop.is_set():
+        path : str = "/api/reaction/" + random.choice(message_ids)
+        body : dict = {"emoji": random.choice(EMOJIS)}
+        request(connection, stats, "PATCH", path, body, headers)
+        request(connection, stats, "DELETE", path, body, headers)
+
+
+def fetcher(port : int, stats : ClientStats, stop : threading.Event, context : dict) -> None:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    while not stop.is_set():
+        request(connection, stats, "GET", random.choice(STATIC_PATHS), headers={"Accept-Encoding": "gzip"})
+
+
+CLIENTS : dict = {
+    "pollers": poller,
+    "posters": poster,
+    "reactors": reactor,
+    "fetchers": fetcher,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_server(port : int, server_mode : str) -> subprocess.Popen:
+    # every simulated client comes from 127.0.0.1, so util/rate_limit.py is left off (its default) unless asked for
+    env : dict[str, str] = dict(os.environ, PORT=str(port), DB_BACKEND="memory", SERVER_MODE=server_mode)
+    # server.py logs a sample of requests (REQUEST_LOG_SAMPLE_RATE in util/metrics.py) to stderr, that's part of what it costs
+    server = subprocess.Popen([sys.executable, "server.py"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline : float = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/hello")
+            if connection.getresponse().status == 200:
+                connection.close()
+                # keep reading the log so a full pipe never blocks the server
+                threading.Thread(target=discard_lines, args=(server.stderr,), daemon=True).start()
+                return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server.py didn't start: " + server.stderr.read().decode(errors="replace")[-2000:])
+
+
+def discard_lines(stream) -> None:
+    for _ in stream:
+        pass
+
+
+def read_rss_mb(pid : int) -> dict[str, float | None]:
+    # resident memory (and its peak) of the server process, Linux only
+    rss : dict[str, float | None] = {"rss_mb": None, "peak_rss_mb": None}
+    try:
+        with open("/proc/" + str(pid) + "/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    rss["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    rss["peak_rss_mb"] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return rss
+
+
+def seed_messages(port : int) -> list[str]:
+    # SEED_MESSAGES messages to react to, returns their ids
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    stats : ClientStats = ClientStats()
+    for number in range(SEED_MESSAGES):
+        request(connection, stats, "POST", "/api/chats", {"content": "seed " + str(number)})
+    response = request(connection, stats, "GET", "/api/chats?limit=" + str(SEED_MESSAGES))
+    connection.close()
+    return [message["id"] for message in json.loads(response.data)["messages"]]
+
+
+def percentile(sorted_values : list[float], fraction : float) -> float:
+    # nearest rank
+    if len(sorted_values) == 0:
+        return 0.0
+    index : int = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(stats : list[ClientStats], duration : float) -> dict:
+    latencies : list[float] = sorted(latency for client in stats for latency in client.latencies)
+    statuses : dict[str, int] = {}
+    for client in stats:
+        for status, count in client.statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": (latencies[-1] if len(latencies) > 0 else 0.0) * 1000,
+        "errors": sum(client.errors for client in stats),
+        "reconnects": sum(client.reconnects for client in stats),
+        "statuses": statuses,
+    }
+
+
+def run_scenario(name : str, clients : dict[str, int], duration : float, server_mode : str) -> dict:
+    # a fresh server for every scenario, so one doesn't warm up (or fill up) the next
+    port : int = free_port()
+    server : subprocess.Popen = start_server(port, server_mode)
+    try:
+        context : dict = {"message_ids": seed_messages(port)}
+        stop : threading.Event = threading.Event()
+        stats : dict[str, list[ClientStats]] = {kind: [ClientStats() for _ in range(count)]
+                                                for kind, count in clients.items()}
+        threads : list[threading.Thread] = [threading.Thread(target=CLIENTS[kind], args=(port, client_stats, stop, context),
+                                                             daemon=True)
+                                            for kind, kind_stats in stats.items() for client_stats in kind_stats]
+        started : float = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=15)
+        elapsed : float = time.perf_counter() - started
+
+        result : dict = {"clients": clients, "duration": elapsed}
+        result.update(read_rss_mb(server.pid))
+        result["kinds"] = {kind: summarize(kind_stats, elapsed) for kind, kind_stats in stats.items()}
+        result["total"] = summarize([client for kind_stats in stats.values() for client in kind_stats], elapsed)
+        return result
+    finally:
+        server.terminate()
+        try:
+            server.wait(5)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_result(name : str, result : dict) -> None:
+    rss : str = "?" if result["rss_mb"] is None else format(result["rss_mb"], ".1f")
+    peak : str = "?" if result["peak_rss_mb"] is None else format(result["peak_rss_mb"], ".1f")
+    print(f"{name}  (RSS {rss} MB, peak {peak} MB)")
+    for kind, summary in list(result["kinds"].items()) + [("total", result["total"])]:
+        print(f"  {kind:<9} {summary['throughput']:>9,.1f} req/s   p50 {summary['p50_ms']:>7.2f} ms   "
+              f"p95 {summary['p95_ms']:>7.2f} ms   p99 {summary['p99_ms']:>7.2f} ms   errors {summary['errors']}")
+
+
+def compare(old_path : str, new_path : str) -> None:
+    # throughput and latency of the second run relative to the first
+    with open(old_path) as old_file:
+        old : dict = json.load(old_file)
+    with open(new_path) as new_file:
+        new : dict = json.load(new_file)
+    print(f"{old['commit']} -> {new['commit']}")
+    for name, new_result in new["scenarios"].items():
+        old_result : dict | None = old["scenarios"].get(name)
+        if old_result is None:
+            continue
+        print(name)
+        for kind, new_summary in list(new_result["kinds"].items()) + [("total", new_result["total"])]:
+            old_summary : dict | None = old_result["total"] if kind == "total" else old_result["kinds"].get(kind)
+            if old_summary is None:
+                continue
+            changes : list[str] = []
+            for key in ("throughput", "p50_ms", "p95_ms", "p99_ms"):
+                if old_summary[key] > 0:
+                    changes.append(f"{key} {(new_summary[key] / old_summary[key] - 1) * 100:+.1f}%")
+            print(f"  {kind:<9} " + "   ".join(changes))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="load test server.py against the in-memory database")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="scenario to run (can be repeated, all of them by default)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument("--server-mode", default="threads", help="SERVER_MODE for server.py")
+    parser.add_argument("--output", help="where to save the JSON results (bench/results/<commit>-<time>.json by default)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved results and exit")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+
+    results : dict = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "server_mode": args.server_mode,
+        "python": sys.version.split()[0],
+        "scenarios": {},
+    }
+    for name in args.scenario or list(SCENARIOS):
+        result : dict = run_scenario(name, SCENARIOS[name], args.duration, args.server_mode)
+        results["scenarios"][name] = result
+        print_result(name, result)
+
+    output : str = args.output or os.path.join(RESULTS_DIR, results["commit"] + "-" +
+                                               time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print("saved " + output)
+
+
+if __name__ == '__main__':
+    main()
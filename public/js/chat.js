@@ -2,150 +2,228 @@ import { html } from "./utils.js";
 
 let selectedMessage = null;
 
+// cursor + ETag of the last /api/chats response, polls only get what changed since then
+let cursor = null;
+let etag = null;
+
+// latest version of a message that arrived while it was being edited
+let skippedWhileEditing = null;
+
+// every message on the page by id, to re-render them when their author changes nickname
+const messagesById = new Map();
+
+// "created" of the oldest message on the page, older history is loaded on demand
+let oldestCreated = null;
+
 async function fetchMessages() {
-  const newMessages = await fetch("/api/chats").then((res) => res.json());
-  newMessages.messages.forEach((message) => {
-    if (message.id === isEditing) {
+  const url = cursor === null ? "/api/chats" : `/api/chats?since=${cursor}`;
+  const headers = etag === null ? {} : { "If-None-Match": etag };
+  const res = await fetch(url, { headers });
+  if (res.status === 304 || !res.ok) {
+    return;
+  }
+  const firstLoad = cursor === null;
+  const newMessages = await res.json();
+  etag = res.headers.get("ETag");
+  if (firstLoad) {
+    // the newest page of the history
+    trackOldest(newMessages);
+  }
+  applyChanges(newMessages);
+  if (newMessages.has_more && !firstLoad) {
+    // more changes than fit in one response
+    return fetchMessages();
+  }
+}
+
+async function loadOlderMessages() {
+  const res = await fetch(`/api/chats?before=${oldestCreated}`);
+  if (!res.ok) {
+    return;
+  }
+  const page = await res.json();
+  trackOldest(page);
+  // oldest first, so each one goes above the last
+  page.messages.reverse().forEach((message) => renderMessage(message, "afterbegin"));
+  addMessageClickHandlers();
+}
+window.loadOlderMessages = loadOlderMessages;
+
+function trackOldest(page) {
+  // {"messages": [...], "has_more": boolean} from a page of the history
+  if (page.messages.length > 0) {
+    oldestCreated = page.messages[0].created;
+  }
+  document
+    .getElementById("load-older")
+    .classList.toggle("hidden", !page.has_more);
+}
+
+function applyChanges(changes) {
+  // {"messages": [...], "nicknames": {author: nickname}, "cursor": int}
+  cursor = changes.cursor;
+  changes.messages.forEach((message) => {
+    // changes to history that isn't loaded yet show up when it is
+    if (
+      !message.deleted &&
+      oldestCreated !== null &&
+      message.created < oldestCreated &&
+      !messagesById.has(message.id)
+    ) {
       return;
     }
-    const messageHtml = html`
-      <div id="group-${message.id}" class="py-1">
-        <div id="message-${message.id}" class="flex items-start gap-2 group">
-          <div class="flex items-center h-full self-center">
-            <button
-            class="text-xs px-1 py-0.5 rounded bg-gray-600 text-white hover:bg-gray-500"
-            id="delete-button"
-            onclick="deleteMessage('${message.id}')"
-            >
-            X
-            </button>
-          </div>
-          <img 
-            src="${message.imageURL}" 
-            alt="${message.author}'s avatar"
-            class="w-8 h-8 rounded-full bg-gray-200"
-          />
-          <div class="relative flex flex-col h-full justify-center">
-            <p>
-              <div class="cursor-pointer message-content" id="${message.id}">
-                <span class="italic font-black group">
-                  <span class="group-hover:hidden">${
-                    message.nickname ? message.nickname : message.author
-                  }</span>
-                  ${`<span class="hidden group-hover:inline font-light">${message.author}</span>`} :
-                </span>
-                <span 
-                  >${message.content}</span
-                >
-                <span class="text-xs">${
-                  message.updated ? "(edited)" : ""
-                } </span>
-              </div>
-              <button
-                class="absolute top-0 -right-6 p-1 hover:bg-gray-200/50 rounded-full"
-                onclick="editMessage('${message.id}')"
-              >
-                <svg
-                  xmlns="http://www.w3.org/2000/svg"
-                  width="14"
-                  height="14"
-                  viewBox="0 0 24 24"
-                  fill="none"
-                  stroke="currentColor"
-                  stroke-width="2"
-                  stroke-linecap="round"
-                  stroke-linejoin="round"
-                  class="text-gray-600"
-                >
-                  <path
-                    d="M21.174 6.812a1 1 0 0 0-3.986-3.987L3.842 16.174a2 2 0 0 0-.5.83l-1.321 4.352a.5.5 0 0 0 .623.622l4.353-1.32a2 2 0 0 0 .83-.497z"
-                  />
-                  <path d="m15 5 4 4" />
-                </svg>
-              </button>
-              <!-- This is emoji div, converts map to array, loops through adds badge for each emoji-->
-              <div class="flex flex-wrap gap-1 mt-1">
-                ${Object.entries(message.reactions || {})
-                  .map(
-                    ([emoji, users]) => `
-                  <button onclick="removeReaction(
-                    '${message.id}'
-                  , '${emoji}')" class="px-2 py-0.5 rounded-full text-sm bg-gray-600">
-                    ${
-                      users.length > 1
-                        ? `<span class="mr-1">${users.length}</span>`
-                        : ""
-                    }${emoji}
-                  </button>
-                `
-                  )
-                  .join("")}
-              </div>
-            </p>
-          </div>
-        </div>
+    renderMessage(message);
+  });
+  // nicknames aren't stored with the messages, a rename only sends the new name
+  const nicknames = changes.nicknames || {};
+  messagesById.forEach((message) => {
+    if (message.author in nicknames) {
+      message.nickname = nicknames[message.author];
+      renderMessage(message);
+    }
+  });
+  addMessageClickHandlers();
+}
 
-        <div
-          class="hidden flex items-start gap-2 mb-2"
-          id="edit-form-${message.id}"
-        >
-          <form
-            class="w-full"
-            onsubmit="event.preventDefault(); submitEdit('${message.id}')"
+function renderMessage(message, position = "beforeend") {
+  // Remove deleted messages
+  if (message.deleted) {
+    const element = document.getElementById(`group-${message.id}`);
+    if (element) {
+      element.remove();
+    }
+    messagesById.delete(message.id);
+    return;
+  }
+  messagesById.set(message.id, message);
+  if (message.id === isEditing) {
+    skippedWhileEditing = message;
+    return;
+  }
+  const messageHtml = html`
+    <div id="group-${message.id}" class="py-1">
+      <div id="message-${message.id}" class="flex items-start gap-2 group">
+        <div class="flex items-center h-full self-center">
+          <button
+          class="text-xs px-1 py-0.5 rounded bg-gray-600 text-white hover:bg-gray-500"
+          id="delete-button"
+          onclick="deleteMessage('${message.id}')"
           >
-            <div class="flex gap-2 items-center">
-              <span class="text-sm">${message.author}:</span>
-              <input
-                type="text"
-                class="flex-1 px-2 py-1 border rounded"
-                value="${message.content}"
-                id="edit-input-${message.id}"
-              />
-            </div>
-            <div class="flex gap-2 mt-2 justify-start">
-              <button
-                type="button"
-                class="px-2 py-1 text-sm rounded bg-gray-700 hover:bg-gray-300"
-                onclick="cancelEdit('${message.id}')"
+          X
+          </button>
+        </div>
+        <img 
+          src="${message.imageURL}" 
+          alt="${message.author}'s avatar"
+          class="w-8 h-8 rounded-full bg-gray-200"
+        />
+        <div class="relative flex flex-col h-full justify-center">
+          <p>
+            <div class="cursor-pointer message-content" id="${message.id}">
+              <span class="italic font-black group">
+                <span class="group-hover:hidden">${
+                  message.nickname ? message.nickname : message.author
+                }</span>
+                ${`<span class="hidden group-hover:inline font-light">${message.author}</span>`} :
+              </span>
+              <span 
+                >${message.content}</span
               >
-                Cancel
-              </button>
-              <button
-                class="px-2 py-1 text-sm rounded bg-blue-500 text-white hover:bg-blue-600"
-                type="submit"
+              <span class="text-xs">${
+                message.updated ? "(edited)" : ""
+              } </span>
+            </div>
+            <button
+              class="absolute top-0 -right-6 p-1 hover:bg-gray-200/50 rounded-full"
+              onclick="editMessage('${message.id}')"
+            >
+              <svg
+                xmlns="http://www.w3.org/2000/svg"
+                width="14"
+                height="14"
+                viewBox="0 0 24 24"
+                fill="none"
+                stroke="currentColor"
+                stroke-width="2"
+                stroke-linecap="round"
+                stroke-linejoin="round"
+                class="text-gray-600"
               >
-                Save
-              </button>
+                <path
+                  d="M21.174 6.812a1 1 0 0 0-3.986-3.987L3.842 16.174a2 2 0 0 0-.5.83l-1.321 4.352a.5.5 0 0 0 .623.622l4.353-1.32a2 2 0 0 0 .83-.497z"
+                />
+                <path d="m15 5 4 4" />
+              </svg>
+            </button>
+            <!-- This is emoji div, converts map to array, loops through adds badge for each emoji-->
+            <div class="flex flex-wrap gap-1 mt-1">
+              ${Object.entries(message.reactions || {})
+                .map(
+                  ([emoji, users]) => `
+                <button onclick="removeReaction(
+                  '${message.id}'
+                , '${emoji}')" class="px-2 py-0.5 rounded-full text-sm bg-gray-600">
+                  ${
+                    users.length > 1
+                      ? `<span class="mr-1">${users.length}</span>`
+                      : ""
+                  }${emoji}
+                </button>
+              `
+                )
+                .join("")}
             </div>
-          </form>
+          </p>
         </div>
       </div>
-    `;
-    const groupRef = document.getElementById(`group-${message.id}`);
-    if (groupRef === null) {
-      document
-        .getElementById("messages")
-        .insertAdjacentHTML("beforeend", messageHtml);
-      return;
-    }
-    groupRef.outerHTML = messageHtml;
-  });
 
-  // Remove deleted messages
-  document.querySelectorAll('[id^="group-"]').forEach((element) => {
-    const id = element.id.replace("group-", "");
-    // console.log("message group id:", id);
-    const isDeleted = !newMessages.messages.find(
-      (message) => message.id === id
-    );
-    if (isDeleted) {
-      const element = document.getElementById(`group-${id}`);
-      if (element) {
-        element.remove();
-      }
-    }
-  });
+      <div
+        class="hidden flex items-start gap-2 mb-2"
+        id="edit-form-${message.id}"
+      >
+        <form
+          class="w-full"
+          onsubmit="event.preventDefault(); submitEdit('${message.id}')"
+        >
+          <div class="flex gap-2 items-center">
+            <span class="text-sm">${message.author}:</span>
+            <input
+              type="text"
+              class="flex-1 px-2 py-1 border rounded"
+              value="${message.content}"
+              id="edit-input-${message.id}"
+            />
+          </div>
+          <div class="flex gap-2 mt-2 justify-start">
+            <button
+              type="button"
+              class="px-2 py-1 text-sm rounded bg-gray-700 hover:bg-gray-300"
+              onclick="cancelEdit('${message.id}')"
+            >
+              Cancel
+            </button>
+            <button
+              class="px-2 py-1 text-sm rounded bg-blue-500 text-white hover:bg-blue-600"
+              type="submit"
+            >
+              Save
+            </button>
+          </div>
+        </form>
+      </div>
+    </div>
+  `;
+  const groupRef = document.getElementById(`group-${message.id}`);
+  if (groupRef === null) {
+    document
+      .getElementById("messages")
+      .insertAdjacentHTML(position, messageHtml);
+    return;
+  }
+  groupRef.outerHTML = messageHtml;
+}
 
+function addMessageClickHandlers() {
   // Add onclick function for toggling the emoji picker
   const messageContent = document.querySelectorAll(".message-content");
   const tooltip = document.querySelector("#emoji-tooltip");
@@ -176,8 +254,34 @@ const closeTooltip = () => {
 };
 window.closeTooltip = closeTooltip; // Make global
 
-fetchMessages();
-setInterval(fetchMessages, 1000);
+// The server pushes changes over /api/chats/stream, polling is only the fallback
+let pollTimer = null;
+
+function startPolling() {
+  if (pollTimer === null) {
+    pollTimer = setInterval(fetchMessages, 1000);
+  }
+}
+
+function subscribeToMessages() {
+  if (!window.EventSource) {
+    startPolling();
+    return;
+  }
+  const stream = new EventSource(`/api/chats/stream?since=${cursor}`);
+  stream.addEventListener("messages", (event) => {
+    etag = null;
+    applyChanges(JSON.parse(event.data));
+  });
+  stream.onerror = () => {
+    // EventSource reconnects by itself, unless the server turned it away
+    if (stream.readyState === EventSource.CLOSED) {
+      startPolling();
+    }
+  };
+}
+
+fetchMessages().then(subscribeToMessages, startPolling);
 let isEditing = null;
 
 // Way to add emoji
@@ -342,6 +446,13 @@ function cancelEdit(messageId) {
   document.getElementById(`message-${messageId}`).classList.remove("hidden");
   document.getElementById(`edit-form-${messageId}`).classList.add("hidden");
   isEditing = null;
+
+  // show any change to the message that came in while editing it
+  if (skippedWhileEditing !== null && skippedWhileEditing.id === messageId) {
+    renderMessage(skippedWhileEditing);
+    addMessageClickHandlers();
+  }
+  skippedWhileEditing = null;
 }
 
 function submitEdit(messageId) {
@@ -1,58 +1,219 @@
+import os
+import socket
 import socketserver
+import time
 
 from util.request import Request
+from util.request_parser import RequestParser, ParseError
+from util.response import Response
 from util.router import Router
 from util.hello_path import hello_path
 from util.static_paths import serve_static_file, handle_index, handle_chat
 from util.for_chat import create_chat_message, retrieve_all_messages, update_chat_message, delete_chat_message
+from util.for_chat import stream_chat_messages
 from util.emojis_and_nicknames import add_emoji, remove_emoji, change_nickname
+from util.server_modes import serve
+from util.push import is_detached
+from util.database import bootstrap_database
+from util.metrics import RequestTimer, request_metrics, set_timer, log_request, configure_logging
+from util.metrics_path import serve_metrics
+from util.profiler import start_from_env
+from util.profiler_path import run_profile
+from util.rate_limit import accept_connection, close_connection, admit, finish_request
+from util.keep_alive import KEEP_ALIVE_TIMEOUT
+
+# how many requests a keep-alive connection can make (KEEP_ALIVE_TIMEOUT is in util/keep_alive.py)
+MAX_REQUESTS_PER_CONNECTION : int = int(os.environ.get("MAX_REQUESTS_PER_CONNECTION", "100"))
+
+# how many bytes to ask the socket for at a time while reading headers
+RECV_SIZE : int = 8192
+
+
+def build_router() -> Router:
+    # built once when the server starts, every connection shares it
+    router = Router()
+    router.add_route("GET", "/hello", hello_path, True)
+    router.add_route("GET", "/metrics", serve_metrics, True)
+    router.add_route("POST", "/admin/profile", run_profile, True)
+    # TODO: Add your routes here
+
+    # HW1 LO's
+    router.add_route("GET", "/public", serve_static_file, False)
+    router.add_route("GET", "/", handle_index, True)
+    router.add_route("GET", "/chat", handle_chat, True)
+
+    # all the request.path's will begin with a "/"
+    router.add_route("POST", "/api/chats", create_chat_message, True)
+    router.add_route("GET", "/api/chats", retrieve_all_messages, True)
+    router.add_route("GET", "/api/chats/stream", stream_chat_messages, True)
+    router.add_route("PATCH", "/api/chats/{id}", update_chat_message, True)
+    router.add_route("DELETE", "/api/chats/{id}", delete_chat_message, True)
+
+    # HW1 AO's
+    router.add_route("PATCH", "/api/reaction/{id}", add_emoji, True)
+    router.add_route("DELETE", "/api/reaction/{id}", remove_emoji, True)
+    router.add_route("PATCH", "/api/nickname", change_nickname, True)
+
+    return router
 
 
 class MyTCPHandler(socketserver.BaseRequestHandler):
 
-    def __init__(self, request, client_address, server):
-        self.router = Router()
-        self.router.add_route("GET", "/hello", hello_path, True)
-        # TODO: Add your routes here
+    router : Router = build_router()
 
-        # HW1 LO's
-        self.router.add_route("GET", "/public", serve_static_file, False)
-        self.router.add_route("GET", "/", handle_index, True)
-        self.router.add_route("GET", "/chat", handle_chat, True)
+    def setup(self):
+        # once per connection, handle() can run more than once (see below)
+        self.request.settimeout(KEEP_ALIVE_TIMEOUT)
 
-        # all the request.path's will begin with a "/"
-        self.router.add_route("POST", "/api/chats", create_chat_message, True)
-        self.router.add_route("GET", "/api/chats", retrieve_all_messages, True)
-        self.router.add_route("PATCH", "/api/chats", update_chat_message, False)
-        self.router.add_route("DELETE", "/api/chats", delete_chat_message, False)
+        # PROFILE_ON_START, see util/profiler.py
+        start_from_env()
 
-        # HW1 AO's
-        self.router.add_route("PATCH", "/api/reaction", add_emoji, False)
-        self.router.add_route("DELETE", "/api/reaction", remove_emoji, False)
-        self.router.add_route("PATCH", "/api/nickname", change_nickname, True)
+        # the parser keeps any bytes after the current request, so pipelined
+        # requests that arrive in the same recv are answered in order
+        self.parser : RequestParser = RequestParser()
+        self.requests_served : int = 0
+        # True when handle() returned with the connection idle between keep-alive requests
+        self.idle : bool = False
 
-        super().__init__(request, client_address, server)
+        # connections per client IP, requests per IP/session and requests in flight, see util/rate_limit.py
+        self.client_ip : str = self.client_address[0] if self.client_address else ""
+        self.accepted : bool = accept_connection(self.client_ip, self.request)
 
     def handle(self):
-        received_data = self.request.recv(2048)
-        print(self.client_address)
-        print("--- received data ---")
-        print(received_data)
-        print("--- end of data ---\n\n")
-        request = Request(received_data)
-
-        self.router.route_request(request, self)
+        # HTTP/1.1 persistent connections: keep serving requests on this socket until
+        # the client asks to close, goes idle for KEEP_ALIVE_TIMEOUT seconds,
+        # or MAX_REQUESTS_PER_CONNECTION have been served
+        #
+        # servers with parks_idle_connections (util/server_modes.py) don't wait for the next request in here:
+        # handle() returns with self.idle set, the server watches the socket without holding a worker
+        # and calls handle() again once the next request is arriving (or calls connection_closed())
+        self.idle = False
+        if not self.accepted:
+            return
+        try:
+            self.serve_connection()
+        finally:
+            # a stream handed to the push broker is still open, the broker calls close_connection() for it
+            if not self.idle and not is_detached(self.request):
+                self.connection_closed()
+
+    def connection_closed(self) -> None:
+        # the connection is done with, called once whether handle() closed it or the server did
+        if self.accepted:
+            self.accepted = False
+            close_connection(self.client_ip)
+
+    def serve_connection(self) -> None:
+        while self.requests_served < MAX_REQUESTS_PER_CONNECTION:
+            # timings of this request, see util/metrics.py
+            timer : RequestTimer = RequestTimer()
+            set_timer(timer)
+            try:
+                request : Request | None = self.read_request(timer)
+            except ParseError as e:
+                error_response : Response = (Response()
+                                             .set_status(e.status_code, e.status_message)
+                                             .text(e.text))
+                error_response.send(self.request)
+                request_metrics.observe(timer)
+                set_timer(None)
+                return
+
+            if request is None:
+                # client closed the connection or went idle
+                set_timer(None)
+                return
+
+            self.requests_served += 1
+            if admit(request, self.client_ip, self.request):
+                try:
+                    self.router.route_request(request, self)
+                finally:
+                    finish_request()
+                    request_metrics.observe(timer)
+                    log_request(timer, request.method, request.path)
+                    set_timer(None)
+
+                # the socket was handed over to the push broker (GET /api/chats/stream)
+                if is_detached(self.request):
+                    return
+            else:
+                # answered with 429/503 instead of being routed
+                timer.route = "rejected"
+                request_metrics.observe(timer)
+                log_request(timer, request.method, request.path)
+                set_timer(None)
+
+            if not wants_keep_alive(request):
+                return
+
+            if (len(self.parser.buffer) == 0 and self.requests_served < MAX_REQUESTS_PER_CONNECTION
+                    and getattr(self.server, "parks_idle_connections", False)):
+                # nothing pipelined, give the worker back until the client sends its next request
+                self.idle = True
+                return
+
+    def read_request(self, timer : RequestTimer) -> Request | None:
+        # returns the next complete request, None if the connection closed or timed out first
+        # timer gets the time spent parsing (not waiting) and the bytes received
+        try:
+            # nothing buffered: the clock starts when the request's first bytes arrive, not while the
+            # connection sits idle between requests
+            waiting_for_first_bytes : bool = len(self.parser.buffer) == 0
+            started : float = time.perf_counter()
+            request : Request | None = self.parser.next_request()
+            timer.add("parse", time.perf_counter() - started)
+            while request is None:
+                body_view = self.parser.body_buffer()
+                if body_view is not None:
+                    # Content-Length body: receive straight into the preallocated buffer
+                    received : int = self.request.recv_into(body_view)
+                    if received == 0:
+                        return None
+                    started = time.perf_counter()
+                    self.parser.body_received(received)
+                else:
+                    data : bytes = self.request.recv(RECV_SIZE)
+                    received = len(data)
+                    if received == 0:
+                        return None
+                    started = time.perf_counter()
+                    if waiting_for_first_bytes:
+                        timer.started = started
+                        waiting_for_first_bytes = False
+                    self.parser.feed(data)
+                timer.bytes_in += received
+                request = self.parser.next_request()
+                timer.add("parse", time.perf_counter() - started)
+        except (socket.timeout, ConnectionError):
+            return None
+
+        return request
+
+
+def wants_keep_alive(request : Request) -> bool:
+    # HTTP/1.1 connections are persistent unless the client sends "Connection: close"
+    # HTTP/1.0 keep-alive would need a "Connection: keep-alive" response header, so just close those
+    connection_header : str = request.get_header("Connection", "").lower()
+
+    if request.http_version != "HTTP/1.1":
+        return False
+    return "close" not in connection_header
 
 
 def main():
     host = "0.0.0.0"
-    port = 8080
-    socketserver.TCPServer.allow_reuse_address = True
+    port = int(os.environ.get("PORT", "8080"))
+
+    # LOG_LEVEL / REQUEST_LOG_SAMPLE_RATE, see util/metrics.py
+    configure_logging()
 
-    server = socketserver.TCPServer((host, port), MyTCPHandler)
+    # indexes (and DB_EXPLAIN_CHECK), before any worker is started
+    bootstrap_database()
 
+    # SERVER_MODE picks serial / threads / prefork / asyncio, see util/server_modes.py
     print("Listening on port " + str(port))
-    server.serve_forever()
+    serve((host, port), MyTCPHandler)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,369 @@
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from pymongo import ReturnDocument
+
+from util.database import counters_collection
+
+# how long (seconds) the version read from the counters collection is trusted before
+# asking the database again, only matters when several processes/servers share the database
+# (changes made by this process are seen right away)
+CHAT_VERSION_TTL : float = float(os.environ.get("CHAT_VERSION_TTL", "0.5"))
+
+# seqs a process reserves from the counters collection at once and then hands out from memory,
+# instead of a round trip to the one counters document for every write (1 = one round trip per write)
+CHAT_SEQUENCE_BATCH : int = int(os.environ.get("CHAT_SEQUENCE_BATCH", "100"))
+
+# how long (seconds) this process hands seqs out of a reserved range, what's left of it after that is never used
+CHAT_SEQUENCE_RESERVE_TTL : float = float(os.environ.get("CHAT_SEQUENCE_RESERVE_TTL", "0.5"))
+
+# every process with a reserved range (or writes still going) keeps a mark in the counters document:
+#   "marks": {<owner>: {"low": the smallest seq it hasn't finished, "beat": bumped every time it's written}}
+# other processes never report a version >= another process's low, however long its writes take,
+# the mark is only taken out by its owner once it has nothing left to finish
+# (so with several processes/servers each one sees the others' writes up to about CHAT_SEQUENCE_RESERVE_TTL later)
+#
+# an owner's mark is rewritten at least every CHAT_SEQUENCE_OWNER_TIMEOUT / 4 while it's there, one whose
+# beat hasn't changed for CHAT_SEQUENCE_OWNER_TIMEOUT (timed on the reader's own clock) belongs to a process
+# that's gone, and is taken out by whoever notices
+CHAT_SEQUENCE_OWNER_TIMEOUT : float = float(os.environ.get("CHAT_SEQUENCE_OWNER_TIMEOUT", "30"))
+
+
+def next_sequence(name : str) -> int:
+    # atomically hands out the next number of the named sequence (1, 2, 3, ...)
+    counter = counters_collection.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"value": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["value"]
+
+
+def reserve_sequence(name : str, count : int, owner : str, pending : int | None, value : int) -> tuple[int, int]:
+    # atomically reserves the next count numbers of the named sequence, returns (first, last)
+    # and in the same update sets owner's mark to the smallest of first and pending (owner's own unfinished seq,
+    # None if there isn't one), see ChatVersion.current()
+    # value : what the sequence is believed to be at, if it's moved on it's read and tried again
+    while True:
+        low : int = value + 1 if pending is None else min(pending, value + 1)
+        counter = counters_collection.find_one_and_update(
+            {"_id": name, "value": value},
+            {"$set": {"value": value + count, "marks." + owner + ".low": low},
+             "$inc": {"marks." + owner + ".beat": 1}}
+        )
+        if counter is not None:
+            return value + 1, value + count
+        # another process got there first (or the sequence doesn't exist yet)
+        counter = counters_collection.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"value": 0}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        value = counter["value"]
+
+
+def publish_mark(name : str, owner : str, low : int | None) -> None:
+    # owner's mark: low is the smallest seq it hasn't finished, None takes the mark out
+    if low is None:
+        counters_collection.update_one({"_id": name}, {"$unset": {"marks." + owner: ""}})
+    else:
+        counters_collection.update_one({"_id": name}, {"$set": {"marks." + owner + ".low": low},
+                                                       "$inc": {"marks." + owner + ".beat": 1}})
+
+
+class ChatVersion:
+    # every change to a chat message (create, edit, delete, reaction, nickname)
+    # stamps the message with a new "seq" from the chat sequence
+    # the chat version is the highest seq whose write is known to be finished,
+    # clients use it as a cursor (?since=<version>) and as the ETag of /api/chats
+
+    def __init__(self, sequence_name : str = "chat", ttl : float = CHAT_VERSION_TTL,
+                 batch : int = CHAT_SEQUENCE_BATCH, reserve_ttl : float = CHAT_SEQUENCE_RESERVE_TTL,
+                 owner_timeout : float = CHAT_SEQUENCE_OWNER_TIMEOUT) -> None:
+        self.sequence_name : str = sequence_name
+        self.ttl : float = ttl
+        self.batch : int = batch
+        self.reserve_ttl : float = reserve_ttl
+        self.owner_timeout : float = owner_timeout
+        self.lock : threading.Lock = threading.Lock()
+
+        # highest seq handed out, reserved, or seen in the counters collection
+        self.latest : int = 0
+
+        # seqs handed out by this process whose writes haven't finished yet
+        self.in_flight : set[int] = set()
+
+        # time.monotonic() of the last read of the counters collection
+        self.refreshed_at : float = float("-inf")
+
+        # the range this process hands seqs out of: next_seq..range_end until range_deadline (time.monotonic())
+        # (held while reserving a new one or writing the mark, so only one thread makes the round trip
+        # and the mark is never written from an out of date view of the range)
+        self.reserve_lock : threading.Lock = threading.Lock()
+        self.next_seq : int = 1
+        self.range_end : int = 0
+        self.range_deadline : float = float("-inf")
+        # names this process's mark, with the pid (a forked child must not use its parent's range)
+        self.owner : str = uuid.uuid4().hex
+        self.range_owner : str = ""
+
+        # this process's mark as last written (low, time.monotonic()), low None once it's taken out
+        self.published_low : int | None = None
+        self.published_at : float = float("-inf")
+        # keeps the mark up to date as writes finish (started by the first reservation of each process)
+        self.publisher_pid : int = 0
+
+        # lowest mark of the other processes at the last read of the counters collection, None if there are none
+        self.others_low : int | None = None
+        # other owner -> (beat, time.monotonic() it was first seen at), to notice owners that are gone
+        self.beats : dict[str, tuple[int, float]] = {}
+
+        # called with the seq after every write of this process (e.g. to push the change to subscribed clients)
+        self.listeners : list = []
+
+    def add_listener(self, listener) -> None:
+        # listener : (int) -> None
+        self.listeners.append(listener)
+
+    @contextmanager
+    def write(self):
+        # with chat_version.write() as seq:
+        #     message_store.update(message_id, {"$set": {...}}, seq)
+        # readers won't report a version >= seq until the with block is done,
+        # so a client can't move its cursor past a write that isn't in the database yet
+        seq : int = self.take_seq()
+        try:
+            yield seq
+        finally:
+            with self.lock:
+                self.in_flight.discard(seq)
+        # only once the write went through (a failed one may or may not be in the database)
+        for listener in self.listeners:
+            listener(seq)
+
+    def owner_name(self) -> str:
+        return self.owner + ":" + str(os.getpid())
+
+    def take_seq(self) -> int:
+        # the next seq, marked as in flight
+        if self.batch <= 1:
+            seq : int = next_sequence(self.sequence_name)
+            with self.lock:
+                self.latest = max(self.latest, seq)
+                self.in_flight.add(seq)
+            return seq
+
+        with self.reserve_lock:
+            owner : str = self.owner_name()
+            if (self.next_seq > self.range_end or time.monotonic() >= self.range_deadline
+                    or self.range_owner != owner):
+                with self.lock:
+                    pending : int | None = min(self.in_flight) if len(self.in_flight) > 0 else None
+                first, last = reserve_sequence(self.sequence_name, self.batch, owner, pending, self.latest)
+                now : float = time.monotonic()
+                with self.lock:
+                    self.next_seq = first
+                    self.range_end = last
+                    self.range_deadline = now + self.reserve_ttl
+                    self.range_owner = owner
+                    self.latest = max(self.latest, last)
+                    self.published_low = first if pending is None else min(pending, first)
+                    self.published_at = now
+                if self.publisher_pid != os.getpid():
+                    self.publisher_pid = os.getpid()
+                    threading.Thread(target=self.run_publisher, name="chat-version", daemon=True).start()
+            with self.lock:
+                seq = self.next_seq
+                self.next_seq += 1
+                self.in_flight.add(seq)
+            return seq
+
+    def low_water(self, now : float) -> int | None:
+        # (lock held) the smallest seq this process hasn't finished, None if it has nothing left to write
+        pending : list[int] = list(self.in_flight)
+        if self.next_seq <= self.range_end and now < self.range_deadline:
+            pending.append(self.next_seq)
+        return min(pending) if len(pending) > 0 else None
+
+    def publish(self) -> None:
+        # brings this process's mark up to date (a round trip only if it changed, or for the heartbeat)
+        with self.reserve_lock:
+            owner : str = self.owner_name()
+            if self.range_owner != owner:
+                return
+            now : float = time.monotonic()
+            with self.lock:
+                low : int | None = self.low_water(now)
+            if low == self.published_low and (low is None or now - self.published_at < self.owner_timeout / 4):
+                return
+            publish_mark(self.sequence_name, owner, low)
+            self.published_low = low
+            self.published_at = now
+
+    def run_publisher(self) -> None:
+        pid : int = os.getpid()
+        while self.publisher_pid == pid:
+            time.sleep(self.reserve_ttl / 2)
+            try:
+                self.publish()
+            except Exception as e:
+                # the database is unreachable, try again next time (the old mark only holds readers back)
+                print("chat version mark not written:", repr(e))
+
+    def current(self) -> int:
+        # no database round trip, unless the cached value is older than ttl
+        now : float = time.monotonic()
+        if now - self.refreshed_at >= self.ttl:
+            counter = counters_collection.find_one({"_id": self.sequence_name})
+            self.read_marks(counter, now)
+            with self.lock:
+                if counter is not None:
+                    self.latest = max(self.latest, counter["value"])
+                self.refreshed_at = now
+
+        with self.lock:
+            version : int = self.latest
+            # our own unfinished writes and the rest of our range, and every other process's mark
+            low : int | None = self.low_water(now)
+            if low is not None:
+                version = min(version, low - 1)
+            if self.others_low is not None:
+                version = min(version, self.others_low - 1)
+            return version
+
+    def read_marks(self, counter : dict | None, now : float) -> None:
+        # the other processes' marks from the counters document, taking out the ones of processes that are gone
+        owner : str = self.owner_name()
+        lows : list[int] = []
+        beats : dict[str, tuple[int, float]] = {}
+        marks : dict = counter.get("marks", {}) if counter is not None else {}
+        for other, mark in marks.items():
+            if other == owner:
+                continue
+            seen : tuple[int, float] | None = self.beats.get(other)
+            if seen is None or seen[0] != mark["beat"]:
+                seen = (mark["beat"], now)
+            elif now - seen[1] >= self.owner_timeout:
+                # only if the beat is still the one we saw, a live owner would have changed it
+                counters_collection.update_one({"_id": self.sequence_name, "marks." + other + ".beat": mark["beat"]},
+                                               {"$unset": {"marks." + other: ""}})
+                continue
+            beats[other] = seen
+            lows.append(mark["low"])
+        with self.lock:
+            self.beats = beats
+            self.others_low = min(lows) if len(lows) > 0 else None
+
+
+class SyncCursor:
+    # how far an in-memory copy of chat data (util/message_store.py, util/profiles.py)
+    # has caught up with the database
+    # writes made by this process are applied to memory as they happen,
+    # so only seqs handed out to other processes have to be read back
+
+    def __init__(self, version : ChatVersion) -> None:
+        self.version : ChatVersion = version
+        self.lock : threading.Lock = threading.Lock()
+
+        # every change with seq <= synced_seq is in memory
+        self.synced_seq : int = 0
+        # seqs of writes this process finished after synced_seq
+        self.local_seqs : set[int] = set()
+
+        version.add_listener(self.finished)
+
+    def finished(self, seq : int) -> None:
+        with self.lock:
+            if seq > self.synced_seq:
+                self.local_seqs.add(seq)
+
+    def behind(self) -> tuple[int, int] | None:
+        # (synced_seq, version) if the database has changes memory doesn't, None if it's up to date
+        # (no database round trip, unless ChatVersion.current() needs one)
+        version : int = self.version.current()
+        with self.lock:
+            while self.synced_seq + 1 in self.local_seqs:
+                self.synced_seq += 1
+                self.local_seqs.discard(self.synced_seq)
+            if version <= self.synced_seq:
+                return None
+            return self.synced_seq, version
+
+    def caught_up(self, version : int) -> None:
+        # everything up to version was read from the database
+        with self.lock:
+            self.synced_seq = max(self.synced_seq, version)
+            self.local_seqs = {seq for seq in self.local_seqs if seq > self.synced_seq}
+
+
+# shared by every connection
+chat_version : ChatVersion = ChatVersion()
+
+
+def test1():
+    # two processes sharing the counters collection, each with its own range
+    from util.fake_collection import FakeDatabase
+    global counters_collection
+    counters_collection = FakeDatabase()["counters"]
+
+    a = ChatVersion(ttl=0, batch=10, reserve_ttl=0.4)
+    b = ChatVersion(ttl=0, batch=10, reserve_ttl=0.4)
+    with a.write() as seq:
+        assert seq == 1
+        # not finished yet
+        assert a.current() == 0
+    assert a.current() == 1
+    with a.write() as seq:
+        assert seq == 2
+    with b.write() as seq:
+        assert seq == 11
+    # one round trip for both of a's writes, one for b's
+    assert counters_collection.find_one({"_id": "chat"})["value"] == 20
+    # a can still write 3..10 and b 12..20, neither reports a version past what the other may still write
+    a.publish()
+    assert a.current() == 2
+    assert b.current() == 2
+
+    # once the ranges are no longer in use, what's left of them is skipped
+    time.sleep(0.45)
+    a.publish()
+    b.publish()
+    assert counters_collection.find_one({"_id": "chat"}).get("marks", {}) == {}
+    assert a.current() == 20 and b.current() == 20
+    with a.write() as seq:
+        assert seq == 21
+
+    # a write that takes longer than the range is used for holds every reader back until it's done
+    with a.write() as slow_seq:
+        assert slow_seq == 22
+        with b.write() as seq:
+            assert seq == 31
+        time.sleep(0.6)
+        a.publish()
+        b.publish()
+        assert b.current() == 21 and a.current() == 21
+    a.publish()
+    assert b.current() == 40
+
+    # a mark whose owner stopped beating is taken out once owner_timeout has passed on the reader's clock
+    c = ChatVersion(ttl=0, batch=10, owner_timeout=0.2)
+    counters_collection.update_one({"_id": "chat"}, {"$set": {"marks.gone:1": {"low": 5, "beat": 3}}})
+    assert c.current() == 4
+    time.sleep(0.25)
+    assert c.current() == 40
+    assert "gone:1" not in counters_collection.find_one({"_id": "chat"})["marks"]
+
+    # one seq per write, readers see it as soon as it's done
+    d = ChatVersion(ttl=0, batch=1)
+    with d.write() as seq:
+        assert seq == 41
+    assert d.current() == 41
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
@@ -0,0 +1,118 @@
+import gzip
+import os
+import zlib
+
+# brotli is optional (pip install brotli), gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses smaller than this aren't worth compressing
+COMPRESSION_MIN_SIZE : int = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+
+# static files are compressed once, so spend the time on the best ratio
+# dynamic bodies are compressed on every request, so keep it cheap
+STATIC_LEVELS : dict[str, int] = {"br": 11, "gzip": 9}
+DYNAMIC_LEVELS : dict[str, int] = {"br": 4, "gzip": 5}
+
+# jpg/png/gif/webp are already compressed, running them through gzip only costs CPU
+COMPRESSIBLE_TYPES : tuple[str, ...] = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+    "image/x-icon",
+)
+
+
+def supported_encodings() -> list[str]:
+    # in order of preference
+    if brotli is not None:
+        return ["br", "gzip"]
+    return ["gzip"]
+
+
+def is_compressible(mime_type : str) -> bool:
+    return mime_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def negotiate(accept_encoding : str | None) -> str | None:
+    # picks the encoding to use from an Accept-Encoding header, None means send it as is
+    # "gzip, deflate, br" / "br;q=1.0, gzip;q=0.8, *;q=0.1" / "gzip;q=0"
+    if accept_encoding is None:
+        return None
+
+    weights : dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        weight : float = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    best : str | None = None
+    best_weight : float = 0.0
+    for encoding in supported_encodings():
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        # ties go to the earlier (preferred) encoding
+        if weight > best_weight:
+            best = encoding
+            best_weight = weight
+    return best
+
+
+def compress(data : bytes, encoding : str, static : bool = False) -> bytes:
+    levels : dict[str, int] = STATIC_LEVELS if static else DYNAMIC_LEVELS
+    if encoding == "br":
+        return brotli.compress(data, quality=levels["br"])
+    # mtime=0 so the same input always gives the same bytes (and the same ETag)
+    return gzip.compress(data, compresslevel=levels["gzip"], mtime=0)
+
+
+def compress_stream(chunks, encoding : str):
+    # compress() for a body that comes a piece at a time, yields the compressed pieces
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=DYNAMIC_LEVELS["br"])
+        compress_chunk = compressor.process
+    else:
+        # wbits=31: gzip header and trailer, same format as gzip.compress
+        compressor = zlib.compressobj(DYNAMIC_LEVELS["gzip"], zlib.DEFLATED, 31)
+        compress_chunk = compressor.compress
+    for chunk in chunks:
+        compressed : bytes = compress_chunk(chunk)
+        if len(compressed) > 0:
+            yield compressed
+    yield compressor.finish() if encoding == "br" else compressor.flush()
+
+
+def test1():
+    assert negotiate(None) is None
+    assert negotiate("gzip, deflate") == "gzip"
+    assert negotiate("gzip;q=0") is None
+    assert negotiate("identity") is None
+    assert negotiate("*") == supported_encodings()[0]
+    if brotli is not None:
+        assert negotiate("gzip, deflate, br") == "br"
+        assert negotiate("br;q=0.5, gzip;q=0.8") == "gzip"
+    print("test1 passed")
+
+def test2():
+    data = b"hello " * 1000
+    assert gzip.decompress(compress(data, "gzip")) == data
+    assert compress(data, "gzip", static=True) == compress(data, "gzip", static=True)
+    assert is_compressible("text/javascript")
+    assert is_compressible("application/json")
+    assert not is_compressible("image/jpg")
+    assert gzip.decompress(b"".join(compress_stream([b"hello "] * 1000, "gzip"))) == data
+    if brotli is not None:
+        assert brotli.decompress(b"".join(compress_stream([b"hello "] * 1000, "br"))) == data
+    print("test2 passed")
+
+if __name__ == '__main__':
+    test1()
+    test2()
@@ -4,20 +4,141 @@ import os
 
 from pymongo import MongoClient
 
+from util.metrics import TimedCollection
+
 docker_db = os.environ.get('DOCKER_DB', "false")
 
-if docker_db == "true":
-    print("using docker compose db")
-    mongo_client = MongoClient("mongo")
+# DB_BACKEND=memory swaps Mongo for util/fake_collection.py's in-process fake
+# (nothing is saved, for tests and benchmarks without a Mongo server)
+db_backend = os.environ.get('DB_BACKEND', "mongo")
+
+# connection pool of each process (every worker thread and util/db_executor.py share it)
+# a query waits up to MONGO_WAIT_QUEUE_TIMEOUT_MS for a free connection, then fails instead of piling up
+MONGO_MAX_POOL_SIZE : int = int(os.environ.get("MONGO_MAX_POOL_SIZE", "64"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS : int = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000"))
+# how long a query waits for a reachable server (pymongo's default is 30s, long after the client gave up)
+MONGO_SERVER_SELECTION_TIMEOUT_MS : int = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+
+# connect=False: don't open connections/monitor threads until the first query,
+# so the client is safe to create before SERVER_MODE=prefork forks the workers
+
+if db_backend == "memory":
+    from util.fake_collection import FakeDatabase
+    print("using in-memory db")
+    mongo_client = None
+    db = FakeDatabase()
 else:
-    print("using local db")
-    mongo_client = MongoClient("localhost")
+    if docker_db == "true":
+        print("using docker compose db")
+        mongo_host = "mongo"
+    else:
+        print("using local db")
+        mongo_host = "localhost"
+    mongo_client = MongoClient(mongo_host, connect=False,
+                               maxPoolSize=MONGO_MAX_POOL_SIZE,
+                               waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                               serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS)
+
+    # cse312 database
+    db = mongo_client["cse312"]
 
-# cse312 database
-db = mongo_client["cse312"]
+# every call on these counts as database time of the request making it (util/metrics.py)
 
 # chat collection in cse312 database (empty for now)
-chat_collection = db["chat"]
+chat_collection = TimedCollection(db["chat"])
+
+# one document per user who picked a nickname: {"_id": <session id>, "nickname": string, "seq": int}
+profiles_collection = TimedCollection(db["profiles"])
+
+# one document per sequence: {"_id": "chat", "value": <last number handed out>}
+counters_collection = TimedCollection(db["counters"])
+
+# DB_EXPLAIN_CHECK=true: at startup, explain() every hot query and refuse to start if one is a collection scan
+explain_check = os.environ.get('DB_EXPLAIN_CHECK', "false")
+
+# (collection name, index keys, options) created at startup, create_index does nothing if it's already there
+INDEXES : list = [
+    # find_one/update by message id, one document per id
+    ("chat", [("id", 1)], {"unique": True}),
+    # a user's messages
+    ("chat", [("author", 1)], {}),
+    # insertion order: the full history is sorted by created
+    ("chat", [("created", 1)], {}),
+    # ?since= polls, and the message store's catch-up reads
+    ("chat", [("seq", 1)], {}),
+    # the profile store's catch-up reads (profiles are looked up by _id, which always has an index)
+    ("profiles", [("seq", 1)], {}),
+]
+
+# (collection name, filter, sort) of every query that runs per request or per poll
+HOT_QUERIES : list = [
+    ("chat", {"id": ""}, None),
+    ("chat", {"author": ""}, None),
+    ("chat", {"deleted": {"$ne": True}}, [("created", 1)]),
+    ("chat", {"seq": {"$gt": 0}}, [("seq", 1)]),
+    ("chat", {}, [("seq", -1)]),
+    ("profiles", {"seq": {"$gt": 0}}, None),
+    ("counters", {"_id": "chat"}, None),
+]
+
+
+def ensure_indexes(database) -> None:
+    for collection_name, keys, options in INDEXES:
+        database[collection_name].create_index(keys, **options)
+
+
+def find_stages(plan) -> list[str]:
+    # every "stage" in an explain() plan, the stages are nested in inputStage/inputStages/queryPlan/...
+    stages : list[str] = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(find_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_stages(value))
+    return stages
+
+
+def check_query_plans(database) -> None:
+    # raises if the database would answer a hot query by reading the whole collection
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = database[collection_name].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in find_stages(winning_plan):
+            raise RuntimeError("query on " + collection_name + " " + str(query) +
+                               " is a collection scan, missing an index?")
+
+
+def bootstrap_database() -> None:
+    # called once by server.py before it starts serving
+    if db_backend == "memory":
+        return
+    # a client of its own, so mongo_client still has no connections when SERVER_MODE=prefork forks
+    bootstrap_client = MongoClient(mongo_host, serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS)
+    try:
+        try:
+            ensure_indexes(bootstrap_client["cse312"])
+        except Exception as e:
+            # no database yet, requests that need it will fail until it's up
+            print("could not create indexes:", repr(e))
+            return
+        if explain_check == "true":
+            check_query_plans(bootstrap_client["cse312"])
+            print("query plans checked, no collection scans")
+    finally:
+        bootstrap_client.close()
+
 
-#######################
+def test1():
+    plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "keyPattern": {"id": 1}}}
+    assert find_stages(plan) == ["FETCH", "IXSCAN"]
+    plan = {"queryPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}}
+    assert "COLLSCAN" in find_stages(plan)
+    print("test1 passed")
 
+if __name__ == '__main__':
+    test1()
@@ -0,0 +1,68 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from util.metrics import RequestTimer, get_timer, set_timer
+
+# threads that do nothing but wait on the database, per process
+# for a request that needs several queries that don't depend on each other: all but one go here, so they're
+# in flight at the same time instead of one round trip after the other (pymongo is blocking, one query per
+# thread at a time), right now that's sync_stores() in util/for_chat.py (GET /api/chats and the push broker)
+# a request with a single query (every write handler) runs it on its own thread, handing it over here
+# would only add a thread switch to the same round trip
+# keep it under MONGO_MAX_POOL_SIZE (util/database.py) with room for the handler threads themselves
+DB_IO_THREADS : int = int(os.environ.get("DB_IO_THREADS", "16"))
+
+# threads are only started by the first run_db(), so SERVER_MODE=prefork can fork after this is made
+db_executor : ThreadPoolExecutor = ThreadPoolExecutor(max_workers=DB_IO_THREADS, thread_name_prefix="db-io")
+
+
+def run_db(function, *args) -> Future:
+    # starts function(*args) on a database thread, .result() waits for it (and raises what it raised)
+    # function must not call run_db() itself and wait for it (it could wait for a thread that never frees up)
+    # the time it takes still counts as database time of the request that started it
+    timer : RequestTimer | None = get_timer()
+
+    def run():
+        set_timer(timer)
+        try:
+            return function(*args)
+        finally:
+            set_timer(None)
+    return db_executor.submit(run)
+
+
+def test1():
+    import time
+
+    # two 0.2s "queries" overlap
+    started = time.monotonic()
+    first = run_db(time.sleep, 0.2)
+    second = run_db(time.sleep, 0.2)
+    first.result()
+    second.result()
+    assert time.monotonic() - started < 0.35
+
+    # database time added from several threads at once all counts
+    timer = RequestTimer()
+    set_timer(timer)
+    def add_db_time():
+        for _ in range(10000):
+            timer.add("db", 0.001)
+    futures = [run_db(add_db_time) for _ in range(4)]
+    add_db_time()
+    for future in futures:
+        future.result()
+    set_timer(None)
+    assert abs(timer.phases["db"] - 50.0) < 1e-6
+
+    def fails():
+        raise ValueError("no database")
+    try:
+        run_db(fails).result()
+        assert False
+    except ValueError:
+        pass
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
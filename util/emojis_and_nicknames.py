@@ -4,7 +4,30 @@ import uuid
 
 from util.request import Request
 from util.response import Response
-from util.database import chat_collection
+from util.message_store import message_store
+from util.profiles import profile_store
+from util.chat_version import chat_version
+from util.for_chat import send_message_not_found, send_busy, send_write_failed
+from util.write_batcher import WriteQueueFull, WriteFailed
+from util.response_cache import PrebuiltResponse
+
+# responses that are the same every time, built once (see util/response_cache.py)
+ALREADY_REACTED_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                               .set_status(403, "Forbidden")
+                                                               .text("reacting with same emoji as before"))
+NO_REACTION_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                           .set_status(403, "Forbidden")
+                                                           .text("trying to remove a reaction that doesn't exist"))
+USER_NOT_FOUND_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                              .set_status(404, "Not Found")
+                                                              .text("User ID not found"))
+INVALID_EMOJI_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                             .set_status(400, "Bad Request")
+                                                             .text("not a valid emoji"))
+# sent with the session cookie
+EMOJI_ADDED_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response().text("emoji added"))
+EMOJI_REMOVED_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response().text("emoji removed"))
+NICKNAME_CHANGED_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response().text("nickname changed and database updated"))
 
 def add_emoji(request : Request, handler) -> None:
     # action taken with a request.path that ends with an {messageID}
@@ -22,37 +45,41 @@ def add_emoji(request : Request, handler) -> None:
         # this is user's first interaction with chat
         user_id = str(uuid.uuid4())
 
-    # get message ID from the path
-    message_id : str = request.path.rsplit("/", 1)[-1]
-
-    # retrieve message being reacted to from chat collection
-    message_to_react_to = chat_collection.find_one({"id": message_id})
-
-    # maybe chance that message can't be found in the collection?
-
-    curr_reactions : dict[str, list[str]] = message_to_react_to.get('reactions', {})
-    if emoji_to_add not in curr_reactions:
-        curr_reactions[emoji_to_add] = []
+    if not is_valid_emoji(emoji_to_add):
+        send_invalid_emoji(handler)
+        return
 
-    # if user_id already reacted with the same emoji, 403 response
-    if user_id in curr_reactions.get(emoji_to_add):
-        already_reacted_response : Response = (Response()
-                                               .set_status(403, "Forbidden")
-                                               .text("reacting with same emoji as before"))
-        handler.request.sendall(already_reacted_response.to_data())
+    # get message ID from the path
+    message_id : str = request.path_params["id"]
+
+    # one atomic update: add user_id to the emoji's list, only if it isn't already there
+    # (no read first, so two users reacting at the same time can't overwrite each other)
+    try:
+        with chat_version.write() as seq:
+            reacted_message = message_store.update(message_id,
+                                                   {"$addToSet": {"reactions." + emoji_to_add: user_id}},
+                                                   seq,
+                                                   condition={"deleted": {"$ne": True},
+                                                              "reactions." + emoji_to_add: {"$ne": user_id}})
+    except WriteQueueFull:
+        # too many writes waiting for the database (CHAT_WRITE_BATCHING), nothing was written
+        send_busy(handler)
+        return
+    except WriteFailed:
+        # the group commit it was part of failed (CHAT_WRITE_BATCHING)
+        send_write_failed(handler)
         return
 
-    # otherwise, add reaction to "reactions" field of the message in the database
-    curr_reactions.get(emoji_to_add).append(user_id)
-    chat_collection.update_one({"id": message_id}, {"$set": {
-        "reactions": curr_reactions
-    }})
+    if reacted_message is None:
+        # nothing matched: either there's no such message, or user_id already reacted with the same emoji
+        if message_store.get(message_id) is None:
+            send_message_not_found(handler)
+            return
+        ALREADY_REACTED_RESPONSE.send(handler.request)
+        return
 
     # send response
-    res = (Response()
-           .text("emoji added")
-           .cookies({"session": user_id, "Max-Age": "3600"}))
-    handler.request.sendall(res.to_data())
+    EMOJI_ADDED_RESPONSE.send(handler.request, {"session": user_id, "Max-Age": "3600"})
     return
 
 def remove_emoji(request : Request, handler) -> None:
@@ -70,58 +97,61 @@ def remove_emoji(request : Request, handler) -> None:
     if user_id == "":
         # every reaction should have an associated user_id, so this should not be possible
         # 404 response
-        user_not_found_response : Response = (Response()
-                                                    .set_status(404, "Not Found")
-                                                    .text("User ID not found"))
-        handler.request.sendall(user_not_found_response.to_data())
+        USER_NOT_FOUND_RESPONSE.send(handler.request)
         return
 
-    # get message ID from the path
-    message_id: str = request.path.rsplit("/", 1)[-1]
-
-    # retrieve message from chat collection
-    message_to_remove_from = chat_collection.find_one({"id": message_id})
-
-    # maybe chance that message can't be found in the collection?
-
-    curr_reactions: dict[str, list[str]] = message_to_remove_from.get('reactions', {})
-    if emoji_to_remove not in curr_reactions:
-        # 403 response
-        no_reaction_to_remove_response: Response = (Response()
-                                                    .set_status(403, "Forbidden")
-                                                    .text("trying to remove a reaction that doesn't exist"))
-        handler.request.sendall(no_reaction_to_remove_response.to_data())
+    if not is_valid_emoji(emoji_to_remove):
+        send_invalid_emoji(handler)
         return
 
-    # if user_id already reacted with the same emoji, 403 response
-    if user_id not in curr_reactions.get(emoji_to_remove, []):
-        no_reaction_to_remove_response: Response = (Response()
-                                              .set_status(403, "Forbidden")
-                                              .text("trying to remove a reaction that doesn't exist"))
-        handler.request.sendall(no_reaction_to_remove_response.to_data())
+    # get message ID from the path
+    message_id: str = request.path_params["id"]
+
+    # one atomic update: take user_id out of the emoji's list, only if it's in there
+    # (an emoji nobody uses anymore is left as an empty list, message_to_json skips those)
+    try:
+        with chat_version.write() as seq:
+            unreacted_message = message_store.update(message_id,
+                                                     {"$pull": {"reactions." + emoji_to_remove: user_id}},
+                                                     seq,
+                                                     condition={"deleted": {"$ne": True},
+                                                                "reactions." + emoji_to_remove: user_id})
+    except WriteQueueFull:
+        # too many writes waiting for the database (CHAT_WRITE_BATCHING), nothing was written
+        send_busy(handler)
+        return
+    except WriteFailed:
+        # the group commit it was part of failed (CHAT_WRITE_BATCHING)
+        send_write_failed(handler)
         return
 
-    # otherwise, remove reaction from "reactions" field of the message in the database
-    curr_reactions.get(emoji_to_remove).remove(user_id)
+    if unreacted_message is None:
+        # nothing matched: either there's no such message, or user_id never reacted with this emoji
+        if message_store.get(message_id) is None:
+            send_message_not_found(handler)
+            return
+        NO_REACTION_RESPONSE.send(handler.request)
+        return
 
-    # *** removing a user_id might remove the emoji entirely as a key
-    if len(curr_reactions.get(emoji_to_remove, [])) == 0:
-        del curr_reactions[emoji_to_remove]
+    # send response
+    EMOJI_REMOVED_RESPONSE.send(handler.request, {"session": user_id, "Max-Age": "3600"})
+    return
 
-    chat_collection.update_one({"id": message_id}, {"$set": {
-        "reactions": curr_reactions
-    }})
+def is_valid_emoji(emoji) -> bool:
+    # the emoji becomes part of a field path ("reactions.<emoji>"), so it can't have a "." or start with "$"
+    return (isinstance(emoji, str) and
+            0 < len(emoji) <= 32 and
+            "." not in emoji and
+            not emoji.startswith("$"))
 
-    # send response
-    res = (Response()
-           .text("emoji removed")
-           .cookies({"session": user_id, "Max-Age": "3600"}))
-    handler.request.sendall(res.to_data())
+def send_invalid_emoji(handler) -> None:
+    INVALID_EMOJI_RESPONSE.send(handler.request)
     return
 
 def change_nickname(request : Request, handler) -> None:
     # request content is JSON in form: {"nickname": "[new nickname]"}
-    # new  nicknames will add a "nickname" field for the user and all their messages
+    # the nickname goes in the user's profile (util/profiles.py) and is joined onto their messages when
+    # they're sent out, so this is one write however many messages the user has
 
     # get new nickname from request body
     d : dict[str, str] = json.loads(request.body)
@@ -133,17 +163,12 @@ def change_nickname(request : Request, handler) -> None:
         # this is user's first interaction with chat
         user_id = str(uuid.uuid4())
 
-    # make changes to the chat collection
-    # does this work if "nickname" isn't an existing field?
-    chat_collection.update_many({"author": user_id}, {"$set": {
-        "nickname": new_nickname
-    }})
+    # the rename gets a seq of its own, so pollers get the new name in "nicknames" (see get_changes)
+    with chat_version.write() as seq:
+        profile_store.set_nickname(user_id, new_nickname, seq)
 
     # send response
-    res = (Response()
-           .text("nickname changed and database updated")
-           .cookies({"session": user_id, "Max-Age": "3600"}))
-    handler.request.sendall(res.to_data())
+    NICKNAME_CHANGED_RESPONSE.send(handler.request, {"session": user_id, "Max-Age": "3600"})
     return
 
 
@@ -0,0 +1,395 @@
+import copy
+import itertools
+import threading
+
+# in-process stand-in for the parts of pymongo's Collection API this server uses
+# picked with DB_BACKEND=memory (see util/database.py), for tests and benchmarks without a Mongo server
+# supports: equality / $ne / $gt / $gte / $lt / $lte / $in / $nin / $not / $exists / $size filters on (dotted) fields,
+# $set / $unset / $inc / $max / $min / $addToSet / $pull / $push ($each, $slice) updates, upserts, sort, limit, projections,
+# and bulk_write of plain (operation, filter, document, upsert) tuples (see util/write_batcher.py)
+
+
+class InsertOneResult:
+    def __init__(self, inserted_id) -> None:
+        self.inserted_id = inserted_id
+        self.acknowledged : bool = True
+
+
+class InsertManyResult:
+    def __init__(self, inserted_ids : list) -> None:
+        self.inserted_ids : list = inserted_ids
+        self.acknowledged : bool = True
+
+
+class UpdateResult:
+    def __init__(self, matched_count : int, modified_count : int, upserted_id = None) -> None:
+        self.matched_count : int = matched_count
+        self.modified_count : int = modified_count
+        self.upserted_id = upserted_id
+        self.acknowledged : bool = True
+
+
+class BulkWriteResult:
+    def __init__(self, inserted_count : int, matched_count : int, modified_count : int,
+                 upserted_ids : dict[int, object]) -> None:
+        self.inserted_count : int = inserted_count
+        self.matched_count : int = matched_count
+        self.modified_count : int = modified_count
+        self.upserted_ids : dict[int, object] = upserted_ids
+        self.acknowledged : bool = True
+
+
+class DeleteResult:
+    def __init__(self, deleted_count : int) -> None:
+        self.deleted_count : int = deleted_count
+        self.acknowledged : bool = True
+
+
+MISSING = object()
+
+
+def get_field(document : dict, dotted_key : str):
+    value = document
+    for part in dotted_key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def set_field(document : dict, dotted_key : str, value) -> None:
+    parts : list[str] = dotted_key.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def unset_field(document : dict, dotted_key : str) -> None:
+    parts : list[str] = dotted_key.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+def values_equal(field_value, expected) -> bool:
+    # like Mongo, {"tags": "a"} matches a document whose tags array contains "a"
+    if field_value is MISSING:
+        return expected is None
+    if isinstance(field_value, list) and not isinstance(expected, list):
+        return expected in field_value
+    return field_value == expected
+
+
+def compare(field_value, operator : str, expected) -> bool:
+    if field_value is MISSING or field_value is None:
+        return False
+    try:
+        if operator == "$gt":
+            return field_value > expected
+        if operator == "$gte":
+            return field_value >= expected
+        if operator == "$lt":
+            return field_value < expected
+        return field_value <= expected
+    except TypeError:
+        return False
+
+
+def is_operator_dict(condition) -> bool:
+    return isinstance(condition, dict) and len(condition) > 0 and next(iter(condition)).startswith("$")
+
+
+def condition_matches(field_value, condition) -> bool:
+    if not is_operator_dict(condition):
+        return values_equal(field_value, condition)
+    for operator, expected in condition.items():
+        if operator == "$ne":
+            if values_equal(field_value, expected):
+                return False
+        elif operator in ("$gt", "$gte", "$lt", "$lte"):
+            if not compare(field_value, operator, expected):
+                return False
+        elif operator == "$in":
+            if not any(values_equal(field_value, option) for option in expected):
+                return False
+        elif operator == "$nin":
+            if any(values_equal(field_value, option) for option in expected):
+                return False
+        elif operator == "$not":
+            if condition_matches(field_value, expected):
+                return False
+        elif operator == "$exists":
+            if (field_value is not MISSING) != bool(expected):
+                return False
+        elif operator == "$size":
+            if not isinstance(field_value, list) or len(field_value) != expected:
+                return False
+        else:
+            raise NotImplementedError("query operator " + operator)
+    return True
+
+
+def matches(document : dict, query : dict) -> bool:
+    return all(condition_matches(get_field(document, key), condition) for key, condition in query.items())
+
+
+def apply_update(document : dict, update : dict) -> bool:
+    # returns True if the document changed
+    before : dict = copy.deepcopy(document)
+    for operator, fields in update.items():
+        for key, value in fields.items():
+            current = get_field(document, key)
+            if operator == "$set":
+                set_field(document, key, copy.deepcopy(value))
+            elif operator == "$unset":
+                unset_field(document, key)
+            elif operator == "$inc":
+                set_field(document, key, (0 if current is MISSING else current) + value)
+            elif operator == "$max":
+                if current is MISSING or value > current:
+                    set_field(document, key, value)
+            elif operator == "$min":
+                if current is MISSING or value < current:
+                    set_field(document, key, value)
+            elif operator == "$addToSet":
+                if current is MISSING:
+                    set_field(document, key, [value])
+                elif value not in current:
+                    current.append(value)
+            elif operator == "$push":
+                # {"$each": [...], "$slice": n} pushes several and keeps the first n (last -n)
+                if isinstance(value, dict) and "$each" in value:
+                    items : list = (([] if current is MISSING else current) +
+                                    [copy.deepcopy(item) for item in value["$each"]])
+                    if "$slice" in value:
+                        limit : int = value["$slice"]
+                        items = items[limit:] if limit < 0 else items[:limit]
+                    set_field(document, key, items)
+                elif current is MISSING:
+                    set_field(document, key, [value])
+                else:
+                    current.append(value)
+            elif operator == "$pull":
+                if isinstance(current, list):
+                    current[:] = [item for item in current if item != value]
+            else:
+                raise NotImplementedError("update operator " + operator)
+    return document != before
+
+
+def project(document : dict, projection : dict | None) -> dict:
+    if projection is None:
+        return copy.deepcopy(document)
+    included : list[str] = [key for key, flag in projection.items() if flag and key != "_id"]
+    if len(included) > 0:
+        result : dict = {}
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+        for key in included:
+            value = get_field(document, key)
+            if value is not MISSING:
+                set_field(result, key, copy.deepcopy(value))
+        return result
+    result = copy.deepcopy(document)
+    for key, flag in projection.items():
+        if not flag:
+            unset_field(result, key)
+    return result
+
+
+def sort_key(value):
+    # missing/None sort first, like Mongo
+    if value is MISSING or value is None:
+        return (0, 0)
+    return (1, value)
+
+
+class FakeCursor:
+    def __init__(self, documents : list[dict], projection : dict | None) -> None:
+        self.documents : list[dict] = documents
+        self.projection : dict | None = projection
+        self.limit_count : int = 0
+
+    def sort(self, key_or_list, direction : int = 1) -> "FakeCursor":
+        keys : list = [(key_or_list, direction)] if isinstance(key_or_list, str) else list(key_or_list)
+        # stable sorts, last key first
+        for key, key_direction in reversed(keys):
+            self.documents.sort(key=lambda document: sort_key(get_field(document, key)),
+                                reverse=key_direction < 0)
+        return self
+
+    def limit(self, count : int) -> "FakeCursor":
+        self.limit_count = count
+        return self
+
+    def __iter__(self):
+        documents : list[dict] = self.documents
+        if self.limit_count > 0:
+            documents = documents[:self.limit_count]
+        for document in documents:
+            yield project(document, self.projection)
+
+
+class FakeCollection:
+
+    # bulk_write takes util/write_batcher.py's plain tuples, not pymongo's InsertOne / UpdateOne
+    plain_bulk_write : bool = True
+
+    def __init__(self, name : str = "collection") -> None:
+        self.name : str = name
+        self.documents : list[dict] = []
+        self.lock : threading.RLock = threading.RLock()
+        self.ids = itertools.count(1)
+
+    def create_index(self, keys, **kwargs) -> str:
+        # no indexes, every query is a scan
+        if isinstance(keys, str):
+            return keys + "_1"
+        return "_".join(key + "_" + str(direction) for key, direction in keys)
+
+    def insert_one(self, document : dict) -> InsertOneResult:
+        with self.lock:
+            if "_id" not in document:
+                document["_id"] = next(self.ids)
+            self.documents.append(copy.deepcopy(document))
+            return InsertOneResult(document["_id"])
+
+    def insert_many(self, documents : list[dict], ordered : bool = True) -> InsertManyResult:
+        return InsertManyResult([self.insert_one(document).inserted_id for document in documents])
+
+    def find(self, query : dict | None = None, projection : dict | None = None) -> FakeCursor:
+        with self.lock:
+            found : list[dict] = [document for document in self.documents if matches(document, query or {})]
+            return FakeCursor(found, projection)
+
+    def find_one(self, query : dict | None = None, projection : dict | None = None) -> dict | None:
+        for document in self.find(query, projection).limit(1):
+            return document
+        return None
+
+    def count_documents(self, query : dict) -> int:
+        with self.lock:
+            return sum(1 for document in self.documents if matches(document, query))
+
+    def update(self, query : dict, update : dict, upsert : bool, many : bool) -> UpdateResult:
+        with self.lock:
+            matched : int = 0
+            modified : int = 0
+            for document in self.documents:
+                if matches(document, query):
+                    matched += 1
+                    if apply_update(document, update):
+                        modified += 1
+                    if not many:
+                        break
+            if matched == 0 and upsert:
+                new_document : dict = {key: value for key, value in query.items()
+                                       if not isinstance(value, dict)}
+                apply_update(new_document, update)
+                return UpdateResult(0, 0, self.insert_one(new_document).inserted_id)
+            return UpdateResult(matched, modified)
+
+    def update_one(self, query : dict, update : dict, upsert : bool = False) -> UpdateResult:
+        return self.update(query, update, upsert, many=False)
+
+    def update_many(self, query : dict, update : dict, upsert : bool = False) -> UpdateResult:
+        return self.update(query, update, upsert, many=True)
+
+    def find_one_and_update(self, query : dict, update : dict, projection : dict | None = None,
+                            upsert : bool = False, return_document : bool = False) -> dict | None:
+        # return_document: False (ReturnDocument.BEFORE) or True (ReturnDocument.AFTER)
+        with self.lock:
+            before : dict | None = self.find_one(query)
+            result : UpdateResult = self.update(query, update, upsert, many=False)
+            if return_document:
+                if result.upserted_id is not None:
+                    return self.find_one({"_id": result.upserted_id}, projection)
+                if before is None:
+                    return None
+                return self.find_one({"_id": before["_id"]}, projection)
+            return None if before is None else project(before, projection)
+
+    def bulk_write(self, requests : list, ordered : bool = True) -> BulkWriteResult:
+        # requests are plain (operation, filter, document, upsert) tuples, operation "insert" or "update"
+        # (what util/write_batcher.py sends, pymongo gets InsertOne / UpdateOne made from the same tuples)
+        # (the fake never fails a write, so ordered doesn't matter)
+        with self.lock:
+            inserted : int = 0
+            matched : int = 0
+            modified : int = 0
+            upserted_ids : dict[int, object] = {}
+            for index, (operation, query, document, upsert) in enumerate(requests):
+                if operation == "insert":
+                    self.insert_one(document)
+                    inserted += 1
+                elif operation == "update":
+                    result : UpdateResult = self.update(query, document, upsert, many=False)
+                    matched += result.matched_count
+                    modified += result.modified_count
+                    if result.upserted_id is not None:
+                        upserted_ids[index] = result.upserted_id
+                else:
+                    raise NotImplementedError("bulk_write of " + str(operation))
+            return BulkWriteResult(inserted, matched, modified, upserted_ids)
+
+    def delete_one(self, query : dict) -> DeleteResult:
+        with self.lock:
+            for index, document in enumerate(self.documents):
+                if matches(document, query):
+                    del self.documents[index]
+                    return DeleteResult(1)
+            return DeleteResult(0)
+
+    def delete_many(self, query : dict) -> DeleteResult:
+        with self.lock:
+            kept : list[dict] = [document for document in self.documents if not matches(document, query)]
+            deleted : int = len(self.documents) - len(kept)
+            self.documents = kept
+            return DeleteResult(deleted)
+
+
+class FakeDatabase:
+    # db["name"] gives the same FakeCollection every time, like pymongo's Database
+    def __init__(self) -> None:
+        self.collections : dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name : str) -> FakeCollection:
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name)
+        return self.collections[name]
+
+
+def test1():
+    collection = FakeCollection()
+    collection.insert_one({"id": "a", "author": "x", "seq": 1, "reactions": {}})
+    collection.insert_one({"id": "b", "author": "y", "seq": 2, "reactions": {"👍": ["x"]}})
+    assert [m["id"] for m in collection.find({"seq": {"$gt": 1}})] == ["b"]
+    assert collection.find_one({"reactions.👍": "x"})["id"] == "b"
+    assert collection.find_one({"id": "a"}, {"_id": 0, "id": 1}) == {"id": "a"}
+
+    result = collection.update_one({"id": "a", "reactions.👍": {"$ne": "x"}}, {"$addToSet": {"reactions.👍": "x"}})
+    assert result.matched_count == 1
+    result = collection.update_one({"id": "a", "reactions.👍": {"$ne": "x"}}, {"$addToSet": {"reactions.👍": "x"}})
+    assert result.matched_count == 0
+
+    assert [m["id"] for m in collection.find().sort("seq", -1).limit(1)] == ["b"]
+
+    assert collection.update_one({"id": "a", "seq": {"$not": {"$gte": 1}}}, {"$set": {"seq": 5}}).matched_count == 0
+    collection.update_one({"id": "a"}, {"$max": {"seq": 3}})
+    collection.update_one({"id": "a"}, {"$max": {"seq": 2}})
+    assert collection.find_one({"id": "a"})["seq"] == 3
+
+    counter = collection.find_one_and_update({"_id": "chat"}, {"$inc": {"value": 1}}, upsert=True, return_document=True)
+    assert counter["value"] == 1
+
+    result = collection.bulk_write([("insert", None, {"id": "c", "seq": 4}, False),
+                                    ("update", {"id": "a"}, {"$set": {"seq": 6}}, False),
+                                    ("update", {"id": "zzz"}, {"$set": {"seq": 7}}, False)], ordered=False)
+    assert result.inserted_count == 1 and result.matched_count == 1
+    assert collection.find_one({"id": "c"})["seq"] == 4 and collection.find_one({"id": "a"})["seq"] == 6
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
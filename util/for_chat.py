@@ -1,22 +1,67 @@
 import html
 import json
+import os
 import uuid
 
 from util.request import Request
 from util.response import Response
-from util.database import chat_collection
+from util.response_cache import PrebuiltResponse
+from util.message_store import message_store
+from util.profiles import profile_store
+from util.chat_version import chat_version
+from util.static_cache import etag_matches
+from util.push import PushBroker
+from util.db_executor import run_db
+from util.write_batcher import WriteQueueFull, WriteFailed
+
+# messages per GET /api/chats response, unless the client asks for a different ?limit=
+CHAT_PAGE_SIZE : int = int(os.environ.get("CHAT_PAGE_SIZE", "100"))
+# the most ?limit= can be, bounds the size of any one response
+CHAT_MAX_PAGE_SIZE : int = int(os.environ.get("CHAT_MAX_PAGE_SIZE", "500"))
+
+# responses that are the same every time, built once (see util/response_cache.py)
+NO_SESSION_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                          .set_status(403, "Forbidden")
+                                                          .text("No session cookie found"))
+NOT_OWNER_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                         .set_status(403, "Forbidden")
+                                                         .text("Session cookie ID does not match owner"))
+MESSAGE_NOT_FOUND_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                                 .set_status(404, "Not Found")
+                                                                 .text("Message not found"))
+# the write queue is full (util/write_batcher.py), try again in a second
+BUSY_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                    .set_status(503, "Service Unavailable")
+                                                    .headers({"Retry-After": "1"})
+                                                    .text("Too many writes, try again"))
+WRITE_FAILED_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                            .set_status(500, "Internal Server Error")
+                                                            .text("The write failed, try again"))
+# sent with the session cookie
+MESSAGE_SENT_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response().text("message sent"))
+MESSAGE_UPDATED_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response().text("message updated"))
+MESSAGE_DELETED_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response().text("message deleted"))
 
 class Message:
+    # one per message posted
+    __slots__ = ("author", "identify", "content", "updated", "created", "seq", "reactions")
+
     def __init__(self,
                  author : str,
                  ident : str,
                  content : str,
-                 updated : bool = False) -> None:
+                 updated : bool = False,
+                 seq : int = 0) -> None:
         self.author : str = author      # maps to session id for now
         self.identify : str = ident     # maps to message id
         self.content : str = content    # maps to message content
         self.updated : bool = updated   # True if it was updated, False otherwise
 
+        # position in the chat sequence (see util/chat_version.py)
+        # "created" never changes, "seq" moves forward on every change to the message
+        self.created : int = seq
+        self.seq : int = seq
+
         # dict that maps emoji "char strings" to list of user id's who used that emoji
         # can't be initialized
         self.reactions : dict[str, list[str]] = {}       # added field from AO #1
@@ -28,7 +73,9 @@ class Message:
             "id" : self.identify,
             "content" : self.content,
             "updated" : self.updated,
-            "reactions" : self.reactions
+            "reactions" : self.reactions,
+            "created" : self.created,
+            "seq" : self.seq
         }
         return ret
 
@@ -55,68 +102,231 @@ def create_chat_message(request : Request, handler) -> None:
     # create id for message (uuid)
     message_id : str = str(uuid.uuid4())
 
-    # store message id and author into database
-    new_message : Message = Message(
-        user_id,            # user_id (str of uuid.uuid4()) is associated with the author
-        message_id,
-        message_content
-    )
-
-    potential_message_document : dict = new_message.get_message_document()
-
-    # AO 2: this user_id might have an associated nickname to it
-    # if one record from database with this user_id (author) has a nickname, add nickname field
-
-    sample_previous_message_from_user = chat_collection.find_one({"author": user_id})
-    if (sample_previous_message_from_user and     # just need some way to tell if find_one found something or not
-            "nickname" in sample_previous_message_from_user):
-        potential_message_document.update({"nickname": sample_previous_message_from_user["nickname"]})
-
-    chat_collection.insert_one(potential_message_document)
+    # AO 2: the user's nickname isn't copied into the message, it's joined on when messages are sent out
+    # (util/profiles.py), so changing it doesn't have to touch every message
+
+    try:
+        with chat_version.write() as seq:
+            # store message id and author into database
+            new_message : Message = Message(
+                user_id,            # user_id (str of uuid.uuid4()) is associated with the author
+                message_id,
+                message_content,
+                seq=seq
+            )
+
+            potential_message_document : dict = new_message.get_message_document()
+
+            message_store.insert(potential_message_document, seq)
+    except WriteQueueFull:
+        # too many writes waiting for the database (CHAT_WRITE_BATCHING), nothing was written
+        send_busy(handler)
+        return
+    except WriteFailed:
+        # the group commit it was part of failed (CHAT_WRITE_BATCHING)
+        send_write_failed(handler)
+        return
 
     # send response
-    response : Response = Response()
-    response.text("message sent")
-    response.cookies({"session": user_id, "Max-Age": "3600"})
-    handler.request.sendall(response.to_data())
+    MESSAGE_SENT_RESPONSE.send(handler.request, {"session": user_id, "Max-Age": "3600"})
     return
 
 def retrieve_all_messages(request : Request, handler) -> None:
     # from a GET request
-    # Response body is JSON : {"messages": [{"author": string, "id": string, "content": string, "updated": boolean}, ...]}
+    # Response body is JSON : {"messages": [{"author": string, "id": string, "content": string, "updated": boolean}, ...],
+    #                          "cursor": int}
     # "updated" represents if the message has even been updated
 
-    # response body should be a json dict with only one key-value pair,
-    # value being a list of dict's (one dict per message)
+    # response body should be a json dict, "messages" being a list of dict's (one dict per message)
 
     # AO 1: each message has another field for "reactions" : dict[str, list[str]]
     # example: (emoji : list of user id's)
     # "reactions": {"👻": ["63fc690d-ea3a-4349-ba51-0c645af40453"],
     # "🫠": ["eda92e0a-eb7a-430b-a938-916d2102b480", "63fc690d-ea3a-4349-ba51-0c645af40453"]}
 
-    # every message in the collection is just a dict with keys and values
-    list_of_messages = []
-    for message in chat_collection.find():
-        # AO 1 changes
-        # message in the database can now have a reaction field for emojis
-
-        message_from_document : dict = {
-            "author": message["author"],
-            "id": message["id"],
-            "content": message["content"],
-            "updated": message["updated"],
-            "reactions" : message["reactions"]
-        }
-
-        # AO 2: message may or may not have a nickname field (string)
-        if "nickname" in message:
-            message_from_document.update({"nickname": message["nickname"]})
+    # history comes in pages (newest first): {"messages": [...], "cursor": int, "has_more": boolean}
+    #   GET /api/chats                          -> the newest ?limit= messages (CHAT_PAGE_SIZE by default)
+    #   GET /api/chats?before=<created>         -> the page before that, has_more means there's older history
+    #   GET /api/chats?after=<created>          -> the page after that, oldest first
+    # each message has a "created" number to page with
+
+    # polling: GET /api/chats?since=<cursor from the last response> only returns the messages that were
+    # created, edited, reacted to, or deleted after that cursor
+    # deleted messages come back as tombstones: {"id": string, "deleted": true}
+    # and "nicknames": {author: nickname} has everybody who changed their nickname after that cursor
+    # at most ?limit= changes at a time, has_more means ask again right away with the new cursor
+    try:
+        since : int | None = get_int_query(request, "since")
+        before : int | None = get_int_query(request, "before")
+        after : int | None = get_int_query(request, "after")
+        limit : int | None = get_int_query(request, "limit")
+    except ValueError as e:
+        bad_request_response : Response = (Response()
+                                           .set_status(400, "Bad Request")
+                                           .text(str(e)))
+        bad_request_response.send(handler.request)
+        return
 
-        list_of_messages.append(message_from_document)
+    # however big the history gets, one response holds at most CHAT_MAX_PAGE_SIZE messages
+    if limit is None:
+        limit = CHAT_PAGE_SIZE
+    limit = max(1, min(limit, CHAT_MAX_PAGE_SIZE))
+
+    # nothing changed since the client's last poll => 304, without touching the database
+    version : int = chat_version.current()
+    if etag_matches(request.get_header("If-None-Match"), chat_etag(version)):
+        not_modified_response : Response = (Response()
+                                            .set_status(304, "Not Modified")
+                                            .headers({"ETag": chat_etag(version), "Cache-Control": "no-cache"}))
+        not_modified_response.send(handler.request)
+        return
 
+    if since is None:
+        # one page of the messages that aren't deleted, oldest first
+        body : dict = get_page(limit, before, after)
+        body["cursor"] = version
+    else:
+        # the changes after the cursor, in the order they happened, plus the nicknames that changed
+        body = get_changes(since, version, limit)
+
+    # the client sends "cursor" back as ?since= next time
+    # (changes that finished while we were reading can show up twice, never zero times)
+    # the messages are turned into JSON one at a time while the response is being sent (chunked),
+    # instead of one json.dumps of the whole page plus a copy of it for the headers
     response : Response = Response()
-    response.json({"messages": list_of_messages})
-    handler.request.sendall(response.to_data())
+    response.json_stream(body, request)
+    # the ETag says how far this response goes, which is less than version if has_more
+    response.headers({"ETag": chat_etag(body["cursor"]), "Cache-Control": "no-cache"})
+    response.compress(request)      # gzip/br as it goes (a page under COMPRESSION_MIN_SIZE is sent whole)
+    response.send(handler.request)
+    return
+
+def get_int_query(request : Request, name : str) -> int | None:
+    # ?name=<integer>, None if it isn't there, ValueError if it isn't an integer
+    text : str | None = request.get_query(name)
+    if text is None:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError(name + " has to be an integer")
+
+def chat_etag(cursor : int) -> str:
+    return '"chat-' + str(cursor) + '"'
+
+def sync_stores() -> None:
+    # brings message_store and profile_store up to date with the database
+    # when both have to read from it, the two reads are in flight at the same time
+    if not profile_store.loaded or profile_store.cursor.behind() is not None:
+        profiles_synced = run_db(profile_store.sync)
+        message_store.sync()
+        profiles_synced.result()
+    else:
+        message_store.sync()
+
+def get_page(limit : int, before : int | None = None, after : int | None = None) -> dict:
+    # {"messages": up to limit messages that aren't deleted (see MessageStore.page), oldest first,
+    #  "has_more": True if there are more past the end of the page (older ones, or newer ones with after)}
+    sync_stores()
+    nicknames : dict[str, str] = profile_store.get_nicknames()
+    # one extra to find out if there are more
+    messages : list[dict] = message_store.page(limit + 1, before, after)
+    has_more : bool = len(messages) > limit
+    if has_more:
+        messages = messages[:limit] if after is not None else messages[1:]
+    return {
+        # converted when it's sent
+        "messages": (message_to_json(message, nicknames) for message in messages),
+        "has_more": has_more
+    }
+
+def get_changes(since : int, version : int, limit : int = CHAT_PAGE_SIZE) -> dict:
+    # {"messages": the first limit messages created/edited/reacted to/deleted after since, in the order it happened,
+    #  "nicknames": {author: nickname} of everybody who changed their nickname after since,
+    #  "cursor": how far this goes (version, unless there was more than limit),
+    #  "has_more": True if there are more changes after cursor}
+    sync_stores()
+    nicknames : dict[str, str] = profile_store.get_nicknames()
+    messages : list[dict] = message_store.changes_since(since, limit + 1)
+    cursor : int = version
+    has_more : bool = False
+    if len(messages) > limit:
+        messages = messages[:limit]
+        # never past version, a write before it might still be in flight
+        cursor = min(messages[-1].get("seq", 0), version)
+        has_more = cursor > since
+    return {
+        # converted when it's sent
+        "messages": (message_to_json(message, nicknames) for message in messages),
+        "nicknames": profile_store.renamed_since(since),
+        "cursor": cursor,
+        "has_more": has_more
+    }
+
+def message_to_json(message : dict, nicknames : dict[str, str]) -> dict:
+    # the fields of a message document that the API sends
+    if message.get("deleted", False):
+        return {"id": message["id"], "deleted": True}
+
+    # AO 1 changes
+    # message in the database can now have a reaction field for emojis
+
+    message_from_document : dict = {
+        "author": message["author"],
+        "id": message["id"],
+        "content": message["content"],
+        "updated": message["updated"],
+        "created": message.get("created", 0),
+        # reactions are added/removed one user at a time ($addToSet/$pull), so an emoji
+        # everybody took back is still there as an empty list
+        "reactions" : {emoji: users for emoji, users in message.get("reactions", {}).items() if len(users) > 0}
+    }
+
+    # AO 2: author may or may not have a nickname (string)
+    # (messages from before util/profiles.py can still have their own copy)
+    nickname : str | None = nicknames.get(message["author"], message.get("nickname"))
+    if nickname is not None:
+        message_from_document.update({"nickname": nickname})
+
+    return message_from_document
+
+# pushes chat changes to every client subscribed with GET /api/chats/stream
+# every chat write (chat_version.write()) wakes it up
+push_broker : PushBroker = PushBroker(get_changes)
+chat_version.add_listener(push_broker.publish)
+
+def stream_chat_messages(request : Request, handler) -> None:
+    # Server-Sent Events instead of polling: GET /api/chats/stream?since=<cursor>
+    # sends "messages" events (same JSON as /api/chats?since=) whenever something changes
+    # when the browser reconnects it sends the id of the last event it got as Last-Event-ID
+    since_text : str | None = request.get_header("Last-Event-ID") or request.get_query("since")
+    try:
+        since : int = int(since_text) if since_text is not None else chat_version.current()
+    except ValueError:
+        bad_request_response : Response = (Response()
+                                           .set_status(400, "Bad Request")
+                                           .text("since has to be an integer"))
+        bad_request_response.send(handler.request)
+        return
+
+    if push_broker.is_full():
+        # too many streams in this process, EventSource gives up on a 503 and the page falls back to polling
+        unavailable_response : Response = (Response()
+                                           .set_status(503, "Service Unavailable")
+                                           .text("Too many open streams, poll /api/chats instead"))
+        unavailable_response.send(handler.request)
+        return
+
+    # the head goes out now, the events follow for as long as the connection stays open
+    response : Response = (Response()
+                           .headers({"Content-Type": "text/event-stream",
+                                     "Cache-Control": "no-cache"})
+                           .open_ended())
+    response.send(handler.request)
+
+    # the broker owns the socket from here on (MyTCPHandler stops reading from it)
+    # (and releases the connection's rate limit count when it closes it, see util/rate_limit.py)
+    push_broker.subscribe(handler.request, since, handler.client_ip)
     return
 
 def update_chat_message(request : Request, handler) -> None:
@@ -129,24 +339,22 @@ def update_chat_message(request : Request, handler) -> None:
     user_id: str = request.cookies.get("session", "")
     if user_id == "":
         # user can't have permission to change
-        no_permission_response = (Response()
-                                  .set_status(403, "Forbidden")
-                                  .text("No session cookie found"))
-        handler.request.sendall(no_permission_response.to_data())
+        NO_SESSION_RESPONSE.send(handler.request)
         return
 
     # retrieve {id} in path
-    message_id : str = request.path.rsplit("/", 1)[-1]
+    message_id : str = request.path_params["id"]
 
     # find the message in the collection, and verify session id is the same
-    chat_message_to_change = chat_collection.find_one({"id": message_id})
+    chat_message_to_change = message_store.get(message_id)
+
+    if chat_message_to_change is None:
+        send_message_not_found(handler)
+        return
 
     if chat_message_to_change["author"] != user_id:
         # no permission to change because session id's don't match
-        no_permission_response = (Response()
-                                  .set_status(403, "Forbidden")
-                                  .text("Session cookie ID does not match owner"))
-        handler.request.sendall(no_permission_response.to_data())
+        NOT_OWNER_RESPONSE.send(handler.request)
         return
 
     # decode request body, and change contents of chat message
@@ -154,61 +362,91 @@ def update_chat_message(request : Request, handler) -> None:
     message_content : str = html.escape(d["content"]) # make sure new content isn't HTML
 
     # update the chat message
-    chat_collection.update_one({"id": message_id}, {"$set":
-                                                        {"content": message_content,
-                                                         "updated": True}
-                                                    })
+    try:
+        with chat_version.write() as seq:
+            message_store.update(message_id, {"$set":
+                                                  {"content": message_content,
+                                                   "updated": True}
+                                              }, seq)
+    except WriteQueueFull:
+        # too many writes waiting for the database (CHAT_WRITE_BATCHING), nothing was written
+        send_busy(handler)
+        return
+    except WriteFailed:
+        # the group commit it was part of failed (CHAT_WRITE_BATCHING)
+        send_write_failed(handler)
+        return
 
     # respond
-    response : Response = (Response()
-        .text("message updated")
-        .cookies({
-            "session": user_id,
-            "Max-Age": "3600"
-        }))
-    handler.request.sendall(response.to_data())
+    MESSAGE_UPDATED_RESPONSE.send(handler.request, {
+        "session": user_id,
+        "Max-Age": "3600"
+    })
     return
 
 
 def delete_chat_message(request : Request, handler) -> None:
     # action taken with a request.path that ends with an {id}
     # responds with 403 Forbidden when user lacks permission because not own message
-    # hard delete
+    # soft delete: the message becomes a tombstone (see below), it's never removed from the collection
 
     # copy update, but delete chat message instead
     # retrieve user's identifying cookie
     user_id: str = request.cookies.get("session", "")
     if user_id == "":
         # user can't have permission to delete
-        no_permission_response = (Response()
-                                  .set_status(403, "Forbidden")
-                                  .text("No session cookie found"))
-        handler.request.sendall(no_permission_response.to_data())
+        NO_SESSION_RESPONSE.send(handler.request)
         return
 
     # retrieve {id} in path
-    message_id: str = request.path.rsplit("/", 1)[-1]
+    message_id: str = request.path_params["id"]
 
     # find the message in the collection, and verify session id is the same
-    chat_message_to_delete = chat_collection.find_one({"id": message_id})
+    chat_message_to_delete = message_store.get(message_id)
+
+    if chat_message_to_delete is None:
+        send_message_not_found(handler)
+        return
 
     if chat_message_to_delete["author"] != user_id:
         # no permission to delete because session id's don't match
-        no_permission_response = (Response()
-                                  .set_status(403, "Forbidden")
-                                  .text("Session cookie ID does not match owner"))
-        handler.request.sendall(no_permission_response.to_data())
+        NOT_OWNER_RESPONSE.send(handler.request)
         return
 
     # delete the message
-    chat_collection.delete_one({"id": message_id})
+    # the document stays as a tombstone (no content) so clients polling with ?since= find out it's gone
+    try:
+        with chat_version.write() as seq:
+            message_store.update(message_id, {"$set":
+                                                  {"deleted": True,
+                                                   "content": "",
+                                                   "reactions": {}}
+                                              }, seq)
+    except WriteQueueFull:
+        # too many writes waiting for the database (CHAT_WRITE_BATCHING), nothing was written
+        send_busy(handler)
+        return
+    except WriteFailed:
+        # the group commit it was part of failed (CHAT_WRITE_BATCHING)
+        send_write_failed(handler)
+        return
 
     # respond
-    response = (Response()
-        .text("message deleted")
-        .cookies({
-            "session": user_id,
-            "Max-Age": "3600"
-        }))
-    handler.request.sendall(response.to_data())
-    return
\ No newline at end of file
+    MESSAGE_DELETED_RESPONSE.send(handler.request, {
+        "session": user_id,
+        "Max-Age": "3600"
+    })
+    return
+
+def send_busy(handler) -> None:
+    BUSY_RESPONSE.send(handler.request)
+    return
+
+def send_write_failed(handler) -> None:
+    WRITE_FAILED_RESPONSE.send(handler.request)
+    return
+
+def send_message_not_found(handler) -> None:
+    # message id in the path doesn't exist (or was deleted)
+    MESSAGE_NOT_FOUND_RESPONSE.send(handler.request)
+    return
@@ -1,9 +1,11 @@
 # from server import MyTCPHandler
 from util.request import Request
 from util.response import Response
+from util.response_cache import PrebuiltResponse
+
+# always the same bytes, built once
+HELLO_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response().text("hello"))
 
 # This path is provided as an example of how to use the router
 def hello_path(request : Request, handler):
-    res = Response()
-    res.text("hello")
-    handler.request.sendall(res.to_data())
+    HELLO_RESPONSE.send(handler.request)
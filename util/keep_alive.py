@@ -0,0 +1,168 @@
+import os
+import selectors
+import socket
+import threading
+import time
+
+# how long an idle keep-alive connection is held open between requests
+KEEP_ALIVE_TIMEOUT : float = float(os.environ.get("KEEP_ALIVE_TIMEOUT", "5"))
+
+# idle keep-alive connections parked per process, past this they're closed instead
+# (an idle connection costs a file descriptor, not a worker thread)
+MAX_IDLE_CONNECTIONS : int = int(os.environ.get("MAX_IDLE_CONNECTIONS", "4096"))
+
+# how often (seconds) parked connections are checked for KEEP_ALIVE_TIMEOUT
+IDLE_SWEEP_INTERVAL : float = 0.5
+
+
+class IdleConnections:
+    # keep-alive connections that are between requests, watched by one selector thread instead of each one
+    # holding a worker thread in recv() until its next request (see ThreadPoolTCPServer in util/server_modes.py)
+    #
+    # park(handler) hands over a handler whose connection is idle (handler.request is the socket)
+    # as soon as the socket is readable (next request, or the client closed it) resume(handler) is called,
+    # after KEEP_ALIVE_TIMEOUT without anything expire(handler) is
+    # both are called from the selector thread, they must not block
+
+    def __init__(self, resume, expire, timeout : float = KEEP_ALIVE_TIMEOUT,
+                 max_idle : int = MAX_IDLE_CONNECTIONS) -> None:
+        self.resume = resume
+        self.expire = expire
+        self.timeout : float = timeout
+        self.max_idle : int = max_idle
+
+        self.lock : threading.Lock = threading.Lock()
+        # parked handlers, and ones park() added that the selector thread hasn't registered yet
+        self.count : int = 0
+        self.incoming : list = []
+
+        # handler -> when it's closed, oldest first (every handler gets the same timeout)
+        self.deadlines : dict = {}
+
+        # made by the first park() (not at import, SERVER_MODE=prefork forks after that)
+        self.selector : selectors.BaseSelector | None = None
+        self.waker : socket.socket | None = None
+        self.wakeup_reader : socket.socket | None = None
+        self.thread : threading.Thread | None = None
+
+    def park(self, handler) -> bool:
+        # False if MAX_IDLE_CONNECTIONS are already parked, the caller closes the connection then
+        with self.lock:
+            if self.count >= self.max_idle:
+                return False
+            self.count += 1
+            self.incoming.append(handler)
+            if self.thread is None:
+                self.start()
+        try:
+            # wake the selector thread up so it registers the socket
+            self.waker.send(b"\0")
+        except BlockingIOError:
+            # already has wakeups waiting
+            pass
+        return True
+
+    def start(self) -> None:
+        # (caller holds the lock)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_reader, self.waker = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self.run, name="keep-alive", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        next_sweep : float = time.monotonic() + IDLE_SWEEP_INTERVAL
+        while True:
+            for key, _ in self.selector.select(max(0.0, next_sweep - time.monotonic())):
+                if key.fileobj is self.wakeup_reader:
+                    self.drain_wakeups()
+                    continue
+                handler = key.data
+                self.remove(handler)
+                self.resume(handler)
+
+            now : float = time.monotonic()
+            self.register_incoming(now)
+            if now >= next_sweep:
+                self.sweep(now)
+                next_sweep = now + IDLE_SWEEP_INTERVAL
+
+    def drain_wakeups(self) -> None:
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def register_incoming(self, now : float) -> None:
+        with self.lock:
+            incoming : list = self.incoming
+            self.incoming = []
+        for handler in incoming:
+            try:
+                self.selector.register(handler.request, selectors.EVENT_READ, handler)
+            except (ValueError, OSError):
+                # the socket is closed already
+                with self.lock:
+                    self.count -= 1
+                self.expire(handler)
+                continue
+            self.deadlines[handler] = now + self.timeout
+
+    def sweep(self, now : float) -> None:
+        # deadlines is in parking order, so the expired ones are at the front
+        expired : list = []
+        for handler, deadline in self.deadlines.items():
+            if deadline > now:
+                break
+            expired.append(handler)
+        for handler in expired:
+            self.remove(handler)
+            self.expire(handler)
+
+    def remove(self, handler) -> None:
+        # (selector thread only)
+        self.selector.unregister(handler.request)
+        del self.deadlines[handler]
+        with self.lock:
+            self.count -= 1
+
+
+def test1():
+    class FakeHandler:
+        def __init__(self, sock):
+            self.request = sock
+
+    resumed = []
+    expired = []
+    idle = IdleConnections(resumed.append, expired.append, timeout=0.3, max_idle=2)
+
+    server_side_a, client_a = socket.socketpair()
+    server_side_b, client_b = socket.socketpair()
+    a = FakeHandler(server_side_a)
+    b = FakeHandler(server_side_b)
+    assert idle.park(a) and idle.park(b)
+    # full
+    assert not idle.park(FakeHandler(socket.socket()))
+
+    # a's client sends its next request => a comes back, b times out
+    time.sleep(0.1)
+    client_a.sendall(b"GET / HTTP/1.1\r\n\r\n")
+    time.sleep(0.1)
+    assert resumed == [a] and expired == []
+    time.sleep(0.9)
+    assert expired == [b] and idle.count == 0
+
+    # room again
+    assert idle.park(a)
+    client_a.close()
+    time.sleep(0.1)
+    assert resumed == [a, a]
+    for sock in (server_side_a, server_side_b, client_b):
+        sock.close()
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
@@ -0,0 +1,356 @@
+import bisect
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pymongo import ReturnDocument
+
+from util.database import chat_collection
+from util.chat_version import ChatVersion, SyncCursor, chat_version
+from util.write_batcher import CHAT_WRITE_BATCHING, WriteBatcher
+
+# most message documents kept in memory per process, the least recently changed ones are evicted first
+# (old history is still in the database, it is just read from there again)
+MESSAGE_STORE_SIZE : int = int(os.environ.get("MESSAGE_STORE_SIZE", "10000"))
+
+# the fields the API sends, plus what the store itself needs (created/seq for ordering, deleted for tombstones)
+# _id stays in the database, nothing here uses it
+MESSAGE_PROJECTION : dict[str, int] = {
+    "_id": 0, "id": 1, "author": 1, "content": 1, "updated": 1, "reactions": 1,
+    "nickname": 1, "deleted": 1, "created": 1, "seq": 1
+}
+
+# writes to the same message from different threads take the same lock (one of this many)
+WRITE_LOCK_STRIPES : int = 64
+
+
+class MessageStore:
+    # write-through cache of the chat collection
+    # reads (a message by id, a message by author, all messages, changes since a cursor) are served from memory,
+    # writes go to the database first and the document the database ends up with is kept in memory
+    #
+    # every change stamps the message with a seq (util/chat_version.py), so the store knows how far it is
+    # caught up (SyncCursor) and only asks the database for changes made by other processes
+    #
+    # the documents handed out are shared, callers must not change them
+
+    def __init__(self, collection, max_messages : int = MESSAGE_STORE_SIZE,
+                 version : ChatVersion = chat_version, batcher : WriteBatcher | None = None) -> None:
+        self.collection = collection
+        self.max_messages : int = max_messages
+        self.version : ChatVersion = version
+
+        # writes go through it (batched with other threads' writes) if there is one
+        self.batcher : WriteBatcher | None = batcher
+
+        # message id -> document, least recently changed (lowest seq) first
+        self.messages : OrderedDict[str, dict] = OrderedDict()
+        # author -> ids of their messages in memory
+        self.by_author : dict[str, set[str]] = {}
+        # (created, message id) of every message in memory, sorted, so page() can bisect instead of
+        # going through every message (created never changes, new messages almost always go at the end)
+        self.by_created : list[tuple[int, str]] = []
+        self.lock : threading.Lock = threading.Lock()
+
+        self.write_locks : list[threading.Lock] = [threading.Lock() for _ in range(WRITE_LOCK_STRIPES)]
+
+        self.loaded : bool = False
+        # True while every message in the database is also in memory
+        self.complete : bool = True
+        # highest seq of any document dropped from memory, changes older than this need the database
+        self.evicted_seq : int = 0
+        # changes up to cursor.synced_seq are in memory (unless they were evicted)
+        self.cursor : SyncCursor = SyncCursor(version)
+
+    def load(self) -> None:
+        # first use in this process: the most recently changed messages
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            # anything written after this is picked up by the next sync()
+            version : int = self.version.current()
+            documents : list[dict] = list(self.collection.find({}, MESSAGE_PROJECTION)
+                                          .sort("seq", -1)
+                                          .limit(self.max_messages + 1))
+            if len(documents) > self.max_messages:
+                self.complete = False
+                self.evicted_seq = documents.pop().get("seq", 0)
+            for document in reversed(documents):
+                self.put(document)
+            self.cursor.caught_up(version)
+            self.loaded = True
+
+    def sync(self) -> None:
+        # catch up with writes made by other processes (no database round trip if there weren't any)
+        self.load()
+        behind : tuple[int, int] | None = self.cursor.behind()
+        if behind is None:
+            return
+        since, version = behind
+
+        documents : list[dict] = list(self.collection.find({"seq": {"$gt": since}}, MESSAGE_PROJECTION).sort("seq"))
+        with self.lock:
+            for document in documents:
+                existing : dict | None = self.messages.get(document["id"])
+                # a write of this process may have finished while we were reading
+                if existing is None or document.get("seq", 0) > existing.get("seq", 0):
+                    self.put(document)
+        self.cursor.caught_up(version)
+
+    def put(self, document : dict) -> None:
+        # (lock held) keep document in memory, in seq order, and evict if over the limit
+        message_id : str = document["id"]
+        if message_id not in self.messages:
+            bisect.insort(self.by_created, (created_of(document), message_id))
+        self.messages[message_id] = document
+        self.messages.move_to_end(message_id)
+        self.by_author.setdefault(document["author"], set()).add(message_id)
+
+        # writes can finish out of seq order, move anything newer back behind this one
+        seq : int = document.get("seq", 0)
+        newer : list[str] = []
+        for other_id in reversed(self.messages):
+            if other_id == message_id:
+                continue
+            if self.messages[other_id].get("seq", 0) <= seq:
+                break
+            newer.append(other_id)
+        for other_id in reversed(newer):
+            self.messages.move_to_end(other_id)
+
+        while len(self.messages) > self.max_messages:
+            evicted_id, evicted = self.messages.popitem(last=False)
+            del self.by_created[bisect.bisect_left(self.by_created, (created_of(evicted), evicted_id))]
+            author_ids : set[str] = self.by_author.get(evicted["author"], set())
+            author_ids.discard(evicted_id)
+            if len(author_ids) == 0:
+                self.by_author.pop(evicted["author"], None)
+            self.evicted_seq = max(self.evicted_seq, evicted.get("seq", 0))
+            self.complete = False
+
+    @contextmanager
+    def locked(self, message_ids):
+        # serializes writes to the same messages, so memory sees them in the order the database did
+        # (stripes are always taken in the same order, so two writers can't deadlock)
+        stripes : list[int] = sorted({hash(message_id) % WRITE_LOCK_STRIPES for message_id in message_ids})
+        for stripe in stripes:
+            self.write_locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.write_locks[stripe].release()
+
+    # reads
+
+    def get(self, message_id : str) -> dict | None:
+        # the message, None if it doesn't exist or was deleted
+        self.sync()
+        message : dict | None = self.messages.get(message_id)
+        if message is None and not self.complete:
+            message = self.collection.find_one({"id": message_id}, MESSAGE_PROJECTION)
+        if message is None or message.get("deleted", False):
+            return None
+        return message
+
+    def find_by_author(self, author : str) -> dict | None:
+        # any one message (deleted or not) by author
+        self.sync()
+        with self.lock:
+            for message_id in self.by_author.get(author, ()):
+                return self.messages[message_id]
+        if not self.complete:
+            return self.collection.find_one({"author": author}, MESSAGE_PROJECTION)
+        return None
+
+    def page(self, limit : int, before : int | None = None, after : int | None = None) -> list[dict]:
+        # up to limit messages that aren't deleted with after < created < before, oldest first
+        # the newest ones in that range, or with after the ones right after it
+        self.sync()
+        if not self.complete:
+            query : dict = {"deleted": {"$ne": True}}
+            created_range : dict = {}
+            if before is not None:
+                created_range["$lt"] = before
+            if after is not None:
+                created_range["$gt"] = after
+            if len(created_range) > 0:
+                query["created"] = created_range
+            cursor = self.collection.find(query, MESSAGE_PROJECTION).sort("created", 1 if after is not None else -1)
+            messages : list[dict] = list(cursor.limit(limit))
+        else:
+            with self.lock:
+                # by_created[start:end] is after < created < before
+                start : int = 0 if after is None else bisect.bisect_left(self.by_created, (after + 1,))
+                end : int = len(self.by_created) if before is None else bisect.bisect_left(self.by_created, (before,))
+                # oldest first from start with after, newest first from end otherwise, until the page is full
+                indexes : range = range(start, end) if after is not None else range(end - 1, start - 1, -1)
+                messages = []
+                for index in indexes:
+                    message : dict = self.messages[self.by_created[index][1]]
+                    if not message.get("deleted", False):
+                        messages.append(message)
+                        if len(messages) >= limit:
+                            break
+        if after is None:
+            messages.reverse()
+        return messages
+
+    def changes_since(self, since : int, limit : int) -> list[dict]:
+        # the first limit messages (deleted ones too) changed after since, in the order it happened
+        self.sync()
+        if since < self.evicted_seq:
+            return list(self.collection.find({"seq": {"$gt": since}}, MESSAGE_PROJECTION).sort("seq").limit(limit))
+        changes : list[dict] = []
+        with self.lock:
+            # newest first until we get to since
+            for message in reversed(self.messages.values()):
+                if message.get("seq", 0) <= since:
+                    break
+                changes.append(message)
+        changes.reverse()
+        return changes[:limit]
+
+    # writes (seq comes from chat_version.write(), the cursor hears about it when the with block ends)
+
+    def insert(self, document : dict, seq : int) -> None:
+        if self.batcher is not None:
+            self.batcher.insert(document, seq)
+        else:
+            self.collection.insert_one(document)
+        # insert_one added the _id
+        document.pop("_id", None)
+        with self.lock:
+            self.put(document)
+
+    def update(self, message_id : str, update : dict, seq : int, condition : dict | None = None) -> dict | None:
+        # applies a Mongo update ({"$set": {...}}) to one message and stamps it with seq
+        # condition is added to the filter, the update is skipped if it doesn't match
+        # returns the updated message, None if nothing matched
+        query : dict = {"id": message_id}
+        if condition is not None:
+            query.update(condition)
+        # $max: an older write finishing late can't move the message's seq backwards
+        update = dict(update)
+        update["$max"] = {"seq": seq}
+
+        with self.locked([message_id]):
+            if self.batcher is not None:
+                message : dict | None = self.batcher.update(query, update, message_id, seq)
+            else:
+                message = self.collection.find_one_and_update(query, update,
+                                                              projection=MESSAGE_PROJECTION,
+                                                              return_document=ReturnDocument.AFTER)
+            if message is not None:
+                with self.lock:
+                    self.put(message)
+        return message
+
+
+def created_of(message : dict) -> int:
+    return message.get("created", 0)
+
+
+# shared by every connection
+message_store : MessageStore = MessageStore(chat_collection,
+                                            batcher=WriteBatcher(chat_collection, MESSAGE_PROJECTION)
+                                            if CHAT_WRITE_BATCHING == "true" else None)
+
+
+def test1():
+    from util.fake_collection import FakeDatabase
+
+    import util.chat_version
+
+    db = FakeDatabase()
+    util.chat_version.counters_collection = db["counters"]
+    version = ChatVersion(ttl=0)
+
+    store = MessageStore(db["chat"], max_messages=3, version=version)
+    for number in range(3):
+        with version.write() as seq:
+            store.insert({"id": str(number), "author": "a" if number < 2 else "b", "content": str(number),
+                          "updated": False, "reactions": {}, "created": seq, "seq": seq}, seq)
+    assert [m["id"] for m in store.page(10)] == ["0", "1", "2"]
+    assert [m["id"] for m in store.page(2)] == ["1", "2"]
+    assert [m["id"] for m in store.page(2, before=3)] == ["0", "1"]
+    assert [m["id"] for m in store.page(1, after=1)] == ["1"]
+    assert store.find_by_author("b")["id"] == "2"
+
+    with version.write() as seq:
+        store.update("0", {"$set": {"content": "edited", "updated": True}}, seq)
+    assert store.get("0")["content"] == "edited"
+    assert [m["id"] for m in store.changes_since(3, 10)] == ["0"]
+    # no database read needed to catch up with our own writes
+    assert store.cursor.synced_seq == 4
+
+    with version.write() as seq:
+        store.update("1", {"$set": {"deleted": True}}, seq)
+    assert store.get("1") is None
+    assert [m["id"] for m in store.page(10)] == ["0", "2"]
+
+    # a 4th message pushes the least recently changed one (2) out of memory
+    with version.write() as seq:
+        store.insert({"id": "3", "author": "b", "content": "3", "updated": False, "reactions": {},
+                      "created": seq, "seq": seq}, seq)
+    assert "2" not in store.messages and not store.complete
+    assert store.by_created == [(1, "0"), (2, "1"), (6, "3")]
+    assert store.get("2")["content"] == "2"
+    assert [m["id"] for m in store.page(10)] == ["0", "2", "3"]
+    assert [m["id"] for m in store.page(2)] == ["2", "3"]
+    assert [m["id"] for m in store.page(1, before=3)] == ["0"]
+    assert [m["id"] for m in store.changes_since(0, 10)] == ["2", "0", "1", "3"]
+    assert [m["id"] for m in store.changes_since(0, 2)] == ["2", "0"]
+
+    print("test1 passed")
+
+def test2():
+    # another process writing to the same database
+    from util.fake_collection import FakeDatabase
+    import util.chat_version
+
+    db = FakeDatabase()
+    util.chat_version.counters_collection = db["counters"]
+    # one seq per write: with reserved ranges, another process's writes only show up once
+    # the ranges stop being used (see util/chat_version.py's test1)
+    version = ChatVersion(ttl=0, batch=1)
+    store = MessageStore(db["chat"], version=version)
+    assert store.page(10) == []
+
+    other_version = ChatVersion(ttl=0, batch=1)
+    with other_version.write() as seq:
+        db["chat"].insert_one({"id": "x", "author": "o", "content": "hi", "updated": False, "reactions": {},
+                               "created": seq, "seq": seq})
+    assert [m["id"] for m in store.page(10)] == ["x"]
+    assert store.cursor.synced_seq == 1
+    print("test2 passed")
+
+def test3():
+    # same as test1's writes, through a WriteBatcher
+    from util.fake_collection import FakeDatabase
+    import util.chat_version
+
+    db = FakeDatabase()
+    util.chat_version.counters_collection = db["counters"]
+    version = ChatVersion(ttl=0)
+    store = MessageStore(db["chat"], version=version, batcher=WriteBatcher(db["chat"], MESSAGE_PROJECTION))
+    with version.write() as seq:
+        store.insert({"id": "a", "author": "x", "content": "hi", "updated": False, "reactions": {},
+                      "created": seq, "seq": seq}, seq)
+    with version.write() as seq:
+        assert store.update("a", {"$addToSet": {"reactions.y": "x"}}, seq,
+                            condition={"reactions.y": {"$ne": "x"}})["reactions"] == {"y": ["x"]}
+    with version.write() as seq:
+        assert store.update("a", {"$addToSet": {"reactions.y": "x"}}, seq,
+                            condition={"reactions.y": {"$ne": "x"}}) is None
+    assert store.get("a")["seq"] == 2 and "_id" not in store.get("a")
+    assert db["chat"].find_one({"id": "a"})["reactions"] == {"y": ["x"]}
+    print("test3 passed")
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
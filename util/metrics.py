@@ -0,0 +1,289 @@
+import bisect
+import logging
+import os
+import random
+import threading
+import time
+
+# per-request timing, aggregated into histograms per route and served as Prometheus text at GET /metrics
+# (numbers are per process, with SERVER_MODE=prefork every worker process has its own)
+#
+# a RequestTimer follows one request through MyTCPHandler:
+#   parse     : time in the request parser (not time waiting for the client's bytes)
+#   route     : Router.match()
+#   handler   : the route's action, which includes
+#   db        : time in database calls (TimedCollection), overlapping calls (util/db_executor.py) all count
+#   serialize : building response bytes (Response.json/head, compression, the chunks of a stream)
+# plus bytes received/sent and the status code of the response
+
+# upper bounds (seconds) of the histogram buckets, +Inf is added
+LATENCY_BUCKETS : tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PHASES : tuple[str, ...] = ("parse", "route", "handler", "db", "serialize")
+
+# one request in REQUEST_LOG_SAMPLE_RATE is logged at INFO (all of them at DEBUG)
+REQUEST_LOG_SAMPLE_RATE : float = float(os.environ.get("REQUEST_LOG_SAMPLE_RATE", "0.01"))
+LOG_LEVEL : str = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+logger : logging.Logger = logging.getLogger("server")
+
+
+class Histogram:
+    def __init__(self, buckets : tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets : tuple[float, ...] = buckets
+        # counts[i] = observations <= buckets[i] but > buckets[i - 1], the last one is +Inf
+        self.counts : list[int] = [0] * (len(buckets) + 1)
+        self.sum : float = 0.0
+        self.count : int = 0
+
+    def observe(self, value : float) -> None:
+        # (caller holds the registry's lock)
+        # first bucket whose bound is >= value
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        # ("le" label, count) like Prometheus wants them
+        total : int = 0
+        result : list[tuple[str, int]] = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((format(bound, "g"), total))
+        result.append(("+Inf", total + self.counts[-1]))
+        return result
+
+
+class RequestTimer:
+    # one per request
+    __slots__ = ("started", "route", "phases", "bytes_in", "bytes_out", "status", "lock")
+
+    def __init__(self) -> None:
+        self.started : float = time.perf_counter()
+        # "GET /api/chats/{id}", the route's path rather than the request's (bounded number of labels)
+        self.route : str = "unmatched"
+        self.phases : dict[str, float] = {phase: 0.0 for phase in PHASES}
+        self.bytes_in : int = 0
+        self.bytes_out : int = 0
+        self.status : int = 0
+        # database threads (util/db_executor.py) add to phases while the handler's thread does
+        self.lock : threading.Lock = threading.Lock()
+
+    def add(self, phase : str, seconds : float) -> None:
+        with self.lock:
+            self.phases[phase] += seconds
+
+    def sent(self, status : int, byte_count : int) -> None:
+        # a response (or part of one) was sent
+        if self.status == 0:
+            self.status = status
+        self.bytes_out += byte_count
+
+
+class RouteStats:
+    # everything RequestMetrics keeps for one route
+    def __init__(self) -> None:
+        self.duration : Histogram = Histogram()
+        self.phases : dict[str, Histogram] = {phase: Histogram() for phase in PHASES}
+        # status code -> requests
+        self.statuses : dict[int, int] = {}
+        self.bytes_in : int = 0
+        self.bytes_out : int = 0
+
+
+class RequestMetrics:
+    # every finished request's RequestTimer, added up per route
+
+    def __init__(self) -> None:
+        self.lock : threading.Lock = threading.Lock()
+        self.routes : dict[str, RouteStats] = {}
+
+    def observe(self, timer : RequestTimer) -> None:
+        duration : float = time.perf_counter() - timer.started
+        with self.lock:
+            stats : RouteStats | None = self.routes.get(timer.route)
+            if stats is None:
+                stats = RouteStats()
+                self.routes[timer.route] = stats
+            stats.duration.observe(duration)
+            for phase, seconds in timer.phases.items():
+                stats.phases[phase].observe(seconds)
+            stats.statuses[timer.status] = stats.statuses.get(timer.status, 0) + 1
+            stats.bytes_in += timer.bytes_in
+            stats.bytes_out += timer.bytes_out
+
+    def to_prometheus(self) -> str:
+        # text exposition format 0.0.4
+        lines : list[str] = []
+        with self.lock:
+            routes : list[tuple[str, RouteStats]] = [('route="' + escape(route) + '"', stats)
+                                                     for route, stats in sorted(self.routes.items())]
+
+            lines.append("# HELP http_request_duration_seconds Time from the first byte parsed to the response sent")
+            lines.append("# TYPE http_request_duration_seconds histogram")
+            for labels, stats in routes:
+                write_histogram(lines, "http_request_duration_seconds", labels, stats.duration)
+
+            lines.append("# HELP http_request_phase_seconds Time per request spent in each phase")
+            lines.append("# TYPE http_request_phase_seconds histogram")
+            for labels, stats in routes:
+                for phase, histogram in stats.phases.items():
+                    write_histogram(lines, "http_request_phase_seconds", labels + ',phase="' + phase + '"', histogram)
+
+            lines.append("# HELP http_requests_total Requests served")
+            lines.append("# TYPE http_requests_total counter")
+            for labels, stats in routes:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append("http_requests_total{" + labels + ',status="' + str(status) + '"} ' + str(count))
+
+            lines.append("# HELP http_request_bytes_total Bytes received for requests")
+            lines.append("# TYPE http_request_bytes_total counter")
+            for labels, stats in routes:
+                lines.append("http_request_bytes_total{" + labels + "} " + str(stats.bytes_in))
+
+            lines.append("# HELP http_response_bytes_total Bytes sent for responses")
+            lines.append("# TYPE http_response_bytes_total counter")
+            for labels, stats in routes:
+                lines.append("http_response_bytes_total{" + labels + "} " + str(stats.bytes_out))
+        return "\n".join(lines) + "\n"
+
+
+def write_histogram(lines : list[str], name : str, labels : str, histogram : Histogram) -> None:
+    for bound, count in histogram.cumulative():
+        lines.append(name + "_bucket{" + labels + ',le="' + bound + '"} ' + str(count))
+    lines.append(name + "_sum{" + labels + "} " + repr(histogram.sum))
+    lines.append(name + "_count{" + labels + "} " + str(histogram.count))
+
+
+def escape(label_value : str) -> str:
+    return label_value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# the request the current thread is working on
+current = threading.local()
+
+
+def get_timer() -> RequestTimer | None:
+    return getattr(current, "timer", None)
+
+
+def set_timer(timer : RequestTimer | None) -> None:
+    current.timer = timer
+
+
+def add_time(phase : str, started : float) -> None:
+    # adds the time since started (time.perf_counter()) to the current request, if there is one
+    timer : RequestTimer | None = get_timer()
+    if timer is not None:
+        timer.add(phase, time.perf_counter() - started)
+
+
+def record_sent(status : int, byte_count : int) -> None:
+    timer : RequestTimer | None = get_timer()
+    if timer is not None:
+        timer.sent(status, byte_count)
+
+
+class TimedCursor:
+    # a find() cursor whose fetches count as database time (the query runs when it's iterated)
+    def __init__(self, cursor) -> None:
+        self.cursor = cursor
+        self.iterator = None
+
+    def sort(self, *args, **kwargs) -> "TimedCursor":
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, count : int) -> "TimedCursor":
+        self.cursor = self.cursor.limit(count)
+        return self
+
+    def __iter__(self) -> "TimedCursor":
+        started : float = time.perf_counter()
+        self.iterator = iter(self.cursor)
+        add_time("db", started)
+        return self
+
+    def __next__(self):
+        started : float = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            add_time("db", started)
+
+
+class TimedCollection:
+    # wraps a pymongo Collection (or util/fake_collection.py's), every call counts as database time
+    def __init__(self, collection) -> None:
+        self.collection = collection
+
+    def __getattr__(self, name : str):
+        attribute = getattr(self.collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            started : float = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            finally:
+                add_time("db", started)
+            if name == "find":
+                return TimedCursor(result)
+            return result
+        # __getattr__ is only asked again for names that aren't set yet
+        setattr(self, name, timed)
+        return timed
+
+
+def log_request(timer : RequestTimer, method : str, path : str) -> None:
+    # one line per request at DEBUG, a sample of them at INFO
+    if logger.isEnabledFor(logging.DEBUG):
+        level : int = logging.DEBUG
+    elif random.random() < REQUEST_LOG_SAMPLE_RATE and logger.isEnabledFor(logging.INFO):
+        level = logging.INFO
+    else:
+        return
+    logger.log(level, "%s %s %d %.2fms in=%d out=%d db=%.2fms", method, path, timer.status,
+               (time.perf_counter() - timer.started) * 1000, timer.bytes_in, timer.bytes_out,
+               timer.phases["db"] * 1000)
+
+
+def configure_logging() -> None:
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+
+# shared by every connection
+request_metrics : RequestMetrics = RequestMetrics()
+
+
+def test1():
+    from util.fake_collection import FakeCollection
+
+    timer = RequestTimer()
+    timer.route = "GET /api/chats"
+    set_timer(timer)
+    collection = TimedCollection(FakeCollection())
+    collection.insert_one({"id": "a", "seq": 1})
+    assert [m["id"] for m in collection.find({}).sort("seq").limit(1)] == ["a"]
+    assert timer.phases["db"] > 0
+    record_sent(200, 123)
+    record_sent(200, 7)
+    set_timer(None)
+
+    metrics = RequestMetrics()
+    metrics.observe(timer)
+    text = metrics.to_prometheus()
+    assert 'http_requests_total{route="GET /api/chats",status="200"} 1' in text
+    assert 'http_response_bytes_total{route="GET /api/chats"} 130' in text
+    assert 'http_request_duration_seconds_bucket{route="GET /api/chats",le="+Inf"} 1' in text
+    assert 'http_request_phase_seconds_count{route="GET /api/chats",phase="db"} 1' in text
+
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe(value)
+    assert histogram.cumulative() == [("0.1", 1), ("1", 3), ("+Inf", 4)]
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
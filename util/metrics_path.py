@@ -0,0 +1,12 @@
+from util.request import Request
+from util.response import Response
+from util.metrics import request_metrics
+
+def serve_metrics(request : Request, handler) -> None:
+    # GET /metrics: the request histograms of this process, in Prometheus' text format
+    res = (Response()
+           .headers({"Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+                     "Cache-Control": "no-store"})
+           .text(request_metrics.to_prometheus()))
+    res.compress(request)
+    res.send(handler.request)
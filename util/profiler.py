@@ -0,0 +1,259 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+# opt-in profiling of a running server, for a set window:
+#   - a sampler thread takes the stack of every thread in the process PROFILE_SAMPLE_INTERVAL_MS apart
+#     and counts them as collapsed stacks ("route;file:function;file:function 12", one per line),
+#     the input flamegraph.pl / speedscope / inferno want
+#   - one routed request in PROFILE_CPROFILE_SAMPLE_RATE runs its route action under cProfile,
+#     the results are added up per route ("GET /api/chats") into a pstats summary
+# started by POST /admin/profile (util/profiler_path.py) or PROFILE_ON_START
+# (numbers are per process, with SERVER_MODE=prefork every worker process profiles itself)
+
+# PROFILE_ON_START=<seconds>: every process profiles its first <seconds> after it serves its first request
+PROFILE_ON_START : float = float(os.environ.get("PROFILE_ON_START", "0"))
+PROFILE_DIR : str = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL_MS : float = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "10"))
+PROFILE_CPROFILE_SAMPLE_RATE : float = float(os.environ.get("PROFILE_CPROFILE_SAMPLE_RATE", "0.05"))
+# longest window anyone can ask for
+PROFILE_MAX_SECONDS : float = float(os.environ.get("PROFILE_MAX_SECONDS", "60"))
+# functions per route in the summary
+PROFILE_TOP_FUNCTIONS : int = int(os.environ.get("PROFILE_TOP_FUNCTIONS", "25"))
+
+
+class ProfilerBusy(Exception):
+    # a profile is already running in this process
+    pass
+
+
+class ProfileSession:
+
+    def __init__(self, seconds : float,
+                 interval : float = PROFILE_SAMPLE_INTERVAL_MS / 1000,
+                 cprofile_rate : float = PROFILE_CPROFILE_SAMPLE_RATE) -> None:
+        self.seconds : float = min(seconds, PROFILE_MAX_SECONDS)
+        self.interval : float = interval
+        self.cprofile_rate : float = cprofile_rate
+        self.started : float = time.time()
+
+        self.lock : threading.Lock = threading.Lock()
+        # collapsed stack -> times it was seen
+        self.stacks : dict[str, int] = {}
+        self.samples : int = 0
+        # thread ident -> route it's running right now, so stacks can start with the route
+        self.thread_routes : dict[int, str] = {}
+        # route -> cProfile results of its profiled requests
+        self.route_stats : dict[str, pstats.Stats] = {}
+        self.route_requests : dict[str, int] = {}
+
+        self.finished : bool = False
+        self.done : threading.Event = threading.Event()
+        # written by finish()
+        self.files : list[str] = []
+
+    def run(self) -> None:
+        # the sampler thread
+        deadline : float = time.monotonic() + self.seconds
+        me : int = threading.get_ident()
+        while time.monotonic() < deadline:
+            self.sample(me)
+            time.sleep(self.interval)
+        self.finish()
+
+    def sample(self, skip : int) -> None:
+        names : dict[int, str] = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, frame in frames.items():
+                if ident == skip:
+                    continue
+                root : str = self.thread_routes.get(ident) or thread_group(names.get(ident, "thread"))
+                stack : str = root + ";" + collapse(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def call(self, route : str, action, request, handler) -> None:
+        # runs a route action, under cProfile for a sample of requests
+        ident : int = threading.get_ident()
+        self.thread_routes[ident] = route
+        try:
+            if self.finished or random.random() >= self.cprofile_rate:
+                action(request, handler)
+                return
+
+            profile : cProfile.Profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # only one cProfile at a time on newer Pythons (sys.monitoring), this request goes unprofiled
+                action(request, handler)
+                return
+            try:
+                action(request, handler)
+            finally:
+                profile.disable()
+                self.add_profile(route, profile)
+        finally:
+            self.thread_routes.pop(ident, None)
+
+    def add_profile(self, route : str, profile : cProfile.Profile) -> None:
+        with self.lock:
+            if self.finished:
+                return
+            stats : pstats.Stats | None = self.route_stats.get(route)
+            if stats is None:
+                self.route_stats[route] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self.route_requests[route] = self.route_requests.get(route, 0) + 1
+
+    def finish(self) -> None:
+        global active_session
+        with self.lock:
+            self.finished = True
+        try:
+            self.files = self.write(PROFILE_DIR)
+        except OSError as e:
+            print("profile could not be written to " + PROFILE_DIR + ": " + str(e))
+        with session_lock:
+            if active_session is self:
+                active_session = None
+        self.done.set()
+
+    def write(self, directory : str) -> list[str]:
+        # <directory>/profile-<pid>-<time>.collapsed and .txt
+        os.makedirs(directory, exist_ok=True)
+        name : str = os.path.join(directory, "profile-" + str(os.getpid()) + "-" +
+                                  time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started)))
+        with open(name + ".collapsed", "w") as file:
+            file.write(self.collapsed())
+        with open(name + ".txt", "w") as file:
+            file.write(self.summary())
+        return [name + ".collapsed", name + ".txt"]
+
+    def collapsed(self) -> str:
+        with self.lock:
+            return "".join(stack + " " + str(count) + "\n" for stack, count in sorted(self.stacks.items()))
+
+    def summary(self, top : int = PROFILE_TOP_FUNCTIONS) -> str:
+        with self.lock:
+            out : io.StringIO = io.StringIO()
+            out.write("pid " + str(os.getpid()) + ", " + format(self.seconds, "g") + "s, " +
+                      str(self.samples) + " stack samples, cProfile on " +
+                      format(self.cprofile_rate * 100, "g") + "% of requests\n")
+            for route, stats in sorted(self.route_stats.items()):
+                out.write("\n=== " + route + " (" + str(self.route_requests[route]) + " requests profiled) ===\n")
+                stats.stream = out
+                stats.sort_stats("cumulative").print_stats(top)
+            return out.getvalue()
+
+
+def collapse(frame) -> str:
+    # outermost call first, "server.py:handle;router.py:route_request;..."
+    names : list[str] = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(os.path.basename(code.co_filename) + ":" + code.co_name)
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+def thread_group(name : str) -> str:
+    # "worker_12" -> "worker", so a pool's idle threads end up in one stack
+    return name.rstrip("0123456789").rstrip("_-") or name
+
+
+# the profile running in this process, if any
+active_session : ProfileSession | None = None
+session_lock : threading.Lock = threading.Lock()
+started_from_env : bool = False
+
+
+def start_profile(seconds : float, interval : float = PROFILE_SAMPLE_INTERVAL_MS / 1000,
+                  cprofile_rate : float = PROFILE_CPROFILE_SAMPLE_RATE) -> ProfileSession:
+    # raises ProfilerBusy if one is already running, wait on session.done for the results
+    global active_session
+    with session_lock:
+        if active_session is not None:
+            raise ProfilerBusy("a profile is already running")
+        session : ProfileSession = ProfileSession(seconds, interval, cprofile_rate)
+        active_session = session
+    threading.Thread(target=session.run, name="profiler", daemon=True).start()
+    return session
+
+
+def start_from_env() -> None:
+    # PROFILE_ON_START, called for every connection (per process, prefork forks after startup)
+    global started_from_env
+    if started_from_env or PROFILE_ON_START <= 0:
+        return
+    with session_lock:
+        if started_from_env:
+            return
+        started_from_env = True
+    try:
+        start_profile(PROFILE_ON_START)
+    except ProfilerBusy:
+        pass
+
+
+def test1():
+    import tempfile
+
+    def busy_loop(stop):
+        while not stop.is_set():
+            sum(range(1000))
+
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop, args=(stop,), name="worker_3")
+    worker.start()
+
+    session = ProfileSession(0.2, interval=0.005, cprofile_rate=1.0)
+    session.call("GET /hello", lambda request, handler: sum(range(1000)), None, None)
+    deadline = time.monotonic() + 0.2
+    while time.monotonic() < deadline:
+        session.sample(threading.get_ident())
+        time.sleep(0.005)
+    stop.set()
+    worker.join()
+
+    assert session.samples > 0
+    assert any(stack.startswith("worker;") and "profiler.py:busy_loop" in stack for stack in session.stacks)
+    assert session.route_requests == {"GET /hello": 1}
+    assert "=== GET /hello (1 requests profiled) ===" in session.summary()
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = session.write(directory)
+        with open(files[0]) as file:
+            line = file.readline().rstrip("\n")
+        assert int(line.rsplit(" ", 1)[1]) > 0
+
+    assert thread_group("worker_12") == "worker" and thread_group("profiler") == "profiler"
+    print("test1 passed")
+
+def test2():
+    global PROFILE_DIR
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        PROFILE_DIR = directory
+        session = start_profile(0.05, interval=0.01)
+        try:
+            start_profile(1)
+            assert False
+        except ProfilerBusy:
+            pass
+        assert session.done.wait(5)
+        assert active_session is None and len(session.files) == 2
+    print("test2 passed")
+
+if __name__ == '__main__':
+    test1()
+    test2()
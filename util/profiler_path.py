@@ -0,0 +1,65 @@
+import hmac
+import os
+
+from util.request import Request
+from util.response import Response
+from util.router import NOT_FOUND_RESPONSE
+from util.profiler import start_profile, ProfilerBusy, PROFILE_MAX_SECONDS
+
+# POST /admin/profile needs "Authorization: Bearer <ADMIN_TOKEN>", with no ADMIN_TOKEN set the route is a 404
+ADMIN_TOKEN : str = os.environ.get("ADMIN_TOKEN", "")
+
+
+def is_admin(request : Request) -> bool:
+    authorization : str = request.get_header("Authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer":
+        return False
+    return hmac.compare_digest(token.strip().encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def run_profile(request : Request, handler) -> None:
+    # POST /admin/profile?seconds=10&format=summary|collapsed
+    # profiles the process that got the request for ?seconds= (default 10), then answers with the
+    # per-route cProfile summary or the collapsed stacks (both are also written to PROFILE_DIR)
+    if ADMIN_TOKEN == "":
+        NOT_FOUND_RESPONSE.send(handler.request)
+        return
+    if not is_admin(request):
+        (Response()
+         .set_status(403, "Forbidden")
+         .text("admin token required")
+         .send(handler.request))
+        return
+
+    try:
+        seconds : float = float(request.get_query("seconds", "10"))
+    except ValueError:
+        seconds = -1
+    output_format : str = request.get_query("format", "summary")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or output_format not in ("summary", "collapsed"):
+        (Response()
+         .set_status(400, "Bad Request")
+         .text("seconds has to be in (0, " + format(PROFILE_MAX_SECONDS, "g") +
+               "], format summary or collapsed")
+         .send(handler.request))
+        return
+
+    try:
+        session = start_profile(seconds)
+    except ProfilerBusy:
+        (Response()
+         .set_status(409, "Conflict")
+         .text("a profile is already running")
+         .send(handler.request))
+        return
+
+    # this worker thread waits out the window
+    session.done.wait()
+    body : str = session.summary() if output_format == "summary" else session.collapsed()
+    res = (Response()
+           .headers({"Content-Type": "text/plain; charset=utf-8",
+                     "Cache-Control": "no-store"})
+           .text(body))
+    res.compress(request)
+    res.send(handler.request)
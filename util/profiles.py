@@ -0,0 +1,115 @@
+import threading
+
+from util.database import profiles_collection
+from util.chat_version import ChatVersion, SyncCursor, chat_version
+
+# _id (the session id) comes back anyway
+PROFILE_PROJECTION : dict[str, int] = {"nickname": 1, "seq": 1}
+
+
+class ProfileStore:
+    # nicknames, one document per user: {"_id": <session id>, "nickname": string, "seq": int}
+    # messages only keep the author, the nickname is joined on when they're sent out,
+    # so renaming is one write no matter how many messages the user has
+    #
+    # every profile is kept in memory (there's one per user who picked a nickname, not one per message)
+    # renames get a seq like message changes, so pollers can be told which names changed since their cursor
+
+    def __init__(self, collection, version : ChatVersion = chat_version) -> None:
+        self.collection = collection
+        self.cursor : SyncCursor = SyncCursor(version)
+        self.lock : threading.Lock = threading.Lock()
+        self.loaded : bool = False
+
+        # session id -> nickname
+        self.nicknames : dict[str, str] = {}
+        # session id -> seq of the last rename
+        self.renamed : dict[str, int] = {}
+
+    def load(self) -> None:
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            version : int = self.cursor.version.current()
+            for profile in self.collection.find({}, PROFILE_PROJECTION):
+                self.put(profile)
+            self.cursor.caught_up(version)
+            self.loaded = True
+
+    def sync(self) -> None:
+        # read back renames made by other processes
+        self.load()
+        behind : tuple[int, int] | None = self.cursor.behind()
+        if behind is None:
+            return
+        since, version = behind
+        profiles : list[dict] = list(self.collection.find({"seq": {"$gt": since}}, PROFILE_PROJECTION))
+        with self.lock:
+            for profile in profiles:
+                if profile.get("seq", 0) >= self.renamed.get(profile["_id"], 0):
+                    self.put(profile)
+        self.cursor.caught_up(version)
+
+    def put(self, profile : dict) -> None:
+        # (lock held)
+        self.nicknames[profile["_id"]] = profile["nickname"]
+        self.renamed[profile["_id"]] = profile.get("seq", 0)
+
+    def get_nicknames(self) -> dict[str, str]:
+        # session id -> nickname for everybody, shared (don't change it)
+        self.sync()
+        return self.nicknames
+
+    def renamed_since(self, since : int) -> dict[str, str]:
+        # session id -> nickname of the users who picked a new nickname after since
+        self.sync()
+        with self.lock:
+            return {user_id: self.nicknames[user_id]
+                    for user_id, seq in self.renamed.items() if seq > since}
+
+    def set_nickname(self, user_id : str, nickname : str, seq : int) -> None:
+        # seq comes from chat_version.write()
+        self.collection.update_one({"_id": user_id},
+                                   {"$set": {"nickname": nickname}, "$max": {"seq": seq}},
+                                   upsert=True)
+        with self.lock:
+            if seq >= self.renamed.get(user_id, 0):
+                self.nicknames[user_id] = nickname
+                self.renamed[user_id] = seq
+
+
+# shared by every connection
+profile_store : ProfileStore = ProfileStore(profiles_collection)
+
+
+def test1():
+    from util.fake_collection import FakeDatabase
+    import util.chat_version
+
+    db = FakeDatabase()
+    util.chat_version.counters_collection = db["counters"]
+    # one seq per write: with reserved ranges, another process's writes only show up once
+    # the ranges stop being used (see util/chat_version.py's test1)
+    version = ChatVersion(ttl=0, batch=1)
+    store = ProfileStore(db["profiles"], version=version)
+
+    with version.write() as seq:
+        store.set_nickname("a", "alice", seq)
+    with version.write() as seq:
+        store.set_nickname("b", "bob", seq)
+    assert store.get_nicknames() == {"a": "alice", "b": "bob"}
+    assert store.renamed_since(1) == {"b": "bob"}
+
+    # renamed by another process
+    other_version = ChatVersion(ttl=0, batch=1)
+    with other_version.write() as seq:
+        db["profiles"].update_one({"_id": "a"}, {"$set": {"nickname": "al", "seq": seq}})
+    assert store.renamed_since(2) == {"a": "al"}
+
+    assert ProfileStore(db["profiles"], version=version).get_nicknames() == {"a": "al", "b": "bob"}
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
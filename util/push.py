@@ -0,0 +1,345 @@
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+import weakref
+
+from util.chat_version import chat_version
+from util.rate_limit import close_connection
+
+# how often (seconds) the broker checks for changes made by other processes/servers
+# (changes made in this process wake it up right away)
+PUSH_POLL_INTERVAL : float = float(os.environ.get("PUSH_POLL_INTERVAL", "1"))
+
+# comment line sent to idle streams so dead connections get noticed (and proxies don't time them out)
+PUSH_HEARTBEAT_INTERVAL : float = float(os.environ.get("PUSH_HEARTBEAT_INTERVAL", "15"))
+
+# a client with more than this many bytes it hasn't taken yet when the next event comes is dropped
+# (sending never waits for a client, what its socket can't take right away waits in memory)
+PUSH_MAX_BUFFERED : int = int(os.environ.get("PUSH_MAX_BUFFERED", str(1 << 20)))
+
+# streams held open per process
+PUSH_MAX_CLIENTS : int = int(os.environ.get("PUSH_MAX_CLIENTS", "1000"))
+
+# sockets handed over to a broker -> the peer IP whose connection count they still hold (None if they don't),
+# the server must not close them (or release their count, see util/rate_limit.py) when the handler returns
+detached_sockets : weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def is_detached(sock) -> bool:
+    return sock in detached_sockets
+
+
+def format_event(event : str, data : dict, event_id : int) -> bytes:
+    # one Server-Sent Event, the id comes back as Last-Event-ID when the browser reconnects
+    return ("id: " + str(event_id) + "\n" +
+            "event: " + event + "\n" +
+            # default=list: data can have generators in it, like the "messages" of get_changes()
+            "data: " + json.dumps(data, default=list) + "\n\n").encode("utf-8")
+
+
+class PushClient:
+    # one open stream (broker thread only)
+    def __init__(self, sock : socket.socket, since : int) -> None:
+        self.sock : socket.socket = sock
+        # how far its catch-up has got, None once it's caught up with the broker's cursor
+        self.since : int | None = since
+        # what the socket hasn't taken yet
+        self.outgoing : bytearray = bytearray()
+
+
+class PushBroker:
+    # holds the open text/event-stream connections of every subscribed client
+    # and sends them one "messages" event per batch of chat changes,
+    # so N idle clients cost nothing and one change costs one database read (not N)
+    #
+    # get_changes(since, version) -> dict of what changed after since, same format as /api/chats?since=
+    # (one page of it: "cursor" says how far it goes, "has_more" if there's more after that)
+    #
+    # one thread does all the sending, on non-blocking sockets watched by a selector:
+    # a client that stops reading only fills up its own outgoing buffer, nobody else waits for it
+
+    def __init__(self, get_changes, poll_interval : float = PUSH_POLL_INTERVAL,
+                 max_buffered : int = PUSH_MAX_BUFFERED) -> None:
+        self.get_changes = get_changes
+        self.poll_interval : float = poll_interval
+        self.max_buffered : int = max_buffered
+
+        # every open stream (broker thread only, other threads just count them)
+        self.clients : dict[socket.socket, PushClient] = {}
+        # streams that just subscribed -> the cursor they asked to start after
+        self.joining : dict[socket.socket, int] = {}
+        # guards joining, and starting the thread
+        self.lock : threading.Lock = threading.Lock()
+
+        # made by the first subscribe() (not at import, SERVER_MODE=prefork forks after that)
+        self.selector : selectors.BaseSelector | None = None
+        self.waker : socket.socket | None = None
+        self.wakeup_reader : socket.socket | None = None
+        self.thread : threading.Thread | None = None
+
+        # chat version the caught up clients have been sent up to (broker thread only)
+        self.cursor : int | None = None
+        self.last_sent : float = time.monotonic()
+        # there's more to send right away (the next page), don't wait for the poll interval
+        self.busy : bool = False
+
+    def publish(self, seq : int | None = None) -> None:
+        # something changed, send it out (called after every chat write, see ChatVersion.write)
+        self.wake()
+
+    def wake(self) -> None:
+        if self.waker is None:
+            return
+        try:
+            self.waker.send(b"\0")
+        except BlockingIOError:
+            # already has wakeups waiting
+            pass
+
+    def is_full(self) -> bool:
+        return len(self.clients) + len(self.joining) >= PUSH_MAX_CLIENTS
+
+    def subscribe(self, sock : socket.socket, since : int, peer_ip : str | None = None) -> bool:
+        # takes over sock (the response head has already been sent on it)
+        # the broker thread first sends everything after since, then every change from now on
+        # False (and sock is closed) if this process already has PUSH_MAX_CLIENTS streams
+        # from here on the broker is in charge of closing sock, and of close_connection(peer_ip) when it does
+        # (the stream keeps counting against its IP's connections as long as it's open)
+        detached_sockets[sock] = peer_ip
+
+        with self.lock:
+            if self.is_full():
+                close_socket(sock)
+                return False
+            self.joining[sock] = since
+            self.start()
+        self.wake()
+        return True
+
+    def start(self) -> None:
+        # (caller holds the lock) background thread is started by the first subscriber
+        if self.thread is None:
+            self.selector = selectors.DefaultSelector()
+            self.wakeup_reader, self.waker = socket.socketpair()
+            self.wakeup_reader.setblocking(False)
+            self.waker.setblocking(False)
+            self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+            self.thread = threading.Thread(target=self.run, name="push-broker", daemon=True)
+            self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            for key, events in self.selector.select(0 if self.busy else self.poll_interval):
+                if key.fileobj is self.wakeup_reader:
+                    self.drain_wakeups()
+                    continue
+                client : PushClient = key.data
+                if events & selectors.EVENT_READ:
+                    self.read_from(client)
+                if events & selectors.EVENT_WRITE and client.sock in self.clients:
+                    self.flush(client)
+            try:
+                self.broadcast_changes()
+            except Exception as e:
+                # keep the broker alive through database hiccups
+                print("push broker error:", repr(e))
+
+    def drain_wakeups(self) -> None:
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def broadcast_changes(self) -> None:
+        # (broker thread)
+        with self.lock:
+            joining : dict[socket.socket, int] = self.joining
+            self.joining = {}
+        for sock, since in joining.items():
+            self.add_client(sock, since)
+        self.busy = False
+        if len(self.clients) == 0:
+            return
+
+        version : int = chat_version.current()
+        caught_up : list[PushClient] = [client for client in self.clients.values() if client.since is None]
+        if self.cursor is None or len(caught_up) == 0:
+            # nobody was listening, nothing older than now needs broadcasting
+            self.cursor = version
+
+        if version > self.cursor:
+            changes : dict = self.get_changes(self.cursor, version)
+            self.cursor = changes["cursor"]
+            self.send_to_all(caught_up, format_event("messages", changes, changes["cursor"]))
+            # send the next page without waiting
+            self.busy = changes["has_more"]
+        elif time.monotonic() - self.last_sent >= PUSH_HEARTBEAT_INTERVAL:
+            self.send_to_all(caught_up, b": ping\n\n")
+
+        # new streams catch up to the broker's cursor a page at a time, the next page once they've taken the last,
+        # from then on they get the broadcast
+        for client in list(self.clients.values()):
+            if client.since is not None and len(client.outgoing) == 0:
+                self.catch_up(client)
+
+    def add_client(self, sock : socket.socket, since : int) -> None:
+        # watched for reading too, so a client closing its end is noticed right away
+        try:
+            sock.setblocking(False)
+            client : PushClient = PushClient(sock, since)
+            self.selector.register(sock, selectors.EVENT_READ, client)
+        except (ValueError, OSError):
+            # closed already
+            close_socket(sock)
+            return
+        self.clients[sock] = client
+
+    def catch_up(self, client : PushClient) -> None:
+        # the next page of what happened after client.since, up to the broker's cursor
+        if client.since < self.cursor:
+            changes : dict = self.get_changes(client.since, self.cursor)
+            if not self.queue(client, format_event("messages", changes, changes["cursor"])):
+                return
+            client.since = changes["cursor"]
+        if client.since >= self.cursor:
+            client.since = None
+        elif len(client.outgoing) == 0:
+            self.busy = True
+
+    def send_to_all(self, clients : list[PushClient], data : bytes) -> None:
+        self.last_sent = time.monotonic()
+        for client in clients:
+            self.queue(client, data)
+
+    def queue(self, client : PushClient, data : bytes) -> bool:
+        # sends as much of data as the socket takes now, the rest goes out when it's writable again
+        # False if client was dropped (closed, or too far behind)
+        if len(client.outgoing) > self.max_buffered:
+            self.drop(client)
+            return False
+        if len(client.outgoing) > 0:
+            client.outgoing += data
+            return True
+        try:
+            sent : int = client.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.drop(client)
+            return False
+        if sent < len(data):
+            client.outgoing += memoryview(data)[sent:]
+            self.selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        return True
+
+    def flush(self, client : PushClient) -> None:
+        try:
+            sent : int = client.sock.send(client.outgoing)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.drop(client)
+            return
+        del client.outgoing[:sent]
+        if len(client.outgoing) == 0:
+            self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def read_from(self, client : PushClient) -> None:
+        # the client isn't supposed to send anything, readable means it closed the connection (or it's thrown away)
+        try:
+            if len(client.sock.recv(4096)) > 0:
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+        self.drop(client)
+
+    def drop(self, client : PushClient) -> None:
+        # closed by the client, or too slow to keep up
+        del self.clients[client.sock]
+        self.selector.unregister(client.sock)
+        close_socket(client.sock)
+
+
+def close_socket(sock : socket.socket) -> None:
+    peer_ip : str | None = detached_sockets.pop(sock, None)
+    if peer_ip is not None:
+        close_connection(peer_ip)
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def test1():
+    # a client that stops reading holds up neither subscribe() nor the other clients, it's dropped once
+    # it's more than max_buffered behind, and a new client's catch-up doesn't hold up the broadcast
+    global chat_version
+
+    class FakeVersion:
+        value = 0
+        def current(self):
+            return self.value
+
+    chat_version = FakeVersion()
+    def get_changes(since, version):
+        return {"messages": ["x" * 300_000], "cursor": version, "has_more": False}
+    broker = PushBroker(get_changes, poll_interval=0.05, max_buffered=200_000)
+
+    def read_events(peer, count):
+        received = b""
+        while received.count(b"\n\n") < count:
+            received += peer.recv(1 << 20)
+        return [event.split(b"\n")[0] for event in received.split(b"\n\n")[:count]]
+
+    stuck, stuck_peer = socket.socketpair()
+    fast, fast_peer = socket.socketpair()
+    fast_peer.settimeout(5)
+    assert broker.subscribe(stuck, 0) and broker.subscribe(fast, 0)
+    time.sleep(0.1)
+
+    started = time.monotonic()
+    for value in (1, 2, 3):
+        chat_version.value = value
+        broker.publish()
+        assert read_events(fast_peer, 1) == [b"id: " + str(value).encode()]
+    # no waiting for the stuck client at all
+    assert time.monotonic() - started < 0.5
+    assert stuck not in broker.clients and stuck.fileno() == -1
+
+    # a new client gets the catch-up, then the broadcast
+    late, late_peer = socket.socketpair()
+    late_peer.settimeout(5)
+    assert broker.subscribe(late, 1)
+    assert read_events(late_peer, 1) == [b"id: 3"]
+    chat_version.value = 4
+    broker.publish()
+    assert read_events(late_peer, 1) == [b"id: 4"] and read_events(fast_peer, 1) == [b"id: 4"]
+
+    # closing the client's end frees its slot
+    late_peer.close()
+    time.sleep(0.1)
+    assert late not in broker.clients and len(broker.clients) == 1
+
+    # a stream keeps counting against its IP's connections until the broker closes it
+    import util.rate_limit
+    util.rate_limit.RATE_LIMITING = "true"
+    assert util.rate_limit.accept_connection("10.0.0.1", None)
+    counted, counted_peer = socket.socketpair()
+    assert broker.subscribe(counted, 4, "10.0.0.1")
+    assert util.rate_limit.connection_limiter.counts["10.0.0.1"] == 1
+    counted_peer.close()
+    time.sleep(0.1)
+    assert "10.0.0.1" not in util.rate_limit.connection_limiter.counts
+    fast_peer.close()
+    stuck_peer.close()
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
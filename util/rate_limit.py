@@ -0,0 +1,285 @@
+import ipaddress
+import math
+import os
+import threading
+import time
+
+from util.request import Request
+from util.response import Response
+from util.response_cache import PrebuiltResponse
+
+# admission control in front of the router (see MyTCPHandler.handle), so one client can't flood the database:
+#   - connections open at once per client IP
+#   - token buckets: every request per client IP, writes (anything but GET/HEAD) per IP and per session cookie
+#     a client that's out of tokens gets 429 Too Many Requests with Retry-After
+#   - requests being handled at once (all clients), a request waits up to MAX_IN_FLIGHT_WAIT seconds
+#     for a slot and gets 503 Service Unavailable otherwise
+# everything is per process (with SERVER_MODE=prefork every worker process keeps its own counts)
+# off unless RATE_LIMITING=true
+RATE_LIMITING = os.environ.get("RATE_LIMITING", "false")
+
+# the client IP is the socket's peer address, unless the peer is one of TRUSTED_PROXIES
+# (comma separated addresses or networks, "10.0.0.5,172.16.0.0/12"): then it's the last X-Forwarded-For
+# address that isn't a trusted proxy, so a client can't pick its own bucket by sending the header itself
+# behind a load balancer, leaving this empty puts every client in the load balancer's bucket
+TRUSTED_PROXIES : tuple = tuple(ipaddress.ip_network(network.strip(), strict=False)
+                                for network in os.environ.get("TRUSTED_PROXIES", "").split(",")
+                                if network.strip() != "")
+
+# requests per second a bucket refills at, and how many it holds (a burst can use them all at once)
+RATE_LIMIT_IP_RATE : float = float(os.environ.get("RATE_LIMIT_IP_RATE", "50"))
+RATE_LIMIT_IP_BURST : float = float(os.environ.get("RATE_LIMIT_IP_BURST", "100"))
+RATE_LIMIT_WRITE_IP_RATE : float = float(os.environ.get("RATE_LIMIT_WRITE_IP_RATE", "20"))
+RATE_LIMIT_WRITE_IP_BURST : float = float(os.environ.get("RATE_LIMIT_WRITE_IP_BURST", "40"))
+RATE_LIMIT_WRITE_SESSION_RATE : float = float(os.environ.get("RATE_LIMIT_WRITE_SESSION_RATE", "5"))
+RATE_LIMIT_WRITE_SESSION_BURST : float = float(os.environ.get("RATE_LIMIT_WRITE_SESSION_BURST", "20"))
+# buckets kept per limiter before the full (idle) ones are dropped
+RATE_LIMIT_MAX_KEYS : int = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "10000"))
+
+MAX_CONNECTIONS_PER_IP : int = int(os.environ.get("MAX_CONNECTIONS_PER_IP", "32"))
+# a bit under MONGO_MAX_POOL_SIZE, so requests wait here instead of in pymongo's wait queue
+MAX_IN_FLIGHT : int = int(os.environ.get("MAX_IN_FLIGHT", "48"))
+MAX_IN_FLIGHT_WAIT : float = float(os.environ.get("MAX_IN_FLIGHT_WAIT", "0.5"))
+
+# sent before closing a connection that's over MAX_CONNECTIONS_PER_IP
+TOO_MANY_CONNECTIONS_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                                    .set_status(429, "Too Many Requests")
+                                                                    .headers({"Retry-After": "1",
+                                                                              "Connection": "close"})
+                                                                    .text("Too many connections"))
+# every handler slot is taken
+OVERLOADED_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                          .set_status(503, "Service Unavailable")
+                                                          .headers({"Retry-After": "1"})
+                                                          .text("Server is busy, try again"))
+
+# methods that don't count as writes
+READ_METHODS : frozenset[str] = frozenset(("GET", "HEAD"))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens : float, updated : float) -> None:
+        self.tokens : float = tokens
+        self.updated : float = updated
+
+
+class RateLimiter:
+    # one token bucket per key, every allowed request takes a token
+
+    def __init__(self, rate : float, burst : float, max_keys : int = RATE_LIMIT_MAX_KEYS) -> None:
+        self.rate : float = rate
+        self.burst : float = burst
+        self.max_keys : int = max_keys
+        self.lock : threading.Lock = threading.Lock()
+        self.buckets : dict[str, TokenBucket] = {}
+
+    def take(self, key : str, now : float | None = None) -> float:
+        # 0 if the request is allowed, otherwise the seconds until the next token
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            bucket : TokenBucket | None = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self.drop_full(now)
+                bucket = TokenBucket(self.burst, now)
+                self.buckets[key] = bucket
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0.0
+            return (1 - bucket.tokens) / self.rate
+
+    def drop_full(self, now : float) -> None:
+        # buckets that have refilled are the same as no bucket
+        # (caller holds the lock)
+        self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                        if bucket.tokens + (now - bucket.updated) * self.rate < self.burst}
+        if len(self.buckets) >= self.max_keys:
+            # every client is busy, start over rather than grow without limit
+            self.buckets = {}
+
+
+class ConnectionLimiter:
+    # open connections per client IP
+
+    def __init__(self, max_per_key : int = MAX_CONNECTIONS_PER_IP) -> None:
+        self.max_per_key : int = max_per_key
+        self.lock : threading.Lock = threading.Lock()
+        self.counts : dict[str, int] = {}
+
+    def acquire(self, key : str) -> bool:
+        with self.lock:
+            count : int = self.counts.get(key, 0)
+            if count >= self.max_per_key:
+                return False
+            self.counts[key] = count + 1
+            return True
+
+    def release(self, key : str) -> None:
+        with self.lock:
+            count : int = self.counts.get(key, 0) - 1
+            if count <= 0:
+                self.counts.pop(key, None)
+            else:
+                self.counts[key] = count
+
+
+ip_limiter : RateLimiter = RateLimiter(RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST)
+write_ip_limiter : RateLimiter = RateLimiter(RATE_LIMIT_WRITE_IP_RATE, RATE_LIMIT_WRITE_IP_BURST)
+write_session_limiter : RateLimiter = RateLimiter(RATE_LIMIT_WRITE_SESSION_RATE, RATE_LIMIT_WRITE_SESSION_BURST)
+connection_limiter : ConnectionLimiter = ConnectionLimiter()
+in_flight_slots : threading.BoundedSemaphore = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+
+def is_trusted_proxy(ip : str) -> bool:
+    if len(TRUSTED_PROXIES) == 0:
+        return False
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def client_ip_of(request : Request, peer_ip : str) -> str:
+    # who the request is from, see TRUSTED_PROXIES
+    if not is_trusted_proxy(peer_ip):
+        return peer_ip
+    forwarded : list[str] = [address.strip()
+                             for value in request.headers.get_all("X-Forwarded-For")
+                             for address in value.split(",")]
+    # each proxy appends the address it got the request from, so read from the right
+    for address in reversed(forwarded):
+        if not is_trusted_proxy(address):
+            return address if address != "" else peer_ip
+    return peer_ip
+
+
+def accept_connection(peer_ip : str, sock) -> bool:
+    # call once per connection, False => it was answered with a 429, close it without reading
+    # every True has to be matched by a close_connection() when the handler is done
+    # (a trusted proxy's connections carry many clients, they aren't counted)
+    if RATE_LIMITING != "true" or is_trusted_proxy(peer_ip):
+        return True
+    if connection_limiter.acquire(peer_ip):
+        return True
+    TOO_MANY_CONNECTIONS_RESPONSE.send(sock)
+    return False
+
+
+def close_connection(peer_ip : str) -> None:
+    if RATE_LIMITING == "true" and not is_trusted_proxy(peer_ip):
+        connection_limiter.release(peer_ip)
+
+
+def admit(request : Request, peer_ip : str, sock) -> bool:
+    # call before routing a request, False => it was answered with a 429/503 and must not be routed
+    # every True has to be matched by a finish_request() once it's been handled
+    if RATE_LIMITING != "true":
+        return True
+
+    client_ip : str = client_ip_of(request, peer_ip)
+    wait : float = ip_limiter.take(client_ip)
+    if wait == 0 and request.method not in READ_METHODS:
+        # the IP bucket is taken from first, so one IP rotating session cookies still runs out
+        wait = write_ip_limiter.take(client_ip)
+        session : str = request.cookies.get("session", "")
+        if wait == 0 and session != "":
+            wait = write_session_limiter.take(session)
+    if wait > 0:
+        send_too_many_requests(sock, wait)
+        return False
+
+    if not in_flight_slots.acquire(timeout=MAX_IN_FLIGHT_WAIT):
+        OVERLOADED_RESPONSE.send(sock)
+        return False
+    return True
+
+
+def finish_request() -> None:
+    if RATE_LIMITING == "true":
+        in_flight_slots.release()
+
+
+def send_too_many_requests(sock, wait : float) -> None:
+    # Retry-After is whole seconds, rounded up so the client doesn't come back too early
+    (Response()
+     .set_status(429, "Too Many Requests")
+     .headers({"Retry-After": str(max(1, math.ceil(wait)))})
+     .text("Too many requests, slow down")
+     .send(sock))
+
+
+def test1():
+    limiter = RateLimiter(rate=2, burst=3)
+    # a full bucket allows a burst, then one request per 1/rate seconds
+    assert [limiter.take("a", now=10.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.take("a", now=10.0) == 0.5
+    assert limiter.take("b", now=10.0) == 0.0
+    assert limiter.take("a", now=10.5) == 0.0
+    assert limiter.take("a", now=10.5) > 0
+
+    # idle buckets are dropped once there are too many
+    small = RateLimiter(rate=1, burst=1, max_keys=2)
+    small.take("x", now=0.0)
+    small.take("y", now=5.0)
+    small.take("z", now=5.0)
+    assert set(small.buckets) == {"y", "z"}
+
+    connections = ConnectionLimiter(max_per_key=2)
+    assert connections.acquire("1.2.3.4") and connections.acquire("1.2.3.4")
+    assert not connections.acquire("1.2.3.4") and connections.acquire("5.6.7.8")
+    connections.release("1.2.3.4")
+    assert connections.acquire("1.2.3.4")
+    print("test1 passed")
+
+def test2():
+    global write_session_limiter, RATE_LIMITING
+    RATE_LIMITING = "true"
+    class FakeSocket:
+        def __init__(self):
+            self.sent = b""
+        def sendall(self, data):
+            self.sent += data
+
+    write_session_limiter = RateLimiter(rate=1, burst=2)
+    post = Request(b'POST /api/chats HTTP/1.1\r\nCookie: session=abc\r\n\r\n')
+    sock = FakeSocket()
+    assert admit(post, "127.0.0.1", sock) and admit(post, "127.0.0.1", sock)
+    finish_request()
+    finish_request()
+    assert not admit(post, "127.0.0.1", sock)
+    assert sock.sent.startswith(b"HTTP/1.1 429 Too Many Requests\r\n") and b"Retry-After: 1\r\n" in sock.sent
+
+    # reads don't use the write buckets
+    get = Request(b'GET /api/chats HTTP/1.1\r\nCookie: session=abc\r\n\r\n')
+    assert admit(get, "127.0.0.1", FakeSocket())
+    finish_request()
+    print("test2 passed")
+
+def test3():
+    global TRUSTED_PROXIES
+    TRUSTED_PROXIES = (ipaddress.ip_network("10.0.0.0/8"), ipaddress.ip_network("192.168.1.1"))
+    forwarded = Request(b'GET / HTTP/1.1\r\nX-Forwarded-For: 6.6.6.6, 1.2.3.4\r\nX-Forwarded-For: 10.1.1.1\r\n\r\n')
+    # straight from a client: the header is whatever the client wrote, ignored
+    assert client_ip_of(forwarded, "5.6.7.8") == "5.6.7.8"
+    # through the proxies: the last address before them, not the one the client put first
+    assert client_ip_of(forwarded, "10.0.0.2") == "1.2.3.4"
+    assert client_ip_of(forwarded, "192.168.1.1") == "1.2.3.4"
+    # trusted proxy but no header
+    assert client_ip_of(Request(b'GET / HTTP/1.1\r\n\r\n'), "10.0.0.2") == "10.0.0.2"
+    assert is_trusted_proxy("10.255.0.1") and not is_trusted_proxy("192.168.1.2") and not is_trusted_proxy("junk")
+    TRUSTED_PROXIES = ()
+    assert client_ip_of(forwarded, "10.0.0.2") == "10.0.0.2"
+    print("test3 passed")
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
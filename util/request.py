@@ -1,5 +1,89 @@
+import urllib.parse
+from collections.abc import Mapping
+
+
+class Headers(Mapping):
+    # the request's headers, read straight out of the bytes of the head
+    # the head is scanned once for where every header's value is, values are only decoded when
+    # they're asked for (most requests only ever look at a few headers)
+    #
+    # names are case-insensitive ("content-length" finds "Content-Length")
+    # a header sent more than once is one value joined with ", " (Cookie with "; "), get_all() has them separately
+    # iterating gives every name once, the way the client first wrote it
+    # (lines without a ":" aren't headers, they're never found)
+
+    __slots__ = ("head", "offsets")
+
+    def __init__(self, head : bytes) -> None:
+        # head : request line + headers, without the final \r\n\r\n
+        self.head : bytes = head
+
+        # lower-cased name -> (value_start, value_end) into head, a header sent more than once has
+        # every (value_start, value_end) one after the other in the tuple, in the order they were sent
+        # (names are kept as bytes, a lookup encodes the name instead of every header decoding its own,
+        # and flat tuples instead of a list of pairs keep it small, every request has one)
+        self.offsets : dict[bytes, tuple[int, ...]] = {}
+        # header lines start after the request line
+        position : int = head.find(b"\r\n") + 2
+        if position == 1:
+            return
+        for line in head[position:].split(b"\r\n"):
+            colon : int = line.find(b":")
+            if colon != -1:
+                name : bytes = line[:colon].lower()
+                spans : tuple[int, ...] | None = self.offsets.get(name)
+                if spans is None:
+                    self.offsets[name] = (position + colon + 1, position + len(line))
+                else:
+                    self.offsets[name] = spans + (position + colon + 1, position + len(line))
+            position += len(line) + 2
+
+    def value(self, start : int, end : int) -> str:
+        # whitespace around the value isn't part of it
+        return self.head[start:end].strip().decode("utf-8", "replace")
+
+    def get_all(self, name : str) -> list[str]:
+        # every value of the header, in the order they were sent
+        spans : tuple[int, ...] | None = self.offsets.get(name.lower().encode())
+        if spans is None:
+            return []
+        return [self.value(spans[index], spans[index + 1]) for index in range(0, len(spans), 2)]
+
+    def get(self, name : str, default : str | None = None) -> str | None:
+        spans : tuple[int, ...] | None = self.offsets.get(name.lower().encode())
+        if spans is None:
+            return default
+        if len(spans) == 2:
+            return self.value(spans[0], spans[1])
+        # sent more than once
+        return ("; " if name.lower() == "cookie" else ", ").join(self.get_all(name))
+
+    def __getitem__(self, name : str) -> str:
+        value : str | None = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name) -> bool:
+        return isinstance(name, str) and name.lower().encode() in self.offsets
+
+    def __iter__(self):
+        for spans in self.offsets.values():
+            # the name is between the start of its first line and the ":"
+            value_start : int = spans[0]
+            line_start : int = self.head.rfind(b"\r\n", 0, value_start) + 2
+            yield self.head[line_start:value_start - 1].decode("utf-8", "replace")
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+
 class Request:
 
+    # one per request, slots instead of a __dict__ per instance
+    # cookie_jar : the parsed Cookie header, None until a handler asks for request.cookies
+    __slots__ = ("method", "http_version", "path", "query_string", "path_params", "headers", "body", "cookie_jar")
+
     def __init__(self, request : bytes) -> None:
         # TODO: parse the bytes of the request and populate the following instance variables
 
@@ -17,57 +101,91 @@ class Request:
         headers_and_body : list[bytes] = request.split(b'\r\n\r\n', 1)
         self.body : bytes = headers_and_body[1]
 
-        # split headers on \r\n (surely \r\n cannot be used as a value to a header ?)
-        headers : list[bytes] = headers_and_body[0].split(b'\r\n')
+        self.parse_head(headers_and_body[0])
+
+    @classmethod
+    def from_head(cls, head : bytes) -> "Request":
+        # used by util.request_parser.RequestParser, which finds the end of the headers itself
+        # and fills in request.body once all of the body bytes have arrived
+        request : Request = cls.__new__(cls)
+        request.body = b""
+        request.parse_head(head)
+        return request
+
+    def parse_head(self, head : bytes) -> None:
+        # head is everything before the \r\n\r\n (request line + headers)
+
+        # the request line ends at the first \r\n, the header lines follow it
+        # (surely \r\n cannot be used as a value to a header ?)
+        request_line_end : int = head.find(b'\r\n')
+        if request_line_end == -1:
+            request_line_end = len(head)
 
         # split the first line of the headers by the first 2 whitespaces
         # the three resulting parts is the method, path, and http_version
         # use split : https://docs.python.org/3/library/stdtypes.html#bytes.split
-        request_line_parts : list[bytes] = (headers[0]
+        request_line_parts : list[bytes] = (head[:request_line_end]
                                      .split(b' '))
         # looks like: [b"POST", b"/api/chats", b"HTTP/1.1"]
 
         # bytes to str : https://docs.python.org/3/library/stdtypes.html#bytes.decode
         self.method : str = request_line_parts[0].decode('utf-8')
-        self.path : str = request_line_parts[1].decode('utf-8')
         self.http_version : str = request_line_parts[2].decode('utf-8')
 
-        ####################################
+        # the query string isn't part of the path the router matches on
+        # "/api/chats?since=5" => path "/api/chats", query_string "since=5"
+        target : str = request_line_parts[1].decode('utf-8')
+        self.path, _, self.query_string = target.partition('?')
 
-        self.headers: dict[str, str] = {}
-        self.cookies: dict[str, str] = {}
+        # filled in by the Router from "{name}" segments of the matched route
+        self.path_params : dict[str, str] = {}
+
+        ####################################
 
         # what headers look like:
-        #  [b"Host: localhost:8080",
-        #  b"Content-Type: application/json",
-        #  b"Content-Length: 18",
-        #  b"Cookie: id=123; theme=dark",
-        #  b"Origin: http://localhost:8080"]
-
-        # every subsequent line in headers:
-        # retrieve content from after the :, left trim the whitespace, if it exists, and
-        # populate the dictionary
-        # if the header before the : is "Cookie", have to create a dictionary?
-        for header in headers[1:]: # skip the request line
-            # split on the 1st :, left trim the whitespace (if it exists) of second elemnt
-            header_parts : list[bytes] = header.split(b':', 1)
-            header_key : str = header_parts[0].decode('utf-8')
-            header_value : str = (header_parts[1]
-                                    .lstrip() # https://docs.python.org/3/library/stdtypes.html#bytes.lstrip
-                                    .decode('utf-8'))
-
-            # handle cookies
-            # example header value: "id=123; theme=dark"
-            if header_key == 'Cookie':
-                # split by b';'
-                # for every key-value pair, lstrip, split by "=", store in dict
-                key_value_pairs : list[str] = header_value.split(';')
-                for kv in key_value_pairs:
-                    kv = kv.lstrip()
-                    key_and_value : list[str] = kv.split('=', 1)
-                    self.cookies[key_and_value[0]] = key_and_value[1]
-
-            self.headers[header_key] = header_value
+        #  b"Host: localhost:8080\r\n
+        #  Content-Type: application/json\r\n
+        #  Content-Length: 18\r\n
+        #  Cookie: id=123; theme=dark\r\n
+        #  Origin: http://localhost:8080"
+        # Headers finds where every header is, values are only decoded when they're asked for
+        self.headers : Headers = Headers(head)
+
+        # the "Cookie" header is only split into a dictionary when request.cookies is used
+        self.cookie_jar : dict[str, str] | None = None
+
+    @property
+    def cookies(self) -> dict[str, str]:
+        # cookies from the Cookie header, parsed the first time they're asked for
+        if self.cookie_jar is None:
+            self.cookie_jar = parse_cookies(self.headers.get('Cookie', ''))
+        return self.cookie_jar
+
+    def get_query(self, name : str, default : str | None = None) -> str | None:
+        # value of ?name=value in the query string (parsed when a handler asks for it)
+        if self.query_string == "":
+            return default
+        values : list[str] | None = urllib.parse.parse_qs(self.query_string).get(name)
+        if values is None:
+            return default
+        return values[0]
+
+    def get_header(self, name : str, default : str | None = None) -> str | None:
+        # header names are case-insensitive (same as request.headers.get)
+        return self.headers.get(name, default)
+
+
+def parse_cookies(header_value : str) -> dict[str, str]:
+    # example header value: "id=123; theme=dark"
+    # split by ';'
+    # for every key-value pair, lstrip, split by "=", store in dict
+    # (pairs without a "=" aren't cookies, they're skipped)
+    cookies : dict[str, str] = {}
+    for kv in header_value.split(';'):
+        key, equals, value = kv.lstrip().partition('=')
+        if equals:
+            cookies[key] = value
+    return cookies
 
 def test1():
     request = Request(b'GET / HTTP/1.1\r\nHost: localhost:8080\r\nConnection: keep-alive\r\n\r\n')
@@ -93,6 +211,32 @@ def test2():
     assert request.body == b'{"content":"test"}'
     print("test2 passed")
 
+def test3():
+    # cookies are only parsed when asked for, repeated Cookie headers add up, broken pairs are skipped
+    request = Request(b'GET / HTTP/1.1\r\nCookie: id=123; junk\r\ncookie: lang=en\r\nCookie: theme=dark\r\n\r\n')
+    assert request.cookie_jar is None
+    assert request.cookies == {"id": "123", "lang": "en", "theme": "dark"}
+    assert request.cookies is request.cookie_jar
+    assert Request(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n').cookies == {}
+    print("test3 passed")
+
+def test4():
+    # names are case-insensitive, repeated headers are kept, values are stripped
+    request = Request(b'GET / HTTP/1.1\r\ncontent-length:  0 \r\nAccept: text/html\r\nX-Tag: a\r\naccept: */*\r\n\r\n')
+    assert request.get_header("Content-Length") == "0"
+    assert request.headers["ACCEPT"] == "text/html, */*"
+    assert request.headers.get_all("Accept") == ["text/html", "*/*"]
+    assert "x-tag" in request.headers and "Host" not in request.headers
+    assert request.get_header("Host", "none") == "none"
+    assert list(request.headers) == ["content-length", "Accept", "X-Tag"]
+    assert dict(request.headers.items())["Accept"] == "text/html, */*"
+
+    assert list(Request(b'GET / HTTP/1.1\r\nno colon here\r\n\r\n').headers) == []
+    assert len(request.headers) == 3 and len(Request(b'GET / HTTP/1.1\r\n\r\n').headers) == 0
+    print("test4 passed")
+
 if __name__ == '__main__':
     test1()
     test2()
+    test3()
+    test4()
@@ -0,0 +1,304 @@
+import os
+
+from util.request import Request
+
+# size limits, anything bigger is rejected as soon as we know about it
+# (before reading the rest of it off the socket)
+MAX_HEADER_SIZE : int = int(os.environ.get("MAX_HEADER_SIZE", str(16 * 1024)))
+MAX_BODY_SIZE : int = int(os.environ.get("MAX_BODY_SIZE", str(1024 * 1024)))
+
+# parser states
+READING_HEAD : int = 0
+READING_BODY : int = 1          # Content-Length body, read straight into a preallocated buffer
+READING_CHUNK_SIZE : int = 2    # Transfer-Encoding: chunked
+READING_CHUNK_DATA : int = 3
+READING_CHUNK_END : int = 4     # the \r\n after every chunk's data
+READING_TRAILERS : int = 5
+
+
+class ParseError(Exception):
+    # the request can't be parsed/accepted, status_code + message are sent back to the client
+    def __init__(self, status_code : int, status_message : str, text : str) -> None:
+        super().__init__(text)
+        self.status_code : int = status_code
+        self.status_message : str = status_message
+        self.text : str = text
+
+
+class RequestParser:
+    # incremental HTTP request parser
+    #
+    # bytes are fed in as they come off the socket:
+    #   parser.feed(data)
+    #   request = parser.next_request()  # None until a whole request has arrived
+    #
+    # while a Content-Length body is being read, parser.body_buffer() returns a memoryview
+    # of the part of the body that hasn't arrived yet, so the socket can recv_into() it directly:
+    #   n = sock.recv_into(parser.body_buffer())
+    #   parser.body_received(n)
+    #
+    # anything after the end of a request stays buffered, so pipelined requests come out
+    # of next_request() one after another
+
+    def __init__(self, max_header_size : int = MAX_HEADER_SIZE, max_body_size : int = MAX_BODY_SIZE) -> None:
+        self.max_header_size : int = max_header_size
+        self.max_body_size : int = max_body_size
+
+        # bytes received but not used yet
+        self.buffer : bytearray = bytearray()
+
+        # how far into self.buffer we already looked for the \r\n\r\n
+        self.scanned : int = 0
+
+        self.state : int = READING_HEAD
+        self.request : Request | None = None
+
+        # Content-Length bodies: preallocated, filled in place
+        self.body : bytearray = bytearray()
+        self.body_filled : int = 0
+
+        # chunked bodies: size is unknown up front
+        self.chunk_remaining : int = 0
+
+    def feed(self, data : bytes) -> None:
+        self.buffer += data
+
+    def body_buffer(self) -> memoryview | None:
+        # the not-yet-received part of a Content-Length body, or None when not reading one
+        if self.state != READING_BODY or len(self.buffer) > 0:
+            return None
+        return memoryview(self.body)[self.body_filled:]
+
+    def body_received(self, count : int) -> None:
+        # count bytes were written into body_buffer()
+        self.body_filled += count
+
+    def next_request(self) -> Request | None:
+        # keep going through the states until a request is complete or more bytes are needed
+        while True:
+            if self.state == READING_HEAD:
+                if not self.parse_head():
+                    return None
+
+            elif self.state == READING_BODY:
+                if not self.fill_body():
+                    return None
+                return self.finish_request()
+
+            elif self.state == READING_CHUNK_SIZE:
+                if not self.parse_chunk_size():
+                    return None
+
+            elif self.state == READING_CHUNK_DATA:
+                if not self.read_chunk_data():
+                    return None
+
+            elif self.state == READING_CHUNK_END:
+                if len(self.buffer) < 2:
+                    return None
+                if self.buffer[:2] != b"\r\n":
+                    raise ParseError(400, "Bad Request", "Malformed chunked body")
+                del self.buffer[:2]
+                self.state = READING_CHUNK_SIZE
+
+            elif self.state == READING_TRAILERS:
+                done : bool | None = self.skip_trailer()
+                if done is None:
+                    return None
+                if done:
+                    return self.finish_request()
+
+    def parse_head(self) -> bool:
+        # only look at the bytes we haven't scanned yet (minus 3 in case the \r\n\r\n was split between reads)
+        header_end : int = self.buffer.find(b"\r\n\r\n", max(0, self.scanned - 3))
+        if header_end == -1:
+            self.scanned = len(self.buffer)
+            if self.scanned > self.max_header_size:
+                raise ParseError(431, "Request Header Fields Too Large", "Request headers are too large")
+            return False
+
+        if header_end > self.max_header_size:
+            raise ParseError(431, "Request Header Fields Too Large", "Request headers are too large")
+
+        with memoryview(self.buffer) as view:
+            head : bytes = bytes(view[:header_end])
+        del self.buffer[:header_end + 4]
+        self.scanned = 0
+
+        try:
+            self.request = Request.from_head(head)
+        except (IndexError, UnicodeDecodeError):
+            raise ParseError(400, "Bad Request", "Malformed request")
+
+        transfer_encoding : str = self.request.get_header("Transfer-Encoding", "").lower()
+        content_length : str = self.request.get_header("Content-Length", "0").strip()
+
+        if "chunked" in transfer_encoding:
+            self.body = bytearray()
+            self.state = READING_CHUNK_SIZE
+            return True
+
+        try:
+            length : int = int(content_length)
+        except ValueError:
+            raise ParseError(400, "Bad Request", "Invalid Content-Length")
+        if length < 0:
+            raise ParseError(400, "Bad Request", "Invalid Content-Length")
+        if length > self.max_body_size:
+            # don't even wait for the body
+            raise ParseError(413, "Content Too Large", "Request body is too large")
+
+        if len(self.buffer) >= length:
+            # whole body already arrived with the headers, no need for a separate buffer
+            with memoryview(self.buffer) as view:
+                self.request.body = bytes(view[:length])
+            del self.buffer[:length]
+            self.state = READING_BODY
+            return True
+
+        # preallocate the whole body, then copy whatever already arrived behind the headers
+        self.body = bytearray(length)
+        self.body_filled = 0
+        self.state = READING_BODY
+        return True
+
+    def fill_body(self) -> bool:
+        if len(self.body) == 0:
+            # body (if any) was taken straight out of self.buffer
+            return True
+        needed : int = len(self.body) - self.body_filled
+        if needed > 0 and len(self.buffer) > 0:
+            take : int = min(needed, len(self.buffer))
+            self.body[self.body_filled:self.body_filled + take] = memoryview(self.buffer)[:take]
+            del self.buffer[:take]
+            self.body_filled += take
+        return self.body_filled == len(self.body)
+
+    def parse_chunk_size(self) -> bool:
+        line_end : int = self.buffer.find(b"\r\n")
+        if line_end == -1:
+            if len(self.buffer) > self.max_header_size:
+                raise ParseError(400, "Bad Request", "Malformed chunked body")
+            return False
+
+        # chunk extensions (";name=value") are allowed after the size, ignore them
+        size_text : bytes = bytes(self.buffer[:line_end]).split(b";", 1)[0].strip()
+        del self.buffer[:line_end + 2]
+        try:
+            chunk_size : int = int(size_text, 16)
+        except ValueError:
+            raise ParseError(400, "Bad Request", "Malformed chunked body")
+
+        if chunk_size == 0:
+            self.state = READING_TRAILERS
+            return True
+
+        if len(self.body) + chunk_size > self.max_body_size:
+            raise ParseError(413, "Content Too Large", "Request body is too large")
+
+        self.chunk_remaining = chunk_size
+        self.state = READING_CHUNK_DATA
+        return True
+
+    def read_chunk_data(self) -> bool:
+        take : int = min(self.chunk_remaining, len(self.buffer))
+        if take == 0:
+            return False
+        self.body += memoryview(self.buffer)[:take]
+        del self.buffer[:take]
+        self.chunk_remaining -= take
+        if self.chunk_remaining == 0:
+            self.state = READING_CHUNK_END
+        return True
+
+    def skip_trailer(self) -> bool | None:
+        # trailer lines after the last chunk, ended by an empty line
+        # returns None if more bytes are needed, True once the empty line was read
+        line_end : int = self.buffer.find(b"\r\n")
+        if line_end == -1:
+            if len(self.buffer) > self.max_header_size:
+                raise ParseError(431, "Request Header Fields Too Large", "Request trailers are too large")
+            return None
+        del self.buffer[:line_end + 2]
+        return line_end == 0
+
+    def finish_request(self) -> Request:
+        # self.body is empty when the whole body was already in self.buffer (see parse_head)
+        request : Request = self.request
+        if len(self.body) > 0:
+            request.body = bytes(self.body)
+
+        # reset for the next (possibly pipelined) request, self.buffer keeps any leftover bytes
+        self.request = None
+        self.body = bytearray()
+        self.body_filled = 0
+        self.chunk_remaining = 0
+        self.state = READING_HEAD
+        return request
+
+
+def test1():
+    # request split across several feeds, with the \r\n\r\n split between two of them
+    parser = RequestParser()
+    parser.feed(b'POST /api/chats HTTP/1.1\r\nHost: localhost:8080\r\nContent-Length: 18\r\n\r')
+    assert parser.next_request() is None
+    parser.feed(b'\n{"content":')
+    assert parser.next_request() is None
+    parser.feed(b'"asdf"}')
+    request = parser.next_request()
+    assert request.method == "POST"
+    assert request.headers["Host"] == "localhost:8080"
+    assert request.body == b'{"content":"asdf"}'
+    print("test1 passed")
+
+def test2():
+    # pipelined requests in one read come out in order
+    parser = RequestParser()
+    parser.feed(b'GET /a HTTP/1.1\r\n\r\nPOST /b HTTP/1.1\r\nContent-Length: 2\r\n\r\nhiGET /c HTTP/1.1\r\n\r\n')
+    assert [parser.next_request().path for _ in range(3)] == ["/a", "/b", "/c"]
+    assert parser.next_request() is None
+    print("test2 passed")
+
+def test3():
+    # chunked body
+    parser = RequestParser()
+    parser.feed(b'POST /api/chats HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n4\r\nWiki\r\n5;ext=1\r\npedia\r\n0\r\n\r\n')
+    assert parser.next_request().body == b"Wikipedia"
+    print("test3 passed")
+
+def test4():
+    # body bytes received straight into the preallocated buffer
+    parser = RequestParser()
+    parser.feed(b'PATCH /api/nickname HTTP/1.1\r\nContent-Length: 5\r\n\r\n')
+    assert parser.next_request() is None
+    view = parser.body_buffer()
+    view[:5] = b"hello"
+    parser.body_received(5)
+    assert parser.next_request().body == b"hello"
+    print("test4 passed")
+
+def test5():
+    # size limits are enforced before the body arrives
+    parser = RequestParser(max_body_size=10)
+    parser.feed(b'POST / HTTP/1.1\r\nContent-Length: 11\r\n\r\n')
+    try:
+        parser.next_request()
+        assert False
+    except ParseError as e:
+        assert e.status_code == 413
+
+    parser = RequestParser(max_header_size=32)
+    parser.feed(b'GET / HTTP/1.1\r\nHost: a-very-long-host-name.example.com\r\n')
+    try:
+        parser.next_request()
+        assert False
+    except ParseError as e:
+        assert e.status_code == 431
+    print("test5 passed")
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
+    test4()
+    test5()
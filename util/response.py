@@ -1,12 +1,35 @@
+import itertools
 import json
+import time
+from collections.abc import Iterator
+from types import MappingProxyType
 
 from pymongo.response import Response
+from util.compression import COMPRESSION_MIN_SIZE, compress, compress_stream, is_compressible, negotiate
+from util.metrics import add_time, record_sent
+
+# stream() bodies are sent in chunks of about this many bytes (small pieces are put together first)
+STREAM_CHUNK_SIZE : int = 16 * 1024
+
+# every Response starts out sharing these (read-only), the first header/cookie it sets makes it its own copy
+# default Content-Type is "text/plain; charset=utf-8"
+# Content-Length is filled in by head()
+DEFAULT_HEADERS = MappingProxyType({
+    "Content-Type" : "text/plain; charset=utf-8",
+    "Content-Length" : "0",
+    "X-Content-Type-Options": "nosniff" # Week 2.2 Slide 22
+})
+NO_COOKIES = MappingProxyType({})
 
 class Response:
 
     # example response from Week 2.1 Lecture Slides
     # HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 5\r\n\r\nhello
 
+    # one per request, slots instead of a __dict__ per instance
+    __slots__ = ("http_version", "status_code", "status_message", "final_headers", "final_cookies", "body",
+                 "body_file", "body_open_ended", "body_stream")
+
     def __init__(self) -> None:
         # set defaults for:
         # http version, status code, status message
@@ -16,18 +39,24 @@ class Response:
         self.status_code : int = 200
         self.status_message : str = "OK"
 
-        # default Content-Type is "text/plain; charset=utf-8"
         # had to rename so not confused with the function .headers()
-        self.final_headers : dict[str, str] = {
-            "Content-Type" : "text/plain; charset=utf-8",
-            "Content-Length" : "0",
-            "X-Content-Type-Options": "nosniff" # Week 2.2 Slide 22
-        }
+        # DEFAULT_HEADERS until one is set, change it with set_header() / headers()
+        self.final_headers : dict[str, str] = DEFAULT_HEADERS
 
         # had to rename bc naming conflicts
-        self.final_cookies : dict[str, str] = {}
+        # NO_COOKIES until cookies() is called
+        self.final_cookies : dict[str, str] = NO_COOKIES
         self.body : bytes = b""
 
+        # set by file(): (open binary file, offset, count) sent with sendfile() instead of self.body
+        self.body_file : tuple | None = None
+
+        # set by open_ended(): body is written to the socket after the head until the connection closes
+        self.body_open_ended : bool = False
+
+        # set by stream(): iterable of bytes sent by send() with Transfer-Encoding: chunked instead of self.body
+        self.body_stream = None
+
         # Set-Cookie ????
 
     def set_status(self, code : int, text : str) -> Response:
@@ -39,12 +68,23 @@ class Response:
     def headers(self, headers : dict[str, str]) -> Response:
         # adds/changes key-value pairs from dict as headers of response
         # handles all headers EXCEPT Set-Cookie
+        if self.final_headers is DEFAULT_HEADERS:
+            self.final_headers = dict(DEFAULT_HEADERS)
         self.final_headers.update(headers)
         return self
 
+    def set_header(self, name : str, value : str) -> Response:
+        # one header, copies the shared defaults first if they haven't been yet
+        if self.final_headers is DEFAULT_HEADERS:
+            self.final_headers = dict(DEFAULT_HEADERS)
+        self.final_headers[name] = value
+        return self
+
     def cookies(self, cookies : dict[str, str]) -> Response:
         # adds key-value pairs from dict as cookies of response
         # multiple calls has to maintain previous cookies
+        if self.final_cookies is NO_COOKIES:
+            self.final_cookies = {}
         self.final_cookies.update(cookies)
 
         # Week 2.3 Slides
@@ -65,26 +105,157 @@ class Response:
 
     def bytes(self, data : bytes) -> Response:
         # appends input to end of body of response as bytes
+        # (Content-Length comes from the body in head())
         self.body += data
-        self.final_headers["Content-Length"] = str(len(self.body))
         return self
 
     def text(self, data : str) -> Response:
         # appends input to end of body of response as bytes
         # multiple calls maintains body
         self.body += data.encode("utf-8")
-        self.final_headers["Content-Length"] = str(len(self.body))
         return self
 
     def json(self, data : dict | list) -> Response:
         # sets body of response to input converted to json as bytes
         # replaces old body always
         # sets Content-Type to "application/json"
+        started : float = time.perf_counter()
         self.body : bytes = json.dumps(data).encode("utf-8")
-        self.final_headers["Content-Type"] = "application/json"
-        self.final_headers["Content-Length"] = str(len(self.body))
+        add_time("serialize", started)
+        self.set_header("Content-Type", "application/json")
+        return self
+
+    def compress(self, request) -> Response:
+        # compresses the body if the client accepts it (Accept-Encoding of request),
+        # the Content-Type is worth compressing, and the body is at least COMPRESSION_MIN_SIZE
+        # call after the body is set
+        content_type : str = self.final_headers.get("Content-Type", "")
+        if not is_compressible(content_type):
+            return self
+
+        # the answer depends on Accept-Encoding even when it isn't compressed
+        self.set_header("Vary", "Accept-Encoding")
+        if "Content-Encoding" in self.final_headers:
+            return self
+
+        if self.body_stream is not None:
+            # the size isn't known up front: take pieces until there's COMPRESSION_MIN_SIZE of them and
+            # compress the rest as it goes, a stream that ends before that is sent as a plain body
+            encoding : str | None = negotiate(request.get_header("Accept-Encoding"))
+            if encoding is None:
+                return self
+            started : float = time.perf_counter()
+            pieces_left = iter(self.body_stream)
+            first_pieces : list[bytes] = []
+            size : int = 0
+            for piece in pieces_left:
+                first_pieces.append(piece)
+                size += len(piece)
+                if size >= COMPRESSION_MIN_SIZE:
+                    break
+            add_time("serialize", started)
+            if size < COMPRESSION_MIN_SIZE:
+                self.body = b"".join(first_pieces)
+                self.body_stream = None
+                return self
+            self.body_stream = compress_stream(itertools.chain(first_pieces, pieces_left), encoding)
+            self.set_header("Content-Encoding", encoding)
+            return self
+
+        if len(self.body) < COMPRESSION_MIN_SIZE:
+            return self
+
+        encoding = negotiate(request.get_header("Accept-Encoding"))
+        if encoding is not None:
+            started : float = time.perf_counter()
+            self.body = compress(self.body, encoding)
+            add_time("serialize", started)
+            self.set_header("Content-Encoding", encoding)
+        return self
+
+    def open_ended(self) -> Response:
+        # no Content-Length, the body continues after to_data() until the connection is closed
+        # (used for text/event-stream)
+        self.body = b""
+        self.body_open_ended = True
+        return self
+
+    def stream(self, chunks, request) -> Response:
+        # body is the bytes from chunks (any iterable, e.g. a generator), sent by send() as they're made
+        # with Transfer-Encoding: chunked, so the whole body is never in memory at once
+        # HTTP/1.0 clients don't know chunked, they get it all joined into one body
+        # replaces old body always
+        self.body = b""
+        if request.http_version == "HTTP/1.1":
+            self.body_stream = chunks
+        else:
+            self.body = b"".join(chunks)
+        return self
+
+    def json_stream(self, data : dict | list, request) -> Response:
+        # json() sent with stream(): lists and iterators (generators, map()) in data are encoded one item at a time
+        self.set_header("Content-Type", "application/json")
+        return self.stream(json_chunks(data), request)
+
+    def file(self, file_obj, offset : int, count : int) -> Response:
+        # body is count bytes of file_obj starting at offset, sent straight from the
+        # file descriptor by send() (the file is never read into Python memory)
+        # replaces old body always, caller keeps file_obj open until send() returns
+        self.body = b""
+        self.body_file = (file_obj, offset, count)
         return self
 
+    def send(self, sock) -> None:
+        # sends the whole response on sock
+        # same as sock.sendall(self.to_data()), plus the body of file() and stream() responses
+        # the head and body go to the kernel as separate buffers, so the body is never copied
+        if self.body_stream is not None:
+            self.send_chunked(sock)
+            return
+        head : bytes = self.head()
+        if len(self.body) < SENDMSG_MIN_SIZE:
+            # copying a small body is cheaper than sendmsg() + memoryviews
+            sock.sendall(head + self.body)
+        else:
+            send_buffers(sock, [head, self.body])
+        record_sent(self.status_code, len(head) + len(self.body))
+        if self.body_file is not None:
+            file_obj, offset, count = self.body_file
+            if count > 0:
+                # os.sendfile when the platform has it, read+send otherwise
+                sock.sendfile(file_obj, offset, count)
+                record_sent(self.status_code, count)
+
+    def send_chunked(self, sock) -> None:
+        # head, then every STREAM_CHUNK_SIZE bytes of body_stream as one chunk: <size in hex>\r\n<data>\r\n
+        # then the last chunk (size 0), the connection can be kept alive afterwards
+        out : bytes = self.head()
+        pieces : list[bytes] = []
+        size : int = 0
+        sent : int = 0
+        pieces_left = iter(self.body_stream)
+        while True:
+            # making the pieces (JSON encoding, compression) is serialization time, sending them isn't
+            started : float = time.perf_counter()
+            piece : bytes | None = next(pieces_left, None)
+            add_time("serialize", started)
+            if piece is None:
+                break
+            pieces.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE:
+                out += chunk_frame(b"".join(pieces))
+                sock.sendall(out)
+                sent += len(out)
+                out = b""
+                pieces = []
+                size = 0
+        if size > 0:
+            out += chunk_frame(b"".join(pieces))
+        out += b"0\r\n\r\n"
+        sock.sendall(out)
+        record_sent(self.status_code, sent + len(out))
+
     def to_data(self) -> bytes:
         # contains entire response, properly formatted by HTTP
         # all headers, cookies, status code, status message, body, and Content-Length header
@@ -94,43 +265,120 @@ class Response:
         # HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 5\r\n\r\nhello
 
         # response = headers + \r\n + body
+        # (copies the body, send() doesn't, and only send() counts the bytes for util/metrics.py)
+        return self.head() + self.body
+
+    def to_buffers(self) -> list[bytes]:
+        # to_data() without joining: [head, body]
+        if len(self.body) == 0:
+            return [self.head()]
+        return [self.head(), self.body]
 
-        # headers = first line (status line) + rest of the lines
-        # first line = http_version + status code + status message (with spaces)
-        status_line : bytes = (("" +
-                                self.http_version +
-                                " " +
-                                str(self.status_code) +
-                                " " +
-                                self.status_message +
-                                "\r\n")
-                               .encode("utf-8"))
+    def head(self) -> bytes:
+        # status line + headers + Set-Cookie's + the blank line, everything before the body
+        started : float = time.perf_counter()
 
         # make sure Content-Length is correct?
-        self.final_headers["Content-Length"] = str(len(self.body))
+        # it's worked out here and put where final_headers has it (final_headers isn't changed, it may be
+        # the shared DEFAULT_HEADERS)
+        # 304 Not Modified has no body, and its Content-Length would have to be
+        # the length of the body it stands in for, so leave it out
+        # stream(): head() is all of to_data(), send() writes the chunks
+        content_length : str | None
+        if self.status_code == 304 or self.body_open_ended or self.body_stream is not None:
+            content_length = None
+        elif self.body_file is not None:
+            content_length = str(self.body_file[2])
+        else:
+            content_length = str(len(self.body))
 
         # rest of the headers:
         # go through every header + ": " + content for that header (don't know how to handle directives)
-        headers : bytes = b""
+        # built as one list of strings and encoded once (adding bytes together one header at a time
+        # copies everything before it every time)
+        lines : list[str] = []
         for key, value in self.final_headers.items():
-            new_header : bytes = ((key + ": " + value + "\r\n")
-                                  .encode("utf-8"))
-            headers += new_header
-
-        # final header will always add a b"\r\n" to the end
+            if key == "Content-Length":
+                if content_length is not None:
+                    lines.append("Content-Length: " + content_length + "\r\n")
+            else:
+                lines.append(key + ": " + value + "\r\n")
+        if self.body_stream is not None:
+            lines.append("Transfer-Encoding: chunked\r\n")
 
         # add "Set-Cookie:'s" to the end
-        if len(self.final_cookies) > 0:
-            set_cookie: bytes = b"Set-Cookie: "
-            for key, value in self.final_cookies.items():
-                if key == "HttpOnly" or key == "Secure":
-                    headers += b"Set-Cookie: " + (key + "\r\n").encode("utf-8")
-                else:
-                    headers += b"Set-Cookie: " + (key + "=" + value + "\r\n").encode("utf-8")
-
-        # add body
-        t : bytes = status_line + headers + b"\r\n" + self.body
-        return t
+        lines += cookie_lines(self.final_cookies)
+
+        # final header will always add a b"\r\n" to the end
+        lines.append("\r\n")
+        head : bytes = get_status_line(self.http_version, self.status_code, self.status_message) + "".join(lines).encode("utf-8")
+        add_time("serialize", started)
+        return head
+
+def cookie_lines(cookies : dict[str, str]) -> list[str]:
+    # one "Set-Cookie: key=value\r\n" per cookie (HttpOnly and Secure are directives, no value)
+    lines : list[str] = []
+    for key, value in cookies.items():
+        if key == "HttpOnly" or key == "Secure":
+            lines.append("Set-Cookie: " + key + "\r\n")
+        else:
+            lines.append("Set-Cookie: " + key + "=" + value + "\r\n")
+    return lines
+
+# encoded status lines, built the first time each one is used
+# (the repo only uses a handful of fixed code/message pairs)
+STATUS_LINES : dict[tuple[str, int, str], bytes] = {}
+
+def get_status_line(http_version : str, status_code : int, status_message : str) -> bytes:
+    # first line = http_version + status code + status message (with spaces)
+    key : tuple[str, int, str] = (http_version, status_code, status_message)
+    status_line : bytes | None = STATUS_LINES.get(key)
+    if status_line is None:
+        status_line = (http_version + " " + str(status_code) + " " + status_message + "\r\n").encode("utf-8")
+        STATUS_LINES[key] = status_line
+    return status_line
+
+# bodies smaller than this are added to the head and sent with sendall() instead
+SENDMSG_MIN_SIZE : int = 64 * 1024
+
+def send_buffers(sock, buffers : list[bytes]) -> None:
+    # sendall() for a list of buffers, in one sendmsg() (writev) call when the kernel takes it all
+    # nothing is joined, so big bodies aren't copied
+    if not hasattr(sock, "sendmsg"):
+        # sendmsg isn't on every platform (or every socket-like object)
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    views : list[memoryview] = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+    while len(views) > 0:
+        sent : int = sock.sendmsg(views)
+        # the kernel may take only part of it, drop what went out and send the rest
+        while len(views) > 0 and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent > 0:
+            views[0] = views[0][sent:]
+
+def chunk_frame(data : bytes) -> bytes:
+    # one chunk of a Transfer-Encoding: chunked body
+    return format(len(data), "x").encode("ascii") + b"\r\n" + data + b"\r\n"
+
+def json_chunks(data):
+    # json.dumps(data) a piece at a time, same output
+    # dicts are walked key by key, lists and iterators one item per piece (each item is dumped whole)
+    if isinstance(data, dict):
+        yield b"{"
+        for index, (key, value) in enumerate(data.items()):
+            yield (b", " if index > 0 else b"") + json.dumps(str(key)).encode("utf-8") + b": "
+            yield from json_chunks(value)
+        yield b"}"
+    elif isinstance(data, (list, tuple, Iterator)):
+        yield b"["
+        for index, item in enumerate(data):
+            yield (b", " if index > 0 else b"") + json.dumps(item).encode("utf-8")
+        yield b"]"
+    else:
+        yield json.dumps(data).encode("utf-8")
 
 def test1():
     res = Response()
@@ -230,6 +478,84 @@ def test5():
     actual = res.to_data()
     print(actual)
 
+def test6():
+    data = {"messages": [{"id": "a", "reactions": {"👍": ["x"]}}, {"id": "b"}], "cursor": 3, "has_more": False}
+    assert b"".join(json_chunks(data)) == json.dumps(data).encode("utf-8")
+    lazy = {"messages": map(lambda n: {"n": n}, range(3))}
+    assert b"".join(json_chunks(lazy)) == json.dumps({"messages": [{"n": 0}, {"n": 1}, {"n": 2}]}).encode("utf-8")
+
+    class FakeSocket:
+        def __init__(self):
+            self.sent = b""
+        def sendall(self, data):
+            self.sent += data
+
+    class FakeRequest:
+        http_version = "HTTP/1.1"
+
+    sock = FakeSocket()
+    Response().stream(iter([b"hello ", b"world"]), FakeRequest()).send(sock)
+    assert b"Transfer-Encoding: chunked" in sock.sent and b"Content-Length" not in sock.sent
+    assert sock.sent.endswith(b"\r\n\r\nb\r\nhello world\r\n0\r\n\r\n")
+
+    FakeRequest.http_version = "HTTP/1.0"
+    sock = FakeSocket()
+    Response().stream(iter([b"hello ", b"world"]), FakeRequest()).send(sock)
+    assert b"Content-Length: 11\r\n" in sock.sent and sock.sent.endswith(b"\r\n\r\nhello world")
+
+    # compress(): a stream under COMPRESSION_MIN_SIZE is sent as is, with a Content-Length
+    FakeRequest.http_version = "HTTP/1.1"
+    FakeRequest.get_header = lambda self, name, default=None: "gzip"
+    sock = FakeSocket()
+    Response().json_stream({"messages": [], "cursor": 3}, FakeRequest()).compress(FakeRequest()).send(sock)
+    assert b"Content-Encoding" not in sock.sent and b"Transfer-Encoding" not in sock.sent
+    assert sock.sent.endswith(b"\r\n\r\n" + json.dumps({"messages": [], "cursor": 3}).encode("utf-8"))
+    # a bigger one is compressed as it goes
+    import gzip
+    big = {"messages": [{"n": n} for n in range(COMPRESSION_MIN_SIZE)]}
+    sock = FakeSocket()
+    Response().json_stream(big, FakeRequest()).compress(FakeRequest()).send(sock)
+    head, _, chunked = sock.sent.partition(b"\r\n\r\n")
+    assert b"Content-Encoding: gzip" in head and b"Transfer-Encoding: chunked" in head
+    body : bytes = b""
+    while True:
+        size_line, _, chunked = chunked.partition(b"\r\n")
+        size = int(size_line, 16)
+        if size == 0:
+            break
+        body += chunked[:size]
+        chunked = chunked[size + 2:]
+    assert gzip.decompress(body) == json.dumps(big).encode("utf-8")
+    print("test6 passed")
+
+def test7():
+    # a body big enough for sendmsg(), through a real socket so partial sends happen
+    import socket
+    import threading
+
+    response = Response().bytes(bytes(range(256)) * 8192)
+    expected = response.to_data()
+    assert response.to_buffers()[1] is response.body
+
+    writer, reader = socket.socketpair()
+    received = []
+    def drain():
+        while True:
+            data = reader.recv(65536)
+            if len(data) == 0:
+                break
+            received.append(data)
+    thread = threading.Thread(target=drain)
+    thread.start()
+    response.send(writer)
+    writer.close()
+    thread.join()
+    reader.close()
+    assert b"".join(received) == expected
+
+    assert get_status_line("HTTP/1.1", 404, "Not Found") is get_status_line("HTTP/1.1", 404, "Not Found")
+    print("test7 passed")
+
 # add tests for actual key-value pairs for Cookies
 
 if __name__ == '__main__':
@@ -238,6 +564,8 @@ if __name__ == '__main__':
     test3()
     test4()
     test5()
+    test6()
+    test7()
 
 # Week 2.1 Slide 29: server can't handle a requested path\r\n
 # b"HTTP/1.1 404 Not Found\r\n
@@ -0,0 +1,53 @@
+from util.response import Response, cookie_lines
+from util.metrics import record_sent
+
+
+class PrebuiltResponse:
+    # a response that's the same bytes every time, serialized once when it's made
+    # (module-level constants next to the handlers that send them)
+    # sending it is one sendall(), the only per-request part allowed is Set-Cookie
+    #
+    # build it from the finished Response, don't change the Response afterwards (it isn't looked at again)
+
+    def __init__(self, response : Response) -> None:
+        data : bytes = response.to_data()
+        self.data : bytes = data
+        self.status_code : int = response.status_code
+
+        # split at the blank line, so Set-Cookie lines can go at the end of the head
+        # head ends with the "\r\n" of its last header, rest is "\r\n" + body
+        head_end : int = data.index(b"\r\n\r\n") + 2
+        self.head : bytes = data[:head_end]
+        self.rest : bytes = data[head_end:]
+
+    def send(self, sock, cookies : dict[str, str] | None = None) -> None:
+        # cookies : same as Response.cookies()
+        if not cookies:
+            sock.sendall(self.data)
+            record_sent(self.status_code, len(self.data))
+            return
+        data : bytes = self.head + "".join(cookie_lines(cookies)).encode("utf-8") + self.rest
+        sock.sendall(data)
+        record_sent(self.status_code, len(data))
+
+
+def test1():
+    class FakeSocket:
+        def __init__(self):
+            self.sent = b""
+        def sendall(self, data):
+            self.sent += data
+
+    prebuilt = PrebuiltResponse(Response().set_status(403, "Forbidden").text("nope"))
+    sock = FakeSocket()
+    prebuilt.send(sock)
+    assert sock.sent == Response().set_status(403, "Forbidden").text("nope").to_data()
+
+    prebuilt = PrebuiltResponse(Response().text("message updated"))
+    sock = FakeSocket()
+    prebuilt.send(sock, {"session": "abc", "Max-Age": "3600"})
+    assert sock.sent == Response().text("message updated").cookies({"session": "abc", "Max-Age": "3600"}).to_data()
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
@@ -1,55 +1,218 @@
 #from server import MyTCPHandler
+import time
+
 from util.request import Request
 from util.response import Response
+from util.response_cache import PrebuiltResponse
+from util.metrics import RequestTimer, get_timer, add_time
+import util.profiler as profiler
+
+# sent when no route matches the path
+NOT_FOUND_RESPONSE : PrebuiltResponse = PrebuiltResponse(Response()
+                                                         .set_status(404, "Not Found")
+                                                         .text("The requested content does not exist"))
 
 
 # helper class to contain all needed information about a Route
 class Route:
+    __slots__ = ("method", "path", "action", "exact_path", "segments", "has_params")
+
     def __init__(self, method : str, path : str, action, exact_path : bool = False) -> None:
         self.method : str = method
         self.path : str = path
         self.action = action # action : (Request, MyTCPHandler) -> None
         self.exact_path : bool = exact_path
 
+        # "/api/chats/{id}" -> ["api", "chats", "{id}"]
+        self.segments : list[str] = split_path(path)
+        self.has_params : bool = any(is_param(segment) for segment in self.segments)
+
+
+def split_path(path : str) -> list[str]:
+    # "/" -> [], "/api/chats/" -> ["api", "chats"]
+    return [segment for segment in path.split("/") if segment != ""]
+
+
+def is_param(segment : str) -> bool:
+    return segment.startswith("{") and segment.endswith("}")
+
+
+# one node per path segment in the route tree
+# "/public" and "/api/chats/{id}" share the root, "/api/chats" and "/api/reaction" share the "api" node
+class RouteNode:
+    __slots__ = ("children", "param_name", "param_child", "exact_routes", "prefix_routes")
+
+    def __init__(self) -> None:
+        self.children : dict[str, RouteNode] = {}
+
+        # child for a "{name}" segment, matches any one segment
+        self.param_name : str = ""
+        self.param_child : RouteNode | None = None
+
+        # routes whose path ends at this node, keyed by method
+        self.exact_routes : dict[str, Route] = {}      # path has to end here
+        self.prefix_routes : dict[str, Route] = {}     # anything below this node matches too
+
+
 class Router:
 
     def __init__(self) -> None:
-        # if multiple routes match the request, have to
-        # choose the first one that matches, so need a list
+        # every route, in the order they were added
         self.routes : list[Route] = []
 
+        # O(1) lookup for exact paths without parameters, keyed by (method, path)
+        self.exact_routes : dict[tuple[str, str], Route] = {}
+
+        # prefix routes and routes with {params} live in a tree of path segments
+        self.root : RouteNode = RouteNode()
+
     def add_route(self, method : str, path : str, action, exact_path : bool = False) -> None:
         # action is a function that handles request matching the method and path
         # action : (Request, MyTCPHandler) -> None
+        # exact_path=False routes match the path and anything below it ("/public" matches "/public/js/chat.js")
+        # "{name}" segments match any one segment and end up in request.path_params["name"]
         newRoute : Route = Route(method, path, action, exact_path)
         self.routes.append(newRoute)
+
+        # if the same method + path is added twice, the first one wins (like the old list scan)
+        if exact_path and not newRoute.has_params:
+            self.exact_routes.setdefault((method, "/" + "/".join(newRoute.segments)), newRoute)
+
+        node : RouteNode = self.root
+        for segment in newRoute.segments:
+            if is_param(segment):
+                if node.param_child is None:
+                    node.param_child = RouteNode()
+                    node.param_name = segment[1:-1]
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+
+        if exact_path:
+            node.exact_routes.setdefault(method, newRoute)
+        else:
+            node.prefix_routes.setdefault(method, newRoute)
         return
 
+    def match(self, method : str, path : str) -> tuple[Route | None, dict[str, str], list[str]]:
+        # returns (route, path params, allowed methods)
+        # route is None when nothing matches the method, allowed methods is then
+        # the methods that DO have a route for this path (empty => 404, otherwise 405)
+
+        # most requests hit an exact route, one dict lookup
+        route : Route | None = self.exact_routes.get((method, path))
+        if route is not None:
+            return route, {}, []
+
+        segments : list[str] = split_path(path)
+        params : dict[str, str] = {}
+        allowed : set[str] = set()
+        route = self.match_node(self.root, segments, 0, method, params, allowed)
+        if route is not None:
+            return route, params, []
+        return None, {}, sorted(allowed)
+
+    def match_node(self, node : RouteNode, segments : list[str], index : int, method : str,
+                   params : dict[str, str], allowed : set[str]) -> Route | None:
+        # walk down the tree, exact routes beat prefix routes and deeper (longer) prefixes
+        # beat shallower ones, static segments are tried before "{param}" segments
+        if index == len(segments):
+            route : Route | None = node.exact_routes.get(method) or node.prefix_routes.get(method)
+            if route is not None:
+                return route
+            allowed.update(node.exact_routes)
+            allowed.update(node.prefix_routes)
+            return None
+
+        segment : str = segments[index]
+
+        child : RouteNode | None = node.children.get(segment)
+        if child is not None:
+            route = self.match_node(child, segments, index + 1, method, params, allowed)
+            if route is not None:
+                return route
+
+        if node.param_child is not None:
+            route = self.match_node(node.param_child, segments, index + 1, method, params, allowed)
+            if route is not None:
+                params[node.param_name] = segment
+                return route
+
+        # nothing deeper matched, fall back to a prefix route ending at this node
+        route = node.prefix_routes.get(method)
+        if route is not None:
+            return route
+        allowed.update(node.prefix_routes)
+        return None
+
     def route_request(self, request : Request, handler) -> None:
         # handler : MyTCPHandler (can't import it without "circular import"
 
         # check the method and path of the request
         # determine "added route" to be used
         # call the function associated with that route with correct arguments
-        # send 404 Not Found response otherwise
-
-        # iterate through self.routes, until you find a matching Route object for the
-        # requested method and path (have to consider exact_path too)
-        # if you find a Route, call Route.action, otherwise send 404 Not Found
-        for route in self.routes:
-            if route.method == request.method: # do I have to worry about capitalization?
-                if route.exact_path and route.path == request.path:
-                    route.action(request, handler)
-                    # action won't return anything, so prevent future iterations from running
-                    return
-                elif (not route.exact_path) and request.path.startswith(route.path):
-                    route.action(request, handler)
-                    return
-
-        # if the appropriate action wasn't taken in the loop,
-        # respond with a 404
-        not_found_response : Response = Response()
-        not_found_response.set_status(404, "Not Found")
-        not_found_response.text("The requested content does not exist")
-        handler.request.sendall(not_found_response.to_data())
+        # send 404 Not Found (no route for the path) or 405 Method Not Allowed
+        # (path has routes, but not for this method) otherwise
+        # how long each part took goes to the request's RequestTimer (util/metrics.py)
+        started : float = time.perf_counter()
+        route, params, allowed = self.match(request.method, request.path)
+        add_time("route", started)
+        if route is not None:
+            timer : RequestTimer | None = get_timer()
+            if timer is not None:
+                timer.route = route.method + " " + route.path
+            request.path_params = params
+            started = time.perf_counter()
+            # while a profile is running (util/profiler.py) it gets to see which route this thread is in
+            session : profiler.ProfileSession | None = profiler.active_session
+            if session is None:
+                route.action(request, handler)
+            else:
+                session.call(route.method + " " + route.path, route.action, request, handler)
+            add_time("handler", started)
+            return
+
+        if len(allowed) > 0:
+            not_allowed_response : Response = Response()
+            not_allowed_response.set_status(405, "Method Not Allowed")
+            not_allowed_response.headers({"Allow": ", ".join(allowed)})
+            not_allowed_response.text("The requested method is not allowed for this content")
+            not_allowed_response.send(handler.request)
+            return
+
+        # if no route matched, respond with a 404
+        NOT_FOUND_RESPONSE.send(handler.request)
         return
+
+
+def test1():
+    def action(request, handler):
+        pass
+
+    router = Router()
+    router.add_route("GET", "/public", action, False)
+    router.add_route("GET", "/", action, True)
+    router.add_route("GET", "/api/chats", action, True)
+    router.add_route("PATCH", "/api/chats/{id}", action, True)
+    router.add_route("DELETE", "/api/chats/{id}", action, True)
+
+    route, params, allowed = router.match("GET", "/")
+    assert route.path == "/"
+    route, params, allowed = router.match("GET", "/public/js/chat.js")
+    assert route.path == "/public"
+    route, params, allowed = router.match("PATCH", "/api/chats/1234")
+    assert route.path == "/api/chats/{id}" and params == {"id": "1234"}
+
+    # path exists, wrong method => 405 with the allowed methods
+    route, params, allowed = router.match("POST", "/api/chats/1234")
+    assert route is None and allowed == ["DELETE", "PATCH"]
+
+    # nothing there => 404
+    route, params, allowed = router.match("GET", "/api/chats/1234/extra")
+    assert route is None and allowed == []
+    route, params, allowed = router.match("GET", "/publicity")
+    assert route is None and allowed == []
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()
@@ -0,0 +1,364 @@
+import asyncio
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from util.push import is_detached
+from util.keep_alive import IdleConnections, KEEP_ALIVE_TIMEOUT
+
+# the different ways server.py can accept and serve connections
+# picked at startup with the SERVER_MODE env variable
+#   serial  : the original single-threaded socketserver.TCPServer
+#   threads : bounded thread pool, a worker thread serves a connection while it has requests, idle
+#             keep-alive connections wait in one selector thread (util/keep_alive.py)
+#   prefork : one listening socket shared by several forked processes (one per core),
+#             each process running its own bounded thread pool
+#   asyncio : event loop owns the listening socket, admission and every open connection, a connection is
+#             handed to a bounded executor only while it has a request to serve (the route actions are
+#             blocking pymongo code), between requests it waits on the loop
+
+# every mode has its own limits:
+#   max_connections : connections being served at once (per process for prefork), keep-alive connections
+#                     waiting for their next request don't count (up to MAX_IDLE_CONNECTIONS, util/keep_alive.py)
+#   backlog         : how long the kernel accept queue can grow (listen() backlog)
+#   workers         : worker threads (per process for prefork)
+#   processes       : forked processes (prefork only)
+SERVER_MODES : dict[str, dict[str, int]] = {
+    "serial": {
+        "max_connections": 1,
+        "backlog": 5,           # socketserver.TCPServer default
+        "workers": 1,
+        "processes": 1,
+    },
+    "threads": {
+        "max_connections": 128,
+        "backlog": 128,
+        "workers": 32,
+        "processes": 1,
+    },
+    "prefork": {
+        "max_connections": 64,
+        "backlog": 512,
+        "workers": 16,
+        "processes": os.cpu_count() or 1,
+    },
+    "asyncio": {
+        "max_connections": 1024,
+        "backlog": 1024,
+        "workers": 32,
+        "processes": 1,
+    },
+}
+
+DEFAULT_SERVER_MODE : str = "threads"
+
+
+def get_server_config() -> tuple[str, dict[str, int]]:
+    # read SERVER_MODE and the per-mode limits from the environment
+    # SERVER_MAX_CONNECTIONS / SERVER_BACKLOG / SERVER_WORKERS / SERVER_PROCESSES override the defaults above
+    mode : str = os.environ.get("SERVER_MODE", DEFAULT_SERVER_MODE).lower()
+    if mode not in SERVER_MODES:
+        raise ValueError("unknown SERVER_MODE '" + mode + "', expected one of " + ", ".join(SERVER_MODES))
+
+    config : dict[str, int] = dict(SERVER_MODES[mode])
+    for key in config:
+        env_value = os.environ.get("SERVER_" + key.upper())
+        if env_value is not None:
+            config[key] = max(1, int(env_value))
+
+    return mode, config
+
+
+class DetachableMixin:
+    # a handler can hand its socket over to something that outlives it (util/push.py's broker),
+    # the server must not close those when the handler returns
+    def shutdown_request(self, request) -> None:
+        if is_detached(request):
+            return
+        super().shutdown_request(request)
+
+
+class SerialTCPServer(DetachableMixin, socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+class ThreadPoolTCPServer(DetachableMixin, socketserver.TCPServer):
+    # TCPServer that hands every accepted connection to a fixed pool of worker threads
+    # (socketserver.ThreadingMixIn would start an unbounded number of threads instead)
+
+    allow_reuse_address = True
+    daemon_threads = True
+    # handlers return between keep-alive requests instead of blocking a worker in recv(), see server.py
+    parks_idle_connections = True
+
+    def __init__(self, server_address, handler_class, workers : int, max_connections : int, backlog : int) -> None:
+        # listen() is called from server_activate() using request_queue_size
+        self.request_queue_size : int = backlog
+        self.executor : ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers,
+                                                                thread_name_prefix="worker")
+
+        # once max_connections are in flight, the accept loop blocks here, so any
+        # further connections wait in the kernel backlog instead of piling up in Python
+        self.connection_slots : threading.BoundedSemaphore = threading.BoundedSemaphore(max_connections)
+        # keep-alive connections between requests, they hold neither a worker nor a slot
+        self.idle_connections : IdleConnections = IdleConnections(self.resume_connection, self.close_idle_connection)
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address) -> None:
+        self.connection_slots.acquire()
+        try:
+            self.executor.submit(self.process_request_thread, request, client_address)
+        except RuntimeError:
+            # executor was shut down while we were waiting for a slot
+            self.connection_slots.release()
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address) -> None:
+        # same as socketserver.ThreadingMixIn.process_request_thread, except that a keep-alive connection
+        # that's waiting for its next request is parked instead of closed (the slot is given back either way)
+        handler = None
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.connection_slots.release()
+            self.after_handler(handler, request)
+
+    def after_handler(self, handler, request) -> None:
+        if handler is not None and handler.idle and not is_detached(request):
+            if self.idle_connections.park(handler):
+                return
+            # too many parked already
+            handler.connection_closed()
+        self.shutdown_request(request)
+
+    def resume_connection(self, handler) -> None:
+        # (keep-alive selector thread) the parked connection's next request is arriving, or it was closed
+        try:
+            self.executor.submit(self.resume_request_thread, handler)
+        except RuntimeError:
+            # executor was shut down
+            self.close_idle_connection(handler)
+
+    def resume_request_thread(self, handler) -> None:
+        try:
+            handler.handle()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            self.after_handler(handler, handler.request)
+
+    def close_idle_connection(self, handler) -> None:
+        # (keep-alive selector thread) idle for KEEP_ALIVE_TIMEOUT
+        handler.connection_closed()
+        self.shutdown_request(handler.request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def serve_serial(server_address, handler_class, config : dict[str, int]) -> None:
+    SerialTCPServer.request_queue_size = config["backlog"]
+    with SerialTCPServer(server_address, handler_class) as server:
+        server.serve_forever()
+
+
+def serve_threads(server_address, handler_class, config : dict[str, int]) -> None:
+    with ThreadPoolTCPServer(server_address, handler_class,
+                             config["workers"], config["max_connections"], config["backlog"]) as server:
+        server.serve_forever()
+
+
+def serve_prefork(server_address, handler_class, config : dict[str, int]) -> None:
+    # parent binds + listens once, then forks the workers, which all accept on the same socket
+    # the kernel spreads the incoming connections across the processes
+    server = ThreadPoolTCPServer(server_address, handler_class,
+                                 config["workers"], config["max_connections"], config["backlog"])
+
+    # every process wakes up on a new connection but only one gets it, the others
+    # get a BlockingIOError from accept() (socketserver ignores it) instead of blocking
+    server.socket.setblocking(False)
+
+    children : set[int] = set()
+
+    def spawn_child() -> None:
+        pid : int = os.fork()
+        if pid == 0:
+            # child: default signal handling, serve until killed
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop_children(signum, frame) -> None:
+        for child_pid in list(children):
+            try:
+                os.kill(child_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        server.server_close()
+        sys.exit(0)
+
+    # the executor's threads are only started lazily on submit(), so nothing is lost in the fork
+    for _ in range(config["processes"]):
+        spawn_child()
+
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+
+    # restart any worker that dies so the pool stays at the configured size
+    while True:
+        pid, status = os.wait()
+        children.discard(pid)
+        print("worker " + str(pid) + " exited with status " + str(status) + ", restarting")
+        spawn_child()
+
+
+class AsyncioServerInfo:
+    # stands in for the socketserver server object that request handlers get passed
+    # handlers return between keep-alive requests, the connection waits on the event loop (serve_connection)
+    parks_idle_connections = True
+
+    def __init__(self, server_address) -> None:
+        self.server_address = server_address
+
+    def shutdown_request(self, request) -> None:
+        # same as socketserver.TCPServer.shutdown_request
+        if is_detached(request):
+            return
+        try:
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        request.close()
+
+
+def start_handler(handler_class, request, client_address, server):
+    # (executor) the connection's first turn, None if the handler raised
+    try:
+        return handler_class(request, client_address, server)
+    except Exception:
+        print_handler_error(client_address)
+        return None
+
+
+def resume_handler(handler) -> bool:
+    # (executor) the connection's next request is arriving, False if the handler raised
+    try:
+        handler.handle()
+        return True
+    except Exception:
+        print_handler_error(handler.client_address)
+        return False
+
+
+def print_handler_error(client_address) -> None:
+    print("Exception occurred during processing of request from", client_address)
+    import traceback
+    traceback.print_exc()
+
+
+async def wait_readable(sock : socket.socket, timeout : float) -> bool:
+    # False if nothing arrived (and the client didn't close) within timeout
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+
+    def on_readable() -> None:
+        if not readable.done():
+            readable.set_result(True)
+
+    loop.add_reader(sock.fileno(), on_readable)
+    try:
+        await asyncio.wait_for(readable, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+async def serve_connection(executor : ThreadPoolExecutor, handler_class, connection : socket.socket,
+                           client_address, server_info : AsyncioServerInfo) -> None:
+    # a connection lives here on the event loop, it only takes an executor thread while it has bytes to serve
+    # (the route actions are blocking pymongo code, so each turn of the handler runs in the executor)
+    loop = asyncio.get_running_loop()
+    handler = None
+    try:
+        while await wait_readable(connection, KEEP_ALIVE_TIMEOUT):
+            if handler is None:
+                handler = await loop.run_in_executor(executor, start_handler,
+                                                     handler_class, connection, client_address, server_info)
+                if handler is None:
+                    return
+            elif not await loop.run_in_executor(executor, resume_handler, handler):
+                return
+            # not idle: the handler closed the connection, or handed the socket over (util/push.py)
+            if not handler.idle:
+                return
+    finally:
+        if handler is not None and handler.idle:
+            # went quiet for KEEP_ALIVE_TIMEOUT while idle
+            handler.connection_closed()
+        server_info.shutdown_request(connection)
+
+
+async def accept_loop(server_address, handler_class, config : dict[str, int]) -> None:
+    loop = asyncio.get_running_loop()
+    executor : ThreadPoolExecutor = ThreadPoolExecutor(max_workers=config["workers"],
+                                                       thread_name_prefix="worker")
+    # every open connection holds one, whether a worker is serving it or it's waiting on the loop
+    connection_slots : asyncio.Semaphore = asyncio.Semaphore(config["max_connections"])
+    server_info : AsyncioServerInfo = AsyncioServerInfo(server_address)
+    # the loop only keeps weak references to tasks
+    connections : set[asyncio.Task] = set()
+
+    listener : socket.socket = socket.create_server(server_address, backlog=config["backlog"])
+    listener.setblocking(False)
+
+    def connection_done(task : asyncio.Task) -> None:
+        connections.discard(task)
+        connection_slots.release()
+
+    while True:
+        # stop accepting while max_connections are open, the kernel backlog queues the rest
+        await connection_slots.acquire()
+        try:
+            connection, client_address = await loop.sock_accept(listener)
+        except OSError:
+            connection_slots.release()
+            continue
+
+        # handlers use blocking sendall/recv in the executor thread
+        connection.setblocking(True)
+        task : asyncio.Task = loop.create_task(serve_connection(executor, handler_class, connection,
+                                                                client_address, server_info))
+        connections.add(task)
+        task.add_done_callback(connection_done)
+
+
+def serve_asyncio(server_address, handler_class, config : dict[str, int]) -> None:
+    asyncio.run(accept_loop(server_address, handler_class, config))
+
+
+SERVE_FUNCTIONS : dict = {
+    "serial": serve_serial,
+    "threads": serve_threads,
+    "prefork": serve_prefork,
+    "asyncio": serve_asyncio,
+}
+
+
+def serve(server_address, handler_class) -> None:
+    mode, config = get_server_config()
+    print("Serving in '" + mode + "' mode with " +
+          ", ".join(key + "=" + str(value) for key, value in config.items()))
+    SERVE_FUNCTIONS[mode](server_address, handler_class, config)
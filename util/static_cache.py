@@ -0,0 +1,248 @@
+import email.utils
+import hashlib
+import os
+import stat
+import threading
+import time
+
+from util.compression import COMPRESSION_MIN_SIZE, compress
+
+# how often (seconds) a cached file's mtime is checked against the disk
+STATIC_CHECK_INTERVAL : float = float(os.environ.get("STATIC_CHECK_INTERVAL", "1"))
+
+# files bigger than this aren't kept in memory, they are sent with sendfile() from the disk
+STATIC_MAX_CACHED_SIZE : int = int(os.environ.get("STATIC_MAX_CACHED_SIZE", str(64 * 1024)))
+
+LAYOUT_PATH : str = "public/layout/layout.html"
+
+
+class CachedFile:
+    # the bytes we serve for a path, plus everything needed for conditional requests
+    # body is None for files too big to keep in memory (see large_file_entry)
+    def __init__(self, body : bytes | None, mtime : float, source_mtimes : tuple[int, ...],
+                 size : int | None = None, etag : str | None = None) -> None:
+        self.body : bytes | None = body
+        self.size : int = len(body) if body is not None else size
+
+        # strong ETag: changes whenever the served bytes change
+        if etag is None and body is not None:
+            etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.etag : str = etag or ""
+
+        # HTTP-date, only has second precision
+        self.mtime : int = int(mtime)
+        self.last_modified : str = email.utils.formatdate(self.mtime, usegmt=True)
+
+        # st_mtime_ns of every file this entry was built from, to notice changes
+        self.source_mtimes : tuple[int, ...] = source_mtimes
+        self.checked_at : float = time.monotonic()
+
+        # compressed copies of body, built the first time a client asks for them
+        # encoding -> (compressed body, ETag), or None if compressing didn't make it smaller
+        self.variants : dict[str, tuple[bytes, str] | None] = {}
+
+        # whole 200 responses for this entry, (Content-Type, encoding) -> PrebuiltResponse
+        # filled by send_cached() in util/static_paths.py
+        self.responses : dict = {}
+
+    def get_variant(self, encoding : str) -> tuple[bytes, str] | None:
+        # (body compressed with encoding, its ETag), None if it isn't worth sending compressed
+        if encoding not in self.variants:
+            variant : tuple[bytes, str] | None = None
+            if self.body is not None and len(self.body) >= COMPRESSION_MIN_SIZE:
+                compressed : bytes = compress(self.body, encoding, static=True)
+                if len(compressed) < len(self.body):
+                    # each representation needs its own strong ETag
+                    variant = (compressed, self.etag[:-1] + "-" + encoding + '"')
+            # two threads might both compress it the first time, either result is fine
+            self.variants[encoding] = variant
+        return self.variants[encoding]
+
+
+class StaticCache:
+    # keeps static files and rendered templates in memory
+    # entries are rebuilt when the mtime of any file they came from changes
+    # (checked at most once every check_interval seconds per entry)
+
+    def __init__(self, check_interval : float = STATIC_CHECK_INTERVAL) -> None:
+        self.check_interval : float = check_interval
+        self.entries : dict[str, CachedFile] = {}
+        self.lock : threading.Lock = threading.Lock()
+
+    def get_file(self, file_path : str) -> CachedFile | None:
+        # None if the file doesn't exist
+        # entry.body is None if the file is bigger than STATIC_MAX_CACHED_SIZE,
+        # the caller opens it and uses large_file_entry() + sendfile() instead
+        return self.get(file_path, (file_path,), read_small_file)
+
+    def get_template(self, page_path : str, layout_path : str = LAYOUT_PATH) -> CachedFile | None:
+        # page_path rendered into the layout, rebuilt if either file changes
+        return self.get("template:" + page_path, (page_path, layout_path), render_template_bytes)
+
+    def get(self, key : str, source_paths : tuple[str, ...], build) -> CachedFile | None:
+        entry : CachedFile | None = self.entries.get(key)
+        now : float = time.monotonic()
+        if entry is not None and now - entry.checked_at < self.check_interval:
+            return entry
+
+        source_mtimes : tuple[int, ...] | None = get_mtimes(source_paths)
+        if source_mtimes is None:
+            # file was deleted (or never existed)
+            self.entries.pop(key, None)
+            return None
+
+        if entry is not None and entry.source_mtimes == source_mtimes:
+            entry.checked_at = now
+            return entry
+
+        with self.lock:
+            # another thread might have rebuilt it while we waited
+            entry = self.entries.get(key)
+            if entry is not None and entry.source_mtimes == source_mtimes:
+                return entry
+            try:
+                body : bytes | None = build(*source_paths)
+            except OSError:
+                return None
+            entry = CachedFile(body, max(mtime_ns / 1e9 for mtime_ns in source_mtimes), source_mtimes)
+            self.entries[key] = entry
+            return entry
+
+
+def get_mtimes(paths : tuple[str, ...]) -> tuple[int, ...] | None:
+    mtimes : list[int] = []
+    for path in paths:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(stat_result.st_mode):
+            return None
+        mtimes.append(stat_result.st_mtime_ns)
+    return tuple(mtimes)
+
+
+def read_file(file_path : str) -> bytes:
+    with open(file_path, "rb") as fileObj:
+        return fileObj.read()
+
+
+def read_small_file(file_path : str) -> bytes | None:
+    # None (don't cache) for big files
+    if os.path.getsize(file_path) > STATIC_MAX_CACHED_SIZE:
+        return None
+    return read_file(file_path)
+
+
+def large_file_entry(stat_result : os.stat_result) -> CachedFile:
+    # validators for a file that is sent from the disk, from the fstat() of the open file
+    # so they always describe the bytes that are actually sent
+    # (ETag from size + mtime like most web servers, hashing it would mean reading it)
+    etag : str = '"' + format(stat_result.st_size, "x") + "-" + format(stat_result.st_mtime_ns, "x") + '"'
+    return CachedFile(None, stat_result.st_mtime, (stat_result.st_mtime_ns,),
+                      size=stat_result.st_size, etag=etag)
+
+
+def render_template_bytes(page_path : str, layout_path : str) -> bytes:
+    # replace {{content}} in the layout with the page
+    return read_file(layout_path).replace(b"{{content}}", read_file(page_path))
+
+
+def is_not_modified(request, entry : CachedFile, etag : str | None = None) -> bool:
+    # True if the client's cached copy (If-None-Match / If-Modified-Since) is still current
+    # etag is the ETag of the representation being sent (a compressed variant has its own)
+    if etag is None:
+        etag = entry.etag
+    if_none_match : str | None = request.get_header("If-None-Match")
+    if_modified_since : str | None = request.get_header("If-Modified-Since")
+
+    # If-None-Match wins when both are sent (RFC 9110 13.2.2)
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since is None:
+            return False
+        return entry.mtime <= since.timestamp()
+
+    return False
+
+
+def etag_matches(if_none_match : str | None, etag : str) -> bool:
+    # True if etag is in the list of an If-None-Match header
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison: W/"abc" matches "abc"
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+# shared by every connection
+static_cache : StaticCache = StaticCache()
+
+
+def test1():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "a.txt")
+        with open(path, "wb") as f:
+            f.write(b"one")
+
+        cache = StaticCache(check_interval=0)
+        first = cache.get_file(path)
+        assert first.body == b"one"
+        assert cache.get_file(path) is first
+
+        # change the file (and make sure the mtime moves)
+        with open(path, "wb") as f:
+            f.write(b"two")
+        os.utime(path, ns=(first.source_mtimes[0] + 10**9, first.source_mtimes[0] + 10**9))
+        second = cache.get_file(path)
+        assert second.body == b"two"
+        assert second.etag != first.etag
+
+        assert cache.get_file(os.path.join(directory, "missing.txt")) is None
+    print("test1 passed")
+
+def test2():
+    from util.request import Request
+
+    entry = CachedFile(b"hello", 1700000000, (0,))
+    request = Request(b'GET / HTTP/1.1\r\nIf-None-Match: W/' + entry.etag.encode() + b'\r\n\r\n')
+    assert is_not_modified(request, entry)
+    request = Request(b'GET / HTTP/1.1\r\nIf-None-Match: "nope"\r\nIf-Modified-Since: ' +
+                      entry.last_modified.encode() + b'\r\n\r\n')
+    assert not is_not_modified(request, entry)
+    request = Request(b'GET / HTTP/1.1\r\nIf-Modified-Since: ' + entry.last_modified.encode() + b'\r\n\r\n')
+    assert is_not_modified(request, entry)
+    request = Request(b'GET / HTTP/1.1\r\nIf-Modified-Since: Sat, 01 Jan 2000 00:00:00 GMT\r\n\r\n')
+    assert not is_not_modified(request, entry)
+    print("test2 passed")
+
+def test3():
+    entry = CachedFile(b"var x = 1;\n" * 500, 1700000000, (0,))
+    body, etag = entry.get_variant("gzip")
+    assert len(body) < len(entry.body)
+    assert etag != entry.etag
+    assert entry.get_variant("gzip")[0] is body
+
+    # not worth it for tiny files
+    assert CachedFile(b"tiny", 1700000000, (0,)).get_variant("gzip") is None
+    print("test3 passed")
+
+if __name__ == '__main__':
+    test1()
+    test2()
+    test3()
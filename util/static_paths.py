@@ -1,7 +1,12 @@
 # from server import MyTCPHandler
+import os
 
 from util.request import Request
 from util.response import Response
+from util.response_cache import PrebuiltResponse
+from util.router import NOT_FOUND_RESPONSE
+from util.compression import is_compressible, negotiate
+from util.static_cache import CachedFile, static_cache, is_not_modified, large_file_entry
 
 extension_to_mime_type : dict[str, str] = {
     "html": "text/html",
@@ -15,64 +20,182 @@ extension_to_mime_type : dict[str, str] = {
     "ico": "image/x-icon"
 }
 
+# static files and rendered pages are revalidated by the browser on every use,
+# which costs a 304 with no body when nothing changed
+CACHE_CONTROL : str = "no-cache"
+
 # This path is provided as an example of how to use the router
 def serve_static_file(request : Request, handler) -> None:
     # this is the action for any path starting with "/public"
     # splice the path to get file to serve in Response
     # make sure to use the right MIME type from the file extension
 
-    ##################################
-    # don't know how/when to send a 404
-
-    file_path = request.path[1:] # just get rid of the leading "/"
+    file_path : str = os.path.normpath(request.path[1:]) # just get rid of the leading "/"
 
-    # chance for error if path is not to file but still valid
+    # "/public/../server.py" must not escape the public folder
+    if not file_path.startswith("public" + os.sep):
+        send_not_found(handler)
+        return
 
     # determine MIME type
     extension : str = request.path.rsplit('.', 1)[-1]  # https://docs.python.org/3/library/stdtypes.html#str.rsplit
 
-    # unavoidable KeyError if path does not lead to file with extension
     mime_type : str = "text/plain; charset=utf-8"
 
     if extension in extension_to_mime_type:
         mime_type = extension_to_mime_type[extension]
 
-    content_type : dict[str, str] = {
-        "Content-Type": mime_type
-    }
-
-    # read bytes of the file
-    with open(file_path, "rb") as fileObj:
-        # send final response
-        res = Response()
-        res.headers(content_type)               # update Content-Type
-        res.bytes(fileObj.read())               # read the file in binary
-        handler.request.sendall(res.to_data())  # send bytes of response
-
+    # bytes of the file come from memory, only re-read when the file changes on disk
+    entry : CachedFile | None = static_cache.get_file(file_path)
+    if entry is None:
+        send_not_found(handler)
+        return
+
+    if entry.body is not None:
+        send_cached(request, handler, entry, mime_type)
+        return
+
+    # too big to keep in memory: sendfile() it straight from the disk
+    try:
+        fileObj = open(file_path, "rb")
+    except OSError:
+        send_not_found(handler)
+        return
+    with fileObj:
+        send_cached(request, handler, large_file_entry(os.fstat(fileObj.fileno())), mime_type, fileObj)
     return
 
 def render_template(request : Request, handler, path_to_render : str) -> None:
-    # read from template_path
-    # read from layout.htmp
-    # replace {{content}} with contents of template_path
-    # send bytes through response
-    with open(path_to_render, "rb") as fileObj:
-        new_content : bytes = fileObj.read()
-
-    template_path : str = "public/layout/layout.html"
-    with open(template_path, "rb") as fileObj:
-        to_replace : bytes = fileObj.read()
+    # layout.html with {{content}} replaced by path_to_render
+    # rendered once and kept in memory until either file changes
+    entry : CachedFile | None = static_cache.get_template(path_to_render)
+    if entry is None:
+        send_not_found(handler)
+        return
+
+    send_cached(request, handler, entry, "text/html")
+    return
 
-    # replace
-    to_render : bytes = to_replace.replace(b"{{content}}", new_content)
+def send_cached(request : Request, handler, entry : CachedFile, mime_type : str, fileObj = None) -> None:
+    # 304 Not Modified if the browser already has this version, otherwise the whole file
+    # or the part asked for with a Range header (206 Partial Content)
+    # fileObj is the open file for entries without a body in memory
+
+    # text files go out compressed when the client accepts it (not for Range requests,
+    # the range would have to be a range of the compressed bytes)
+    body : bytes | None = entry.body
+    etag : str = entry.etag
+    encoding : str | None = None
+    compressible : bool = is_compressible(mime_type)
+    if compressible and body is not None and request.get_header("Range") is None:
+        encoding = negotiate(request.get_header("Accept-Encoding"))
+        variant : tuple[bytes, str] | None = None
+        if encoding is not None:
+            variant = entry.get_variant(encoding)
+        if variant is None:
+            encoding = None
+        else:
+            body, etag = variant
+
+    # the 304 repeats the headers of the 200 it stands in for (the browser updates its cached copy with them)
+    validators : dict[str, str] = {
+        "Content-Type": mime_type,
+        "ETag": etag,
+        "Last-Modified": entry.last_modified,
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes"
+    }
+    if compressible:
+        # caches must keep the compressed and uncompressed copies apart
+        validators["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        validators["Content-Encoding"] = encoding
+
+    if is_not_modified(request, entry, etag):
+        res = (Response()
+               .set_status(304, "Not Modified")
+               .headers(validators))
+        res.send(handler.request)
+        return
+
+    byte_range : tuple[int, int] | None = get_byte_range(request, entry)
+    if byte_range == UNSATISFIABLE_RANGE:
+        res = (Response()
+               .set_status(416, "Range Not Satisfiable")
+               .headers({"Content-Range": "bytes */" + str(entry.size)})
+               .text("Requested range not satisfiable"))
+        res.send(handler.request)
+        return
+
+    if byte_range is None and body is not None:
+        # the whole file from memory: the same bytes for everyone asking for this encoding,
+        # serialized the first time and kept with the entry (a changed file gets a new entry)
+        key : tuple[str, str | None] = (mime_type, encoding)
+        prebuilt : PrebuiltResponse | None = entry.responses.get(key)
+        if prebuilt is None:
+            prebuilt = PrebuiltResponse(Response().headers(validators).bytes(body))
+            entry.responses[key] = prebuilt
+        prebuilt.send(handler.request)
+        return
 
-    # send response
     res = Response()
-    res.headers({
-        "Content-Type": "text/html"
-    })
-    res.bytes(to_render)
-    handler.request.sendall(res.to_data())
+    res.headers(validators)                     # update Content-Type, add validators
+
+    start : int = 0
+    end : int = entry.size        # exclusive
+    if byte_range is not None:
+        start, end = byte_range
+        res.set_status(206, "Partial Content")
+        res.headers({"Content-Range": "bytes " + str(start) + "-" + str(end - 1) + "/" + str(entry.size)})
+
+    if body is not None:
+        res.bytes(body[start:end])
+    else:
+        res.file(fileObj, start, end - start)
+
+    res.send(handler.request)                   # send bytes of response
+    return
+
+# returned by get_byte_range when the Range header can't be served (416)
+UNSATISFIABLE_RANGE : tuple[int, int] = (-1, -1)
+
+def get_byte_range(request : Request, entry : CachedFile) -> tuple[int, int] | None:
+    # (start, end) with end exclusive for a single "Range: bytes=..." request,
+    # None to send the whole file (no Range, a stale If-Range, or a multi-range request)
+    range_header : str | None = request.get_header("Range")
+    if range_header is None or not range_header.startswith("bytes="):
+        return None
+
+    # If-Range: only send the part if the client's copy is still this version
+    if_range : str | None = request.get_header("If-Range")
+    if if_range is not None and if_range.strip() not in (entry.etag, entry.last_modified):
+        return None
+
+    ranges : list[str] = range_header[len("bytes="):].split(",")
+    if len(ranges) != 1:
+        # multipart/byteranges isn't supported, the whole file is a valid answer
+        return None
+
+    first, _, last = ranges[0].strip().partition("-")
+    try:
+        if first == "":
+            # "bytes=-500" => the last 500 bytes
+            suffix_length : int = int(last)
+            if suffix_length <= 0:
+                return UNSATISFIABLE_RANGE
+            return max(0, entry.size - suffix_length), entry.size
+
+        start : int = int(first)
+        end : int = entry.size if last == "" else min(int(last) + 1, entry.size)
+    except ValueError:
+        return None
+
+    if start >= entry.size or start >= end:
+        return UNSATISFIABLE_RANGE
+    return start, end
+
+def send_not_found(handler) -> None:
+    NOT_FOUND_RESPONSE.send(handler.request)
     return
 
 def handle_index(request : Request, handler) -> None:
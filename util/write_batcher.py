@@ -0,0 +1,254 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from util.metrics import add_time
+
+# CHAT_WRITE_BATCHING=true: chat inserts and message updates from every handler thread are put together
+# into one bulk_write (group commit) instead of one round trip each
+CHAT_WRITE_BATCHING = os.environ.get("CHAT_WRITE_BATCHING", "false")
+
+# a batch goes out CHAT_BATCH_WINDOW_MS after its first write, or as soon as it has CHAT_BATCH_MAX_SIZE writes
+# (the most a write waits before it's sent is the window plus the batch in front of it)
+CHAT_BATCH_WINDOW_MS : float = float(os.environ.get("CHAT_BATCH_WINDOW_MS", "2"))
+CHAT_BATCH_MAX_SIZE : int = int(os.environ.get("CHAT_BATCH_MAX_SIZE", "256"))
+
+# backpressure: at most this many writes waiting for a batch, a handler waits up to
+# CHAT_BATCH_QUEUE_TIMEOUT seconds for room and then gets WriteQueueFull (503)
+CHAT_BATCH_QUEUE_SIZE : int = int(os.environ.get("CHAT_BATCH_QUEUE_SIZE", "4096"))
+CHAT_BATCH_QUEUE_TIMEOUT : float = float(os.environ.get("CHAT_BATCH_QUEUE_TIMEOUT", "1"))
+
+
+class WriteQueueFull(Exception):
+    # the database isn't keeping up, the write was not made
+    pass
+
+
+class WriteFailed(Exception):
+    # the batch's bulk_write failed: the database refused this write, or the whole batch failed
+    # (then it may or may not have been made, the database's exception is the __cause__)
+    pass
+
+
+def batch_failed(error : Exception) -> WriteFailed:
+    failed : WriteFailed = WriteFailed("write batch failed: " + repr(error))
+    failed.__cause__ = error
+    return failed
+
+
+# a write of a batch is a plain (operation, filter, document, upsert) tuple:
+#   (INSERT, None, document, False)  /  (UPDATE, query, update, upsert)
+# util/fake_collection.py's bulk_write takes them as they are, pymongo's gets its InsertOne/UpdateOne made from them
+INSERT : str = "insert"
+UPDATE : str = "update"
+
+
+def bulk_write(collection, operations : list[tuple], ordered : bool = True):
+    # collection.bulk_write() for the plain tuples above
+    # (collections that take them say so with plain_bulk_write = True, pymongo's Collection makes a
+    # sub-collection out of any attribute name, hence "is True")
+    if getattr(collection, "plain_bulk_write", False) is True:
+        return collection.bulk_write(operations, ordered=ordered)
+    return collection.bulk_write([InsertOne(document) if operation == INSERT else UpdateOne(query, document, upsert=upsert)
+                                  for operation, query, document, upsert in operations], ordered=ordered)
+
+
+class PendingWrite:
+    def __init__(self, operation : tuple, message_id : str, seq : int) -> None:
+        self.operation : tuple = operation  # (INSERT / UPDATE, filter, document, upsert), see above
+        self.message_id : str = message_id
+        self.seq : int = seq
+        self.future : Future = Future()
+
+
+class WriteBatcher:
+    # write-behind queue in front of the chat collection (see MessageStore.insert/update)
+    # handlers still wait for their own write: insert() returns once the batch it was in is in the database,
+    # update() returns the updated message like find_one_and_update, and both raise if their write failed
+    #
+    # bulk_write only says how many updates matched in total, so the batch's messages are read back
+    # (one find for the whole batch) to tell which ones did: an update matched if the message's seq
+    # is at least its own, every update stamps it with $max (MessageStore.update)
+    # MessageStore holds the message's write lock while it waits, so a batch never has two updates of
+    # the same message from this process
+    # (another process updating the same message at the same moment can make an update whose condition
+    # didn't match look like it did)
+
+    def __init__(self, collection, projection : dict,
+                 window : float = CHAT_BATCH_WINDOW_MS / 1000,
+                 max_size : int = CHAT_BATCH_MAX_SIZE,
+                 queue_size : int = CHAT_BATCH_QUEUE_SIZE,
+                 queue_timeout : float = CHAT_BATCH_QUEUE_TIMEOUT) -> None:
+        self.collection = collection
+        self.projection : dict = projection
+        self.window : float = window
+        self.max_size : int = max_size
+        self.queue_timeout : float = queue_timeout
+        self.queue : queue.Queue = queue.Queue(maxsize=queue_size)
+
+        # started by the first write (not at import, SERVER_MODE=prefork forks after that)
+        self.thread : threading.Thread | None = None
+        self.lock : threading.Lock = threading.Lock()
+
+    def insert(self, document : dict, seq : int) -> None:
+        # like insert_one(document), document gets its _id
+        # (waiting for the batch counts as database time, the flusher thread isn't working for any one request)
+        started : float = time.perf_counter()
+        try:
+            self.submit(PendingWrite((INSERT, None, document, False), document["id"], seq)).result()
+        finally:
+            add_time("db", started)
+
+    def update(self, query : dict, update : dict, message_id : str, seq : int) -> dict | None:
+        # like find_one_and_update(query, update, return_document=AFTER), update has to $max the seq
+        started : float = time.perf_counter()
+        try:
+            return self.submit(PendingWrite((UPDATE, query, update, False), message_id, seq)).result()
+        finally:
+            add_time("db", started)
+
+    def submit(self, pending : PendingWrite) -> Future:
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="write-batcher", daemon=True)
+                    self.thread.start()
+        try:
+            self.queue.put(pending, timeout=self.queue_timeout)
+        except queue.Full:
+            raise WriteQueueFull("write queue is full")
+        return pending.future
+
+    def run(self) -> None:
+        while True:
+            batch : list[PendingWrite] = [self.queue.get()]
+            deadline : float = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining : float = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.flush(batch)
+
+    def flush(self, batch : list[PendingWrite]) -> None:
+        # one bulk_write for the batch, then every waiting handler gets its own result
+        failed : dict[int, str] = {}
+        try:
+            bulk_write(self.collection, [pending.operation for pending in batch], ordered=False)
+        except BulkWriteError as e:
+            # unordered: everything but these went through
+            for error in e.details.get("writeErrors", []):
+                failed[error["index"]] = error.get("errmsg", "write failed")
+        except Exception as e:
+            # nothing is known about any of them
+            for pending in batch:
+                pending.future.set_exception(batch_failed(e))
+            return
+
+        updated : list[PendingWrite] = []
+        for index, pending in enumerate(batch):
+            if index in failed:
+                pending.future.set_exception(WriteFailed(failed[index]))
+            elif pending.operation[0] == UPDATE:
+                updated.append(pending)
+            else:
+                pending.future.set_result(None)
+        if len(updated) == 0:
+            return
+
+        try:
+            messages : dict[str, dict] = {message["id"]: message for message in
+                                          self.collection.find({"id": {"$in": [pending.message_id for pending in updated]}},
+                                                               self.projection)}
+        except Exception as e:
+            for pending in updated:
+                pending.future.set_exception(batch_failed(e))
+            return
+        for pending in updated:
+            message : dict | None = messages.get(pending.message_id)
+            if message is not None and message.get("seq", 0) >= pending.seq:
+                pending.future.set_result(message)
+            else:
+                # the query didn't match
+                pending.future.set_result(None)
+
+
+def test1():
+    from util.fake_collection import FakeCollection
+
+    collection = FakeCollection()
+    batcher = WriteBatcher(collection, {"_id": 0}, window=0.05)
+
+    # a burst of inserts from 20 threads goes out in one or two batches
+    calls = []
+    fake_bulk_write = collection.bulk_write
+    def counting_bulk_write(requests, ordered=True):
+        calls.append(len(requests))
+        return fake_bulk_write(requests, ordered)
+    collection.bulk_write = counting_bulk_write
+
+    threads = [threading.Thread(target=batcher.insert, args=({"id": str(n), "seq": n, "reactions": {}}, n))
+               for n in range(1, 21)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert collection.count_documents({}) == 20 and sum(calls) == 20 and len(calls) <= 2
+
+    # an update whose condition matches gets the message back, one that doesn't gets None
+    message = batcher.update({"id": "1", "reactions.x": {"$ne": "u"}},
+                             {"$addToSet": {"reactions.x": "u"}, "$max": {"seq": 30}}, "1", 30)
+    assert message["reactions"] == {"x": ["u"]} and message["seq"] == 30
+    assert batcher.update({"id": "1", "reactions.x": {"$ne": "u"}},
+                          {"$addToSet": {"reactions.x": "u"}, "$max": {"seq": 31}}, "1", 31) is None
+    assert batcher.update({"id": "nope"}, {"$max": {"seq": 32}}, "nope", 32) is None
+
+    # the database failing fails every write of the batch, with WriteFailed
+    def broken_bulk_write(requests, ordered=True):
+        raise ConnectionError("database is down")
+    collection.bulk_write = broken_bulk_write
+    try:
+        batcher.insert({"id": "x", "seq": 40}, 40)
+        assert False
+    except WriteFailed as e:
+        assert isinstance(e.__cause__, ConnectionError)
+
+    # one write refused: only that one fails
+    def refusing_bulk_write(requests, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "errmsg": "duplicate key"}]})
+    collection.bulk_write = refusing_bulk_write
+    try:
+        batcher.insert({"id": "x", "seq": 41}, 41)
+        assert False
+    except WriteFailed as e:
+        assert str(e) == "duplicate key"
+
+    # full queue => WriteQueueFull instead of waiting forever
+    stuck = WriteBatcher(collection, {"_id": 0}, queue_size=1, queue_timeout=0.01)
+    stuck.thread = threading.current_thread()       # nobody takes writes off the queue
+    stuck.submit(PendingWrite((INSERT, None, {"id": "y"}, False), "y", 41))
+    try:
+        stuck.submit(PendingWrite((INSERT, None, {"id": "z"}, False), "z", 42))
+        assert False
+    except WriteQueueFull:
+        pass
+
+    # anything else (pymongo's Collection) gets InsertOne / UpdateOne
+    class MongoLike:
+        def bulk_write(self, requests, ordered=True):
+            self.requests = requests
+    mongo_like = MongoLike()
+    bulk_write(mongo_like, [(INSERT, None, {"id": "a"}, False), (UPDATE, {"id": "a"}, {"$set": {"x": 1}}, False)])
+    assert isinstance(mongo_like.requests[0], InsertOne) and isinstance(mongo_like.requests[1], UpdateOne)
+    print("test1 passed")
+
+if __name__ == '__main__':
+    test1()